@@ -1,10 +1,19 @@
 # eeg_main_view_full.py
 import os
+import sys
 import numpy as np
-from scipy.signal import welch, detrend
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm-backend"))
+from rd_parser import to_rd000, align_channels
+from rd_cache import default_cache
+from rd_loader import iter_recordings
+from eeg_dsp import PSDEngine
+from feature_cache import FeatureCache, default_feature_cache
+from group_stats import GroupStatsStore
+from quantile_sketch import sketch_percentiles
+
 # ---------- CONFIG ----------
 DEMO_FILES = [
     "llm-backend/ControlDataset/co2c0000337.rd.000",
@@ -33,218 +42,103 @@ MAX_DISPLAY_SECONDS = 1.0  # clip to 0..1.0 s
 DEFAULT_N_CHANS = 64
 DEFAULT_N_SAMPLES = 416
 DEFAULT_SAMPLING_MS = 3.906000  # -> 256 Hz
+LOAD_WORKERS = 1  # >1 parses files in a process pool (parsed recordings are cached in llm-backend/.rd_cache)
+PSD_NPERSEG = 256
+ALPHA_BAND = (8, 12)
+QUANTILE_MODE = "exact"  # "sketch": approximate percentiles with bounded memory (mergeable KLL-style sketches)
+SKETCH_SIZE = 128
+FEATURE_CACHE = True  # reuse grand average/PSDs/band power and cohort aggregates from llm-backend/.feature_cache when data and parameters are unchanged
 
-# ---------- Parser ----------
-def parse_rd000(path):
+# ---------- PSD / band helpers ----------
+def compute_psd_all_channels(data, fs, nperseg=256, filled=None, engine=None):
     """
-    Parse .rd.000 file and return:
-      data: np.array shape (n_ch, n_samples) with dtype float (may contain NaN)
-      channel_names: list of length n_ch
-      sampling_rate: int Hz
-      n_samples: int
-    Only uses trial 0 lines.
+    data: (..., n_ch, n_samp) may contain NaN; returns freqs, psds (..., n_ch, n_freqs)
+    NaN gaps are linearly interpolated by fill_gaps (entire channel NaN -> zeros); pass
+    filled from an earlier fill_gaps call if data is already filled.
     """
-    with open(path, 'r', errors='ignore') as f:
-        lines = [ln.rstrip("\n") for ln in f]
-
-    n_trials = None; n_chans = None; n_samples = None; samp_ms = None
-    chan_order = {}  # idx -> name
-    data_lines = []
-
-    for ln in lines:
-        if not ln:
-            continue
-        if ln.startswith("#"):
-            txt = ln[1:].strip()
-            # detect trial/chans/samples line
-            if "trials" in txt and "chans" in txt and "samples" in txt:
-                # extract integers
-                ints = [int(tok) for tok in txt.replace(",", " ").split() if tok.isdigit()]
-                if len(ints) >= 3:
-                    n_trials, n_chans, n_samples = ints[0], ints[1], ints[2]
-            # detect sampling ms e.g. "3.906000 msecs uV"
-            if "msec" in txt.lower() or "msecs" in txt.lower():
-                toks = txt.split()
-                for i, t in enumerate(toks):
-                    if "msec" in t.lower():
-                        try:
-                            samp_ms = float(toks[i-1])
-                        except:
-                            pass
-                if samp_ms is None:
-                    # fallback: first float in the header line
-                    for t in toks:
-                        try:
-                            samp_ms = float(t)
-                            break
-                        except:
-                            continue
-            # detect channel mapping lines like "# FP1 chan 0"
-            if "chan" in txt:
-                toks = txt.split()
-                try:
-                    idx = toks.index("chan")
-                    chan_name = " ".join(toks[:idx])
-                    chan_idx = int(toks[idx+1])
-                    chan_order[chan_idx] = chan_name
-                except Exception:
-                    pass
-        else:
-            data_lines.append(ln.strip())
-
-    if n_chans is None:
-        n_chans = DEFAULT_N_CHANS
-    if n_samples is None:
-        n_samples = DEFAULT_N_SAMPLES
-    if samp_ms is None:
-        samp_ms = DEFAULT_SAMPLING_MS
+    # one detrend + welch over every subject and channel at once
+    return (engine or PSDEngine(fs, nperseg=nperseg)).psd(data, filled=filled)
 
-    sr = int(round(1000.0 / samp_ms))
+def bandpower_from_psd(freqs, psds, engine, band="alpha"):
+    # trapezoid integral of one of the engine's bands for every row of psds (..., n_freqs), from its cached weights
+    return engine.band_powers(freqs, psds)[..., list(engine.bands).index(band)]
 
-    # build channel list
-    if chan_order:
-        max_idx = max(chan_order.keys())
-        # ensure length covers claimed n_chans
-        length = max(max_idx + 1, n_chans)
-        channel_names = [chan_order.get(i, f"Ch{i+1}") for i in range(length)]
-        if len(channel_names) > n_chans:
-            channel_names = channel_names[:n_chans]
-        else:
-            while len(channel_names) < n_chans:
-                channel_names.append(f"Ch{len(channel_names)+1}")
-    else:
-        # derive from data order
-        seen = []
-        for ln in data_lines:
-            parts = ln.split()
-            if len(parts) >= 4:
-                ch = parts[1]
-                if ch not in seen:
-                    seen.append(ch)
-            if len(seen) >= n_chans:
-                break
-        if len(seen) < n_chans:
-            seen += [f"Ch{i+1}" for i in range(len(seen), n_chans)]
-        channel_names = seen[:n_chans]
-
-    # allocate with NaN default
-    data = np.full((len(channel_names), n_samples), np.nan, dtype=float)
+def channel_percentiles(x, q):
+    """
+    All percentiles q of x (n_rows, n_cols) over rows in one pass (NaN ignored): one sort for
+    QUANTILE_MODE "exact", a QuantileSketch of SKETCH_SIZE items per column for "sketch"
+    (exact below SKETCH_SIZE rows, bounded memory and rank error above)
+    """
+    if QUANTILE_MODE == "sketch":
+        return sketch_percentiles(x, q, axis=0, sketch_size=SKETCH_SIZE)[0]
+    return np.nanpercentile(x, q, axis=0)
 
-    # fill only trial 0
-    for ln in data_lines:
-        parts = ln.split()
-        if len(parts) < 4:
-            continue
-        try:
-            trial_idx = int(parts[0])
-            ch_name = parts[1]
-            samp_idx = int(parts[2])
-            val = float(parts[3])
-        except:
-            continue
-        if trial_idx != 0:
-            continue
-        # channel index by name if possible
-        try:
-            ch_idx = channel_names.index(ch_name)
-        except ValueError:
-            # channel name not in canonical list: skip (we avoid inventing indices)
-            continue
-        if 0 <= ch_idx < data.shape[0] and 0 <= samp_idx < data.shape[1]:
-            data[ch_idx, samp_idx] = val
+# ---------- Cohort helpers ----------
+def feature_cache():
+    return default_feature_cache() if FEATURE_CACHE else FeatureCache(cache_dir=None, max_items=0)
 
-    return data, channel_names, sr, n_samples
+def cohort_cap_samples(subject_data_list, sr):
+    # cap samples at sr * MAX_DISPLAY_SECONDS or available min across subjects
+    cap_by_time = int(round(sr * MAX_DISPLAY_SECONDS))
+    # choose final cap = min(cap_by_time, min available max across subjects)
+    min_samples_available = min(d.shape[1] for d in subject_data_list)
+    return min(cap_by_time, min_samples_available)
 
-# ---------- PSD / band helpers ----------
-def compute_psd_all_channels(data, fs, nperseg=256):
+def align_subject(d, n_ch, cap_samples):
     """
-    data: (n_ch, n_samp) may contain NaN; returns freqs, psds (n_ch, n_freqs)
-    Uses simple NaN handling via interpolation; if entire channel NaN -> zeros.
+    d: (n_ch_d, n_samp_d) -> (n_ch, cap_samples), NaN where d has no data
+    If channel counts differ, assume ordering aligns by channel_names and caller should have
+    provided aligned data; extra channels are dropped, missing ones padded with NaN.
     """
-    n_ch, n_samp = data.shape
-    psd_list = []
-    freqs = None
-    for ch in data:
-        # handle NaN: interpolate across valid points; if not possible, fill zeros
-        if np.all(np.isnan(ch)):
-            ch_clean = np.zeros_like(ch)
-        else:
-            idx = np.where(~np.isnan(ch))[0]
-            if idx.size == 0:
-                ch_clean = np.zeros_like(ch)
-            else:
-                # linear interpolate missing points
-                valid_x = idx
-                valid_y = ch[idx]
-                full_x = np.arange(len(ch))
-                ch_clean = np.interp(full_x, valid_x, valid_y)
-        # detrend and compute PSD
-        f, p = welch(detrend(ch_clean), fs=fs, nperseg=min(nperseg, max(16, len(ch_clean))))
-        psd_list.append(p)
-        freqs = f
-    return freqs, np.array(psd_list)
+    nch_d, nsamp_d = d.shape
+    D = np.full((n_ch, cap_samples), np.nan, dtype=float)
+    D[:min(nch_d, n_ch), :min(nsamp_d, cap_samples)] = d[:n_ch, :cap_samples]
+    return D
 
-def bandpower_from_psd(freqs, psds, band):
-    low, high = band
-    idx = np.logical_and(freqs >= low, freqs <= high)
-    return np.trapz(psds[:, idx], freqs[idx], axis=1)
-
-# ---------- Figure builder ----------
-def build_main_figure(subject_data_list, channel_names, sr, title="EEG Grand Summary (0-1s)"):
+# ---------- Grand average ----------
+def grand_average(subject_data_list, n_ch, sr):
     """
     subject_data_list: list of arrays (n_ch, n_samp) with NaN for missing
+    -> grand average across subjects (nanmean), (n_ch, cap_samples); cached on the subjects' data
     """
-    # convert list -> stack; align shapes by padding with NaN if needed
-    n_subj = len(subject_data_list)
-    n_ch = len(channel_names)
-    max_samples = max(d.shape[1] for d in subject_data_list)
-    # cap samples at sr * MAX_DISPLAY_SECONDS or available min across subjects
-    cap_by_time = int(round(sr * MAX_DISPLAY_SECONDS))
-    # choose final cap = min(cap_by_time, min available max across subjects)
-    min_samples_available = min(d.shape[1] for d in subject_data_list)
-    cap_samples = min(cap_by_time, min_samples_available)
+    features = feature_cache()
+    cap_samples = cohort_cap_samples(subject_data_list, sr)
 
-    # build aligned array (n_subj, n_ch, cap_samples)
-    S = np.full((n_subj, n_ch, cap_samples), np.nan, dtype=float)
-    for si, d in enumerate(subject_data_list):
-        # d may have shape (n_ch_d, n_samp_d). If channel counts differ, assume ordering aligns by channel_names,
-        # and caller should have provided aligned data. We'll handle shapes robustly:
-        nch_d, nsamp_d = d.shape
-        # if nch_d != n_ch, attempt to pad/truncate channels
-        if nch_d < n_ch:
-            D = np.full((n_ch, nsamp_d), np.nan)
-            D[:nch_d, :] = d
-        else:
-            D = d[:n_ch, :]
+    def average():
+        # aligned array (n_subj, n_ch, cap_samples), then the grand average across subjects
+        S = np.stack([align_subject(d, n_ch, cap_samples) for d in subject_data_list])
+        return {"grand": np.nanmean(S, axis=0)}
 
-        # trim/pad samples to cap_samples
-        if nsamp_d >= cap_samples:
-            S[si, :, :] = D[:, :cap_samples]
-        else:
-            S[si, :, :nsamp_d] = D[:, :nsamp_d]
-            # remaining remain NaN
+    _, grand = features.compute("grand_average", {"n_ch": n_ch, "cap_samples": cap_samples}, subject_data_list, average)
+    return grand["grand"]
 
-    # compute grand average across subjects (nanmean)
-    grand = np.nanmean(S, axis=0)  # (n_ch, cap_samples)
+# ---------- Figure builder ----------
+def build_main_figure(grand, channel_names, sr, title="EEG Grand Summary (0-1s)"):
+    """
+    grand: grand average (n_ch, cap_samples), from grand_average or GroupStatsStore
+    """
+    features = feature_cache()
+    cap_samples = grand.shape[1]
 
     # z-score per channel for heatmap using nan-aware ops
     ch_mean = np.nanmean(grand, axis=1, keepdims=True)
     ch_std = np.nanstd(grand, axis=1, keepdims=True)
     gm = (grand - ch_mean) / (ch_std + 1e-9)
 
-    # median ERP across channels (nanmedian)
-    median_erp = np.nanmedian(grand, axis=0)
-    p10 = np.nanpercentile(grand, 10, axis=0)
-    p90 = np.nanpercentile(grand, 90, axis=0)
+    # median ERP and 10-90 percentile band across channels
+    median_erp, p10, p90 = channel_percentiles(grand, (50, 10, 90))
 
-    # PSD on per-channel grand (interpolates internally)
-    freqs, psds = compute_psd_all_channels(grand, sr)
-    psd_med = np.nanmedian(psds, axis=0)
-    psd_p10 = np.nanpercentile(psds, 10, axis=0)
-    psd_p90 = np.nanpercentile(psds, 90, axis=0)
+    # PSD on per-channel grand (interpolates internally); PSDs and band power are cached on the grand average
+    engine = PSDEngine(sr, nperseg=PSD_NPERSEG, bands={"alpha": ALPHA_BAND})
+    psd_key, psd = features.compute("grand_psd", {"fs": sr, "nperseg": PSD_NPERSEG}, [grand],
+                                    lambda: dict(zip(("freqs", "psd"), compute_psd_all_channels(grand, sr, engine=engine))))
+    freqs, psds = psd["freqs"], psd["psd"]
+    psd_med, psd_p10, psd_p90 = channel_percentiles(psds, (50, 10, 90))
 
     # alpha bandpower per channel
-    alpha_bp = bandpower_from_psd(freqs, psds, (8, 12))
+    _, alpha_bp = features.compute("bandpower", {"band": ALPHA_BAND}, [psd_key],
+                                   lambda: {"power": bandpower_from_psd(freqs, psds, engine)})
+    alpha_bp = alpha_bp["power"]
     sort_idx = np.argsort(alpha_bp)[::-1]
 
     times = np.arange(cap_samples) / float(sr)
@@ -287,39 +181,58 @@ def build_main_figure(subject_data_list, channel_names, sr, title="EEG Grand Sum
     return fig
 
 # ---------- MAIN ----------
+def iter_cohort(paths, cohort):
+    """
+    Stream subjects one file at a time as (subject_id, features) pairs for GroupStatsStore.sync
+    (files are parsed in a process pool when LOAD_WORKERS > 1). Each subject is aligned on the fly:
+    channels by name to the first subject's (missing -> NaN, extra channels ignored), samples
+    padded/trimmed to MAX_DISPLAY_SECONDS (NaN past its end). cohort (a dict) receives the channel
+    names, sampling rate and per-sample subject count.
+    """
+    for p, rec, err in iter_recordings(paths, workers=LOAD_WORKERS, cache=default_cache()):
+        if rec is None:
+            print(f"Skipping {p}: {err}")
+            continue
+        d, ch_names, sr, n_samp = to_rd000(rec, DEFAULT_N_CHANS, DEFAULT_N_SAMPLES, DEFAULT_SAMPLING_MS)
+        if "channels" not in cohort:
+            cohort["channels"], cohort["sr"] = ch_names, sr  # assume same sampling rate across files
+        width = int(round(cohort["sr"] * MAX_DISPLAY_SECONDS))
+        aligned = align_subject(align_channels(d, ch_names, cohort["channels"]), len(cohort["channels"]), width)
+        n_present = min(d.shape[1], width)
+        # number of subjects that have each display sample
+        cohort["count"] = cohort.get("count", 0) + (np.arange(width) < n_present)
+        subject_id = FeatureCache.key_for("cohort_subject", {"width": width, "n_samples": n_present}, [aligned])
+        yield subject_id, {"erp": aligned}
+
 def main():
     files_found = [p for p in DEMO_FILES if os.path.exists(p)]
     if not files_found:
         print("No demo files found. Place the files or update DEMO_FILES paths.")
         return
 
-    subj_data = []
-    canonical_chan_names = None
-    sampling_rate = None
-    sample_counts = []
+    # stream subjects into the incremental store, which keeps only running NaN-aware counts and sums
+    # per channel x sample, so memory does not grow with the cohort; with FEATURE_CACHE only subjects
+    # new since the last run are folded in
+    features = feature_cache()
+    stats = GroupStatsStore(features, percentiles=())  # the grand average needs no quantile sketches
+    stats.load("main_view")
+    cohort = {}
+    stats.sync("cohort", iter_cohort(files_found, cohort))
+    if not cohort:
+        print("None of the demo files could be parsed.")
+        return
+    stats.save("main_view")
 
-    # parse files
-    for p in files_found:
-        d, ch_names, sr, n_samp = parse_rd000(p)
-        sample_counts.append(n_samp)
-        if canonical_chan_names is None:
-            canonical_chan_names = ch_names
-        # align channels by name: create array with canonical channel count and NaN default
-        n_canon = len(canonical_chan_names)
-        aligned = np.full((n_canon, d.shape[1]), np.nan, dtype=float)
-        # try mapping names
-        for i, cname in enumerate(canonical_chan_names):
-            if cname in ch_names:
-                idx = ch_names.index(cname)
-                aligned[i, :d.shape[1]] = d[idx, :]
-            else:
-                # if file contains extra channels not in canonical, ignore them
-                aligned[i, :d.shape[1]] = np.nan
-        subj_data.append(aligned)
-        sampling_rate = sr  # assume same across files
+    # cap at the first sample some subject lacks (cohort_cap_samples for in-memory lists),
+    # or keep every sample if all subjects have them all
+    count = cohort["count"]
+    n_subj = len(stats.subjects("cohort"))
+    short = np.flatnonzero(count < n_subj)
+    cap_samples = short[0] if short.size else len(count)
+    grand = stats.summary("cohort", "erp")["mean"][:, :cap_samples]
 
     # build and show figure
-    fig = build_main_figure(subj_data, canonical_chan_names, sampling_rate, title="EEG Grand Summary (0-1s)")
+    fig = build_main_figure(grand, cohort["channels"], cohort["sr"], title="EEG Grand Summary (0-1s)")
     fig.show()
 
 if __name__ == "__main__":
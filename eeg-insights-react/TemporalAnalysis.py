@@ -1,13 +1,25 @@
 # eeg_temporal_comparison.py
-import os, math
+import os, sys, re, math
+from functools import lru_cache
 import numpy as np
-from scipy.signal import welch, detrend, butter, filtfilt, hilbert
-from scipy.stats import ttest_ind, t
+from scipy.signal import butter, sosfiltfilt, hilbert
+from scipy.stats import t, beta
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 warnings.filterwarnings("ignore")
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm-backend"))
+from rd_parser import to_rd000, align_channels
+from rd_cache import default_cache
+from rd_loader import iter_recordings
+from eeg_dsp import PSDEngine, fill_gaps, gap_weighted_mean
+from feature_cache import FeatureCache, default_feature_cache
+from group_stats import GroupStatsStore
+
 # ---------- CONFIG ----------
 CONTROL_FILES = [
     "llm-backend/ControlDataset/co2c0000337.rd.000","llm-backend/ControlDataset/co2c0000338.rd.000","llm-backend/ControlDataset/co2c0000339.rd.000",
@@ -22,214 +34,326 @@ ALC_FILES = [
     "llm-backend/AlcoholicDataset/co2a0000378.rd.000"
 ]
 MAX_T_SEC = 1.0
-PERMUTATIONS = 1
+PERMUTATIONS = 1  # permutations per cluster test; use >= 1000 for usable cluster p-values (each run takes ~1000x longer)
 CLUSTER_P_THRESHOLD = 0.05  # per-timepoint threshold to form clusters (two-sided)
-
-# ---------- Parser (trial 0, same format you provided) ----------
-def parse_rd000(path, default_ch=64, default_samples=416, default_ms=3.906):
-    lines = open(path, 'r', errors='ignore').read().splitlines()
-    n_ch = None; n_samp = None; samp_ms = None
-    chan_order = {}
-    data_lines = []
-    for ln in lines:
-        if not ln: continue
-        if ln.startswith("#"):
-            txt = ln[1:].strip()
-            if "trials" in txt and "chans" in txt and "samples" in txt:
-                ints = [int(t) for t in txt.replace(","," ").split() if t.isdigit()]
-                if len(ints) >= 3:
-                    _, n_ch, n_samp = ints[:3]
-            if "msec" in txt.lower() or "msecs" in txt.lower():
-                toks = txt.split()
-                for i,t in enumerate(toks):
-                    if "msec" in t.lower():
-                        try:
-                            samp_ms = float(toks[i-1]); break
-                        except: pass
-            if "chan" in txt:
-                toks = txt.split()
-                try:
-                    idx = toks.index("chan")
-                    chan_order[int(toks[idx+1])] = " ".join(toks[:idx])
-                except: pass
-        else:
-            data_lines.append(ln.strip())
-
-    if n_ch is None: n_ch = default_ch
-    if n_samp is None: n_samp = default_samples
-    if samp_ms is None: samp_ms = default_ms
-    sr = int(round(1000.0 / samp_ms))
-
-    # channel naming
-    if chan_order:
-        length = max(max(chan_order.keys())+1, n_ch)
-        channel_names = [chan_order.get(i, f"Ch{i+1}") for i in range(length)]
-        channel_names = channel_names[:n_ch]
-    else:
-        # gather first occurring channel tokens
-        seen=[]
-        for ln in data_lines:
-            p=ln.split()
-            if len(p)>=4:
-                ch=p[1]; 
-                if ch not in seen: seen.append(ch)
-            if len(seen)>=n_ch: break
-        while len(seen)<n_ch: seen.append(f"Ch{len(seen)+1}")
-        channel_names = seen[:n_ch]
-
-    data = np.full((len(channel_names), n_samp), np.nan, dtype=float)
-    for ln in data_lines:
-        p = ln.split()
-        if len(p) < 4: continue
-        try:
-            trial = int(p[0]); ch_name = p[1]; idx = int(p[2]); val = float(p[3])
-        except: continue
-        if trial != 0: continue
-        if ch_name in channel_names:
-            ch_idx = channel_names.index(ch_name)
-            if 0 <= idx < n_samp: data[ch_idx, idx] = val
-    return data, channel_names, sr, n_samp
+CLUSTER_MODE = "channel"  # "channel": per-channel time clusters; "spatiotemporal": clusters over adjacent channels x time
+LOAD_WORKERS = 1  # >1 parses files in a process pool (parsed recordings are cached in llm-backend/.rd_cache)
+PERM_WORKERS = 1  # >1 runs permutation chunks in a process pool; results do not depend on it
+PERM_SEED = 1
+ADAPTIVE_PERMUTATIONS = True  # stop early once every cluster p-value is clearly above/below CLUSTER_P_THRESHOLD
+PSD_NPERSEG = 256
+FEATURE_CACHE = True  # reuse ERPs/envelopes/PSDs and group aggregates from llm-backend/.feature_cache when data and parameters are unchanged
 
 # ---------- signal helpers ----------
+@lru_cache(maxsize=None)
+def band_sos(fs, low, high, order=4):
+    """Butterworth band-pass in second-order sections, designed once per (fs, band, order)"""
+    return butter(order, [low/(fs/2), high/(fs/2)], btype='band', output='sos')
+
+def band_envelopes(data, fs, bands, order=4, filled=None):
+    """Analytic amplitude of data (..., n_ch, n_t) in every band of bands ({name: (low, high)}).
+       Pass data already through fill_gaps together with its filled mask to skip the gap filling.
+       Every band is filtered with sosfiltfilt along the last axis and the stacked result goes
+       through a single Hilbert transform.
+       Returns (n_bands, ..., n_ch, n_t), bands in dict order; all-NaN channels stay NaN."""
+    if filled is None:
+        data, filled = fill_gaps(data)
+    dead = filled.all(axis=-1)
+    filt = np.stack([sosfiltfilt(band_sos(fs, lo, hi, order), data, axis=-1) for lo, hi in bands.values()])
+    out = np.abs(hilbert(filt, axis=-1))
+    out[:, dead] = np.nan
+    return out
+
 def band_envelope(data, fs, low, high, order=4):
     # data: (n_ch, n_samples) -> returns same shape of analytic amplitude
-    b,a = butter(order, [low/(fs/2), high/(fs/2)], btype='band')
-    n_ch, n_samp = data.shape
-    out = np.zeros_like(data)
-    for i in range(n_ch):
-        ch = data[i,:]
-        if np.all(np.isnan(ch)):
-            out[i,:] = np.nan
-            continue
-        chc = np.copy(ch)
-        # interpolate NaN
-        nans = np.isnan(chc)
-        if nans.any():
-            idx = np.where(~nans)[0]
-            if idx.size==0:
-                chc = np.zeros_like(chc)
-            else:
-                chc = np.interp(np.arange(n_samp), idx, chc[idx])
-        filt = filtfilt(b,a,chc)
-        env = np.abs(hilbert(filt))
-        out[i,:] = env
-    return out
+    return band_envelopes(data, fs, {"band": (low, high)}, order)[0]
 
-def compute_psd_per_subject(data, fs, nperseg=256):
-    # data: (n_ch, n_samp) -> return freqs, median_psd_across_channels
-    n_ch = data.shape[0]
-    psds=[]
-    for i in range(n_ch):
-        ch = data[i,:]
-        if np.all(np.isnan(ch)):
-            chc = np.zeros_like(ch)
-        else:
-            idx = np.where(~np.isnan(ch))[0]
-            if idx.size==0: chc = np.zeros_like(ch)
-            else: chc = np.interp(np.arange(len(ch)), idx, ch[idx])
-        f,p = welch(detrend(chc), fs=fs, nperseg=min(nperseg, len(chc)))
-        psds.append(p)
-    psds = np.array(psds)
-    return f, np.median(psds, axis=0)
+def compute_psd_per_subject(data, fs, nperseg=256, filled=None, engine=None):
+    # data: (..., n_ch, n_samp) -> return freqs, per-channel psds (..., n_ch, n_freqs)
+    # all-NaN channels come back NaN (nanmedian over axis -2 leaves them out);
+    # pass filled (from fill_gaps) if data is already filled
+    if filled is None:
+        data, filled = fill_gaps(data)
+    f, psds = (engine or PSDEngine(fs, nperseg=nperseg)).psd(data, filled=filled)
+    psds[filled.all(axis=-1)] = np.nan
+    return f, psds
 
 # ---------- cluster permutation across time (per channel) ----------
-def cluster_permutation_time(group1, group2, sr, n_perm=1000, p_thresh=0.05, rng=None):
+def _welch_t(n1, s1, q1, n2, s2, q2):
+    """Welch t from per-group counts, sums and sums of squares; 0 where a group has < 2 values
+       (matches ttest_ind(equal_var=False) on the NaN-dropped samples)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = s1 / n1; m2 = s2 / n2
+        v1 = np.maximum(q1 - s1 * m1, 0) / (n1 - 1)
+        v2 = np.maximum(q2 - s2 * m2, 0) / (n2 - 1)
+        tv = (m1 - m2) / np.sqrt(v1 / n1 + v2 / n2)
+    tv[(n1 < 2) | (n2 < 2) | np.isnan(tv)] = 0
+    return tv
+
+def _cluster_runs(mask, weights):
+    """Contiguous True runs along the last axis of mask, rows taken in C order.
+       Returns (row, start, end_exclusive, sum of weights over the run) arrays, one entry per run."""
+    n_t = mask.shape[-1]
+    rows_shape = mask.shape[:-1] + (n_t + 1,)  # trailing False column keeps runs inside their row
+    m = np.zeros(rows_shape, dtype=bool); m[..., :n_t] = mask
+    w = np.zeros(rows_shape); w[..., :n_t] = np.where(mask, weights, 0)
+    edges = np.diff(np.concatenate(([0], m.ravel().astype(np.int8))))
+    starts = np.flatnonzero(edges == 1); ends = np.flatnonzero(edges == -1)
+    # each run summed on its own, so equal runs get equal masses wherever they sit in mask
+    lengths = ends - starts
+    run_w = w.ravel()[m.ravel()]
+    mass = np.add.reduceat(run_w, np.cumsum(lengths) - lengths) if starts.size else np.zeros(0)
+    rows, start = np.divmod(starts, n_t + 1)
+    return rows, start, ends - rows * (n_t + 1), mass
+
+# Null masses within this relative distance of an observed mass count as ties: a permutation that
+# reproduces the observed split (or its mirror) only matches the observed t-values up to rounding
+MASS_RTOL = 1e-9
+
+def _at_least(null, masses):
+    """null >= masses, up to MASS_RTOL"""
+    return null >= masses * (1 - MASS_RTOL)
+
+def _sufficient_stats(group1, group2):
+    """NaN-zeroed data, validity (0/1) and squares, (n_ch, n_sub, n_t), centred per (ch, t) for
+       numerical stability; plus the 0/1 group labels of the subjects"""
+    allsub = np.concatenate([group1, group2], axis=0).astype(float)  # (n1+n2, n_ch, n_t)
+    labels = np.array([0]*group1.shape[0] + [1]*group2.shape[0])
+    valid = ~np.isnan(allsub)
+    centre = np.nanmean(allsub, axis=0) if valid.any() else 0
+    X0 = np.where(valid, allsub - centre, 0).transpose(1, 0, 2)
+    V = valid.astype(float).transpose(1, 0, 2)
+    return X0, V, X0 ** 2, labels
+
+def _group_tstats(X0, V, Q, in_g1):
+    """t-values for many labelings at once.
+       X0/V/Q: (n_ch, n_sub, n_t) NaN-zeroed data, validity (0/1) and squares;
+       in_g1: (n_ch, n_lab, n_sub) 0/1 group-1 membership per channel -> (n_lab, n_ch, n_t)"""
+    n1 = np.matmul(in_g1, V); s1 = np.matmul(in_g1, X0); q1 = np.matmul(in_g1, Q)
+    n2 = V.sum(axis=1, keepdims=True) - n1
+    s2 = X0.sum(axis=1, keepdims=True) - s1
+    q2 = Q.sum(axis=1, keepdims=True) - q1
+    return _welch_t(n1, s1, q1, n2, s2, q2).transpose(1, 0, 2)
+
+def _channel_null(X0, V, Q, in_g1, tcrit):
+    """Max cluster mass per channel and labeling; in_g1: (n_ch, n_lab, n_sub) -> (n_ch, n_lab)"""
+    tperm = np.abs(_group_tstats(X0, V, Q, in_g1))  # (n_lab, n_ch, n_t)
+    rows, _, _, mass = _cluster_runs(tperm > tcrit, tperm)
+    blk = np.zeros(tperm.shape[0] * tperm.shape[1])
+    np.maximum.at(blk, rows, mass)
+    return blk.reshape(tperm.shape[0], tperm.shape[1]).T
+
+def cluster_permutation_time(group1, group2, sr, n_perm=1000, p_thresh=0.05, rng=None, block_size=128,
+                             seed=None, workers=None, adaptive=False):
     """For each channel: perform t-test at each timepoint, form clusters of consecutive timepoints 
        where |t| > threshold, compute cluster mass (sum |t|). Permute labels across subjects to build null of max cluster mass.
        Returns dict: {ch_idx: list of (start_idx,end_idx,cluster_mass,pval)}
     group1: (n1, n_ch, n_t)
     group2: (n2, n_ch, n_t)
+    Welch t-values come from NaN-aware sums for a whole (block_size, n_ch, n_t) block of
+    permutations at a time; permutations are drawn from rng in the same order as a per-channel loop.
+    With seed set, permutations instead come from schedule_permutations (shared by all channels,
+    reproducible for any number of workers, optionally stopped early) and rng is ignored.
     """
     if rng is None: rng = np.random.RandomState(0)
     n1 = group1.shape[0]; n2 = group2.shape[0]
     n_ch = group1.shape[1]; n_t = group1.shape[2]
-    allsub = np.concatenate([group1, group2], axis=0)  # (n1+n2, n_ch, n_t)
-    labels = np.array([0]*n1 + [1]*n2)
+    X0, V, Q, labels = _sufficient_stats(group1, group2)
     df = n1 + n2 - 2
     tcrit = t.ppf(1 - p_thresh/2, df)  # two-sided
     results = {ch: [] for ch in range(n_ch)}
-    # observed t-stats
-    for ch in range(n_ch):
-        g1 = group1[:, ch, :]
-        g2 = group2[:, ch, :]
-        tvals = np.zeros(n_t)
-        pvals = np.ones(n_t)
-        for tt in range(n_t):
-            a = g1[:, tt]; b = g2[:, tt]
-            # remove NaNs
-            a = a[~np.isnan(a)]; b = b[~np.isnan(b)]
-            if a.size < 2 or b.size < 2:
-                tvals[tt] = 0; pvals[tt] = 1; continue
-            tv, pv = ttest_ind(a, b, equal_var=False)
-            tvals[tt] = tv if not np.isnan(tv) else 0
-            pvals[tt] = pv if not np.isnan(pv) else 1
-        # clusters: contiguous runs where |t|>tcrit
-        mask = np.abs(tvals) > tcrit
-        clusters = []
-        idx = 0
-        while idx < n_t:
-            if mask[idx]:
-                start = idx
-                while idx < n_t and mask[idx]:
-                    idx += 1
-                end = idx  # exclusive
-                clusters.append((start, end, np.sum(np.abs(tvals[start:end]))))
-            else:
-                idx += 1
-        if not clusters:
-            continue
-        # build null distribution of max cluster mass via permutations
-        max_masses = np.zeros(n_perm)
-        for pi in range(n_perm):
-            perm = rng.permutation(labels)
-            p1 = allsub[perm==0, ch, :]
-            p2 = allsub[perm==1, ch, :]
-            # compute tvals for permuted split
-            tperm = np.zeros(n_t)
-            for tt in range(n_t):
-                a = p1[:, tt]; b = p2[:, tt]
-                a = a[~np.isnan(a)]; b = b[~np.isnan(b)]
-                if a.size < 2 or b.size < 2:
-                    tperm[tt]=0; continue
-                tv, _ = ttest_ind(a,b, equal_var=False)
-                tperm[tt] = tv if not np.isnan(tv) else 0
-            maskp = np.abs(tperm) > tcrit
-            # find clusters and record max cluster mass
-            mx = 0
-            j=0
-            while j < n_t:
-                if maskp[j]:
-                    s=j
-                    while j<n_t and maskp[j]: j+=1
-                    e=j
-                    mass = np.sum(np.abs(tperm[s:e]))
-                    if mass>mx: mx=mass
-                else:
-                    j+=1
-            max_masses[pi]=mx
-        # for each observed cluster compute p-value
-        for (s,e,mass) in clusters:
-            pval = (np.sum(max_masses >= mass) + 1) / (n_perm + 1)
-            results[ch].append((s,e,mass,pval))
+
+    # observed t-stats and clusters: contiguous runs where |t|>tcrit
+    obs_in_g1 = np.broadcast_to((labels == 0).astype(float), (n_ch, 1, n1 + n2))
+    tvals = _group_tstats(X0, V, Q, obs_in_g1)[0]  # (n_ch, n_t)
+    ch_of, starts, ends, masses = _cluster_runs(np.abs(tvals) > tcrit, np.abs(tvals))
+    sig_ch = np.unique(ch_of)
+    if sig_ch.size == 0:
+        return results
+    row_of = np.searchsorted(sig_ch, ch_of)  # null row of each observed cluster
+    X0, V, Q = X0[sig_ch], V[sig_ch], Q[sig_ch]
+
+    if seed is not None:
+        state = {"kind": "channel", "X0": X0, "V": V, "Q": Q, "labels": labels, "tcrit": tcrit}
+        pvals, _ = schedule_permutations(state, row_of, masses, n_perm, seed=seed, workers=workers, adaptive=adaptive)
+    else:
+        # null distribution of max cluster mass, per channel with observed clusters
+        perms = np.stack([np.stack([rng.permutation(labels) for _ in range(n_perm)]) for _ in sig_ch])
+        max_masses = np.zeros((sig_ch.size, n_perm))
+        for b0 in range(0, n_perm, block_size):
+            in_g1 = (perms[:, b0:b0 + block_size] == 0).astype(float)  # (n_sig, n_blk, n_sub)
+            max_masses[:, b0:b0 + in_g1.shape[1]] = _channel_null(X0, V, Q, in_g1, tcrit)
+        pvals = (_at_least(max_masses[row_of], masses[:, None]).sum(axis=1) + 1) / (n_perm + 1)
+
+    for ch, s, e, mass, pval in zip(ch_of, starts, ends, masses, pvals):
+        results[int(ch)].append((int(s), int(e), mass, pval))
     return results
 
+# ---------- spatio-temporal clusters (channel adjacency x time) ----------
+_ROW_OF_PREFIX = {"FP": 0, "AF": 1, "F": 2, "FC": 3, "FT": 3, "C": 4, "T": 4, "CP": 5, "TP": 5, "P": 6, "PO": 7, "O": 8}
+
+def _scalp_position(name):
+    """Approximate 2D scalp position of a 10-20/10-10 label (azimuthal projection around Cz, degrees).
+       Midline electrodes sit 22.5 deg apart; each row fans out to its edge electrode on the Fpz-T7-Oz
+       circumference. Returns None for non-scalp channels (X, Y, nd, ...)."""
+    m = re.fullmatch(r"([A-Z]+?)(Z|\d+)", name.upper())
+    if not m or m.group(1) not in _ROW_OF_PREFIX: return None
+    row = _ROW_OF_PREFIX[m.group(1)]
+    num = m.group(2)
+    k = 0 if num == "Z" else ((int(num)+1)//2) * (-1 if int(num) % 2 else 1)  # odd = left
+    k_max = 1 if row in (0, 8) else 4
+    mid = np.array([0.0, (4-row)*22.5])
+    a = np.radians(18*(row+1))
+    edge = np.array([np.sign(k)*90*np.sin(a), 90*np.cos(a)])
+    return mid + abs(k)/k_max*(edge-mid)
+
+def channel_adjacency(channel_names, max_dist=33.0):
+    """(n_ch, n_ch) bool neighbour matrix from the channel labels' scalp positions (about 4-8 neighbours
+       per electrode); channels without a 10-20 position have no neighbours"""
+    pos = [_scalp_position(c) for c in channel_names]
+    n_ch = len(channel_names)
+    adj = np.zeros((n_ch, n_ch), dtype=bool)
+    known = [i for i,p in enumerate(pos) if p is not None]
+    if known:
+        P = np.array([pos[i] for i in known])
+        D = np.linalg.norm(P[:, None, :] - P[None, :, :], axis=-1)
+        adj[np.ix_(known, known)] = (D < max_dist) & (D > 0)
+    return adj
+
+def _spacetime_components(mask, weights, pairs):
+    """Connected components of the True points of mask (n_lab, n_ch, n_t): points connect to the next
+       timepoint on the same channel and to adjacent channels (pairs: (n_pairs, 2)) at the same time.
+       Returns (flat index of each point, component of each point, mass per component, labeling per component)"""
+    n_lab, n_ch, n_t = mask.shape
+    nodes = np.flatnonzero(mask)
+    if nodes.size == 0:
+        return nodes, np.zeros(0, int), np.zeros(0), np.zeros(0, int)
+    rank = np.cumsum(mask.ravel()) - 1
+    lab, ch, tt = np.nonzero(mask[..., :-1] & mask[..., 1:])
+    a_t = (lab*n_ch + ch)*n_t + tt
+    lab, k, tt = np.nonzero(mask[:, pairs[:, 0], :] & mask[:, pairs[:, 1], :])
+    a_s = (lab*n_ch + pairs[k, 0])*n_t + tt
+    b_s = (lab*n_ch + pairs[k, 1])*n_t + tt
+    rows = rank[np.concatenate([a_t, a_s])]; cols = rank[np.concatenate([a_t + 1, b_s])]
+    graph = coo_matrix((np.ones(rows.size), (rows, cols)), shape=(nodes.size, nodes.size))
+    n_comp, comp = connected_components(graph, directed=False)
+    mass = np.bincount(comp, weights=weights.ravel()[nodes], minlength=n_comp)
+    comp_lab = np.zeros(n_comp, dtype=int); comp_lab[comp] = nodes // (n_ch*n_t)
+    return nodes, comp, mass, comp_lab
+
+def _spacetime_null(X0, V, Q, labs, tcrit, pairs):
+    """Largest (channel, time) cluster mass for each labeling in labs (n_lab, n_sub) -> (n_lab,)"""
+    in_g1 = np.broadcast_to((labs == 0).astype(float), (X0.shape[0],) + labs.shape)
+    tperm = np.abs(_group_tstats(X0, V, Q, in_g1))  # (n_lab, n_ch, n_t)
+    _, _, mass, lab = _spacetime_components(tperm > tcrit, tperm, pairs)
+    blk = np.zeros(labs.shape[0]); np.maximum.at(blk, lab, mass)
+    return blk
+
+def cluster_permutation_spacetime(group1, group2, sr, adjacency, n_perm=1000, p_thresh=0.05, rng=None, block_size=128,
+                                  seed=None, workers=None, adaptive=False):
+    """Clusters over (channel, time): points with |t| > threshold join their neighbours in time and
+       adjacent channels (adjacency, e.g. channel_adjacency(chs)) at the same time. One permutation set is
+       shared by all channels and each permutation adds its single largest cluster mass to the null,
+       so p-values are family-wise over channels and time. seed/workers/adaptive: see schedule_permutations.
+       Returns list of (channel_indices, start_idx, end_idx, cluster_mass, pval), largest mass first.
+    group1: (n1, n_ch, n_t)
+    group2: (n2, n_ch, n_t)
+    """
+    if rng is None: rng = np.random.RandomState(0)
+    n_ch = group1.shape[1]; n_t = group1.shape[2]
+    X0, V, Q, labels = _sufficient_stats(group1, group2)
+    tcrit = t.ppf(1 - p_thresh/2, labels.size - 2)  # two-sided
+    pairs = np.argwhere(np.triu(adjacency, 1))
+
+    tvals = np.abs(_group_tstats(X0, V, Q, np.broadcast_to((labels == 0).astype(float), (n_ch, 1, labels.size))))
+    nodes, comp, masses, _ = _spacetime_components(tvals > tcrit, tvals, pairs)
+    if masses.size == 0:
+        return []
+
+    if seed is not None:
+        state = {"kind": "spacetime", "X0": X0, "V": V, "Q": Q, "labels": labels, "tcrit": tcrit, "pairs": pairs}
+        pvals, _ = schedule_permutations(state, np.zeros(masses.size, dtype=int), masses, n_perm,
+                                         seed=seed, workers=workers, adaptive=adaptive)
+    else:
+        max_masses = np.zeros(n_perm)
+        for b0 in range(0, n_perm, block_size):
+            labs = np.stack([rng.permutation(labels) for _ in range(min(block_size, n_perm - b0))])
+            max_masses[b0:b0 + labs.shape[0]] = _spacetime_null(X0, V, Q, labs, tcrit, pairs)
+        pvals = (_at_least(max_masses[None, :], masses[:, None]).sum(axis=1) + 1) / (n_perm + 1)
+
+    clusters = []
+    for k in np.argsort(masses)[::-1]:
+        member = nodes[comp == k]
+        tt = member % n_t
+        clusters.append((np.unique(member // n_t), int(tt.min()), int(tt.max()) + 1, masses[k], pvals[k]))
+    return clusters
+
+# ---------- permutation scheduler ----------
+_PERM_STATE = {}
+
+def _init_perm_worker(state):
+    _PERM_STATE.clear(); _PERM_STATE.update(state)
+
+def _null_chunk(job):
+    """Null max cluster masses (n_rows, n) for one chunk, drawn from the chunk's own SeedSequence"""
+    seed_seq, n = job
+    s = _PERM_STATE
+    labs = np.random.default_rng(seed_seq).permuted(np.tile(s["labels"], (n, 1)), axis=1)
+    if s["kind"] == "channel":
+        in_g1 = np.broadcast_to((labs == 0).astype(float), (s["X0"].shape[0],) + labs.shape)
+        return _channel_null(s["X0"], s["V"], s["Q"], in_g1, s["tcrit"])
+    return _spacetime_null(s["X0"], s["V"], s["Q"], labs, s["tcrit"], s["pairs"])[None, :]
+
+def _pvalues_resolved(exceed, n, alpha, confidence):
+    """True once every p-value's Clopper-Pearson interval lies entirely above or below alpha"""
+    a = 1 - confidence
+    lo = np.where(exceed > 0, beta.ppf(a/2, np.maximum(exceed, 1), n - exceed + 1), 0.0)
+    hi = np.where(exceed < n, beta.ppf(1 - a/2, exceed + 1, np.maximum(n - exceed, 1)), 1.0)
+    return bool(np.all((hi < alpha) | (lo > alpha)))
+
+def schedule_permutations(state, obs_rows, obs_masses, n_perm, seed=0, workers=None, chunk_size=100,
+                          adaptive=False, alpha=0.05, confidence=0.99):
+    """Permutation p-values for observed clusters (null row, mass), with the budget split into fixed chunks.
+       Chunk i draws its permutations from SeedSequence(seed).spawn(n_chunks)[i] and chunks are consumed in
+       order, so results are bit-identical for any workers count. workers > 1 runs chunks in a process pool.
+       adaptive: stop after the first chunk at which every p-value is clearly above or below alpha.
+       Returns (pvals, n_permutations_used)."""
+    n_chunks = max(1, math.ceil(n_perm / chunk_size))
+    seqs = np.random.SeedSequence(seed).spawn(n_chunks)
+    jobs = [(seqs[i], min(chunk_size, n_perm - i*chunk_size)) for i in range(n_chunks)]
+    obs_rows = np.asarray(obs_rows); obs_masses = np.asarray(obs_masses)
+    exceed = np.zeros(obs_masses.size); done = 0
+
+    if workers and workers > 1 and n_chunks > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_perm_worker, initargs=(state,))
+        results = pool.map(_null_chunk, jobs)
+    else:
+        pool = None
+        _init_perm_worker(state)
+        results = map(_null_chunk, jobs)
+    try:
+        for null in results:
+            exceed += _at_least(null[obs_rows], obs_masses[:, None]).sum(axis=1)
+            done += null.shape[1]
+            if adaptive and done < n_perm and _pvalues_resolved(exceed, done, alpha, confidence):
+                break
+    finally:
+        if pool is not None: pool.shutdown(cancel_futures=True)
+        _PERM_STATE.clear()
+    return (exceed + 1) / (done + 1), done
+
 # ---------- high-level pipeline ----------
-def load_group(file_list):
+def load_group(file_list, workers=LOAD_WORKERS):
     subs = []
     chan_names = None; sr = None; n_samp = None
-    for p in file_list:
-        if not os.path.exists(p):
-            print("MISSING", p); continue
-        d, chs, sampling_rate, n_samples = parse_rd000(p)
+    for p, rec, err in iter_recordings(file_list, workers=workers, cache=default_cache()):
+        if rec is None:
+            print("MISSING" if err == "missing" else f"FAILED ({err})", p); continue
+        d, chs, sampling_rate, n_samples = to_rd000(rec)
         if chan_names is None: chan_names = chs
         # align channels by name if necessary: here parsers already produce canonical ordering
-        if d.shape[0] != len(chan_names):
-            # simple pad/truncate
-            aligned = np.full((len(chan_names), d.shape[1]), np.nan)
-            for i,c in enumerate(chan_names):
-                if c in chs:
-                    aligned[i,:] = d[chs.index(c),:]
-            d = aligned
+        if chs != chan_names:
+            d = align_channels(d, chs, chan_names)
         subs.append(d)
         sr = sampling_rate; n_samp = n_samples
     if not subs: raise RuntimeError("No files found in provided list.")
@@ -239,6 +363,45 @@ def load_group(file_list):
     arr = np.stack(subs_clipped, axis=0)  # (nsub, n_ch, cap)
     return arr, chan_names, sr
 
+def group_features(data, sr, bands, cache, nperseg=PSD_NPERSEG, order=4):
+    """Per-subject channel-mean ERP, band envelopes, per-channel PSDs and alpha metrics of one group (nsub, n_ch, n_t).
+       Every feature goes through cache (feature_cache.FeatureCache) per subject, keyed by that subject's data
+       and the feature's own parameters: changing e.g. nperseg recomputes the PSDs and alpha metrics only,
+       and adding a subject to the group computes that subject only."""
+    gap_fill = lru_cache(maxsize=1)(lambda idx: fill_gaps(data[list(idx)]))  # shared by the features that miss
+
+    def erp(idx):
+        return {"subject": np.nanmean(data[idx], axis=1)}  # (nsub, n_t) per-subject channel-average
+
+    def envelopes(idx):
+        # gap-filled samples count less in the channel mean
+        data_f, gaps = gap_fill(tuple(idx))
+        env = gap_weighted_mean(band_envelopes(data_f, sr, bands, order, filled=gaps), gaps, axis=-2)
+        return {"env": np.moveaxis(env, 1, 0)}  # (nsub, n_bands, n_t)
+
+    engine = PSDEngine(sr, nperseg=nperseg, bands=bands)
+    def psds(idx):
+        data_f, gaps = gap_fill(tuple(idx))
+        freqs, psd = compute_psd_per_subject(data_f, sr, filled=gaps, engine=engine)  # (nsub, n_ch, n_freqs)
+        return {"freqs": np.broadcast_to(freqs, (len(idx), freqs.size)), "psd": psd, "median": np.nanmedian(psd, axis=-2)}
+
+    _, out_erp = cache.compute("grand_erp", {}, [data], erp, batch=True)
+    _, out_env = cache.compute("band_envelopes", {"fs": sr, "bands": bands, "order": order}, [data], envelopes, batch=True)
+    _, out_psd = cache.compute("psd", {"fs": sr, "nperseg": nperseg}, [data], psds, batch=True)
+    out_psd["freqs"] = out_psd["freqs"][0]
+
+    def alpha_metrics(idx):
+        # all band powers of the channel-median PSDs in one matmul; peak frequency inside the alpha band
+        freqs, psd = out_psd["freqs"], out_psd["median"][idx]
+        band = engine.band_mask(freqs, "alpha")
+        return {"power": engine.band_powers(freqs, psd)[..., list(bands).index("alpha")],
+                "peak_freq": freqs[band][np.argmax(psd[..., band], axis=-1)]}
+
+    _, out_alpha = cache.compute("alpha_metrics", {"alpha": bands["alpha"], "fs": sr, "nperseg": nperseg},
+                                 [out_psd["median"]], alpha_metrics, batch=True)
+    return {"erp": out_erp, "env": dict(zip(bands, np.moveaxis(out_env["env"], 1, 0))), "psd": out_psd,
+            "alpha": out_alpha}
+
 # ---------- Run analysis ----------
 def main():
     ctrl, chs, sr = load_group(CONTROL_FILES)
@@ -246,64 +409,46 @@ def main():
     assert chs == chs2 and sr==sr2
     n_t = ctrl.shape[2]; times = np.arange(n_t)/sr
 
-    # 1) Grand-average ERP per group (median across channels)
-    grand_ctrl = np.nanmean(ctrl, axis=1)  # (nsub, n_t) per-subject channel-average
-    grand_alc = np.nanmean(alc, axis=1)
-    # group mean across subjects (and CI)
-    mean_ctrl = np.nanmean(grand_ctrl, axis=0); se_ctrl = np.nanstd(grand_ctrl, axis=0)/math.sqrt(grand_ctrl.shape[0])
-    mean_alc = np.nanmean(grand_alc, axis=0); se_alc = np.nanstd(grand_alc, axis=0)/math.sqrt(grand_alc.shape[0])
-
-    # 2) Band envelopes (delta/theta/alpha/beta) per subject (average across channels)
+    # 1-4) Per-subject channel-mean ERP, band envelopes (delta/theta/alpha/beta), per-channel PSDs
+    # (median across channels for the summary) and alpha power & peak frequency
     bands = {"delta":(1,4),"theta":(4,8),"alpha":(8,12),"beta":(13,30)}
-    band_env_ctrl = {b: [] for b in bands}
-    band_env_alc = {b: [] for b in bands}
-    print("Computing band envelopes...")
-    for subj in ctrl:
-        for b,(lo,hi) in bands.items():
-            env = band_envelope(subj, sr, lo, hi)
-            band_env_ctrl[b].append(np.nanmean(env, axis=0))  # mean across channels
-    for subj in alc:
-        for b,(lo,hi) in bands.items():
-            env = band_envelope(subj, sr, lo, hi)
-            band_env_alc[b].append(np.nanmean(env, axis=0))
-
-    # convert to arrays
-    for b in bands:
-        band_env_ctrl[b] = np.vstack(band_env_ctrl[b])  # (nsub, n_t)
-        band_env_alc[b] = np.vstack(band_env_alc[b])
-
-    # 3) PSD per subject (median across channels)
-    print("Computing PSDs...")
-    freqs = None
-    psd_ctrl=[]; psd_alc=[]
-    for subj in ctrl:
-        f,p = compute_psd_per_subject(subj, sr)
-        freqs = f; psd_ctrl.append(p)
-    for subj in alc:
-        f,p = compute_psd_per_subject(subj, sr)
-        psd_alc.append(p)
-    psd_ctrl = np.vstack(psd_ctrl); psd_alc = np.vstack(psd_alc)
-
-    # 4) Per-subject alpha power & peak alpha frequency
-    def alpha_metrics_from_psd(freqs, psd):
-        # psd: (n_freqs,) or (n_subj,n_freqs)
-        idx = np.logical_and(freqs>=8, freqs<=12)
-        if psd.ndim==1:
-            alpha_pow = np.trapz(psd[idx], freqs[idx])
-            peak_idx = np.argmax(psd[idx]); peak_freq = freqs[idx][peak_idx]
-            return alpha_pow, peak_freq
-        else:
-            alpha_pow = np.trapz(psd[:,idx], freqs[idx], axis=1)
-            peak_idx = np.argmax(psd[:,idx], axis=1)
-            peak_freq = freqs[idx][peak_idx]
-            return alpha_pow, peak_freq
-
-    alpha_pow_ctrl, peak_alpha_ctrl = alpha_metrics_from_psd(freqs, psd_ctrl)
-    alpha_pow_alc, peak_alpha_alc = alpha_metrics_from_psd(freqs, psd_alc)
-
-    # 5) Cluster-based permutation over time per channel
-    print("Running cluster permutation test per channel (this may take time)...")
-    perm_results = cluster_permutation_time(ctrl, alc, sr, n_perm=PERMUTATIONS, p_thresh=CLUSTER_P_THRESHOLD, rng=np.random.RandomState(1))
+    features = default_feature_cache() if FEATURE_CACHE else FeatureCache(cache_dir=None, max_items=0)
+    print("Computing ERPs, band envelopes and PSDs...")
+    ctrl_feat = group_features(ctrl, sr, bands, features)
+    alc_feat = group_features(alc, sr, bands, features)
+    band_env_ctrl, band_env_alc = ctrl_feat["env"], alc_feat["env"]
+    freqs = ctrl_feat["psd"]["freqs"]
+    alpha_pow_ctrl, peak_alpha_ctrl = ctrl_feat["alpha"]["power"], ctrl_feat["alpha"]["peak_freq"]
+    alpha_pow_alc, peak_alpha_alc = alc_feat["alpha"]["power"], alc_feat["alpha"]["peak_freq"]
+
+    # Group means, SEs and percentiles come from the incremental store: with FEATURE_CACHE only subjects
+    # added to (or removed from) CONTROL_FILES / ALC_FILES since the last run are folded in (or out)
+    stats = GroupStatsStore(features)
+    stats.load("temporal")
+    for group, data, feat in (("control", ctrl, ctrl_feat), ("alcoholic", alc, alc_feat)):
+        stats.sync(group, {features.key_for("subject", {"fs": sr, "nperseg": PSD_NPERSEG}, [data[i]]):
+                           {"erp": data[i], "erp_chmean": feat["erp"]["subject"][i],
+                            "psd": feat["psd"]["psd"][i], "psd_chmedian": feat["psd"]["median"][i]}
+                           for i in range(len(data))})
+    stats.save("temporal")
+    erp_ctrl, erp_alc = stats.summary("control", "erp_chmean"), stats.summary("alcoholic", "erp_chmean")
+    mean_ctrl, se_ctrl = erp_ctrl["mean"], erp_ctrl["se"]
+    mean_alc, se_alc = erp_alc["mean"], erp_alc["se"]
+    psd_med_ctrl = stats.summary("control", "psd_chmedian")["p50"]
+    psd_med_alc = stats.summary("alcoholic", "psd_chmedian")["p50"]
+
+    # 5) Cluster-based permutation over time per channel, or over (channel, time) with one shared null
+    if CLUSTER_MODE == "spatiotemporal":
+        print("Running spatio-temporal cluster permutation test...")
+        st_clusters = cluster_permutation_spacetime(ctrl, alc, sr, channel_adjacency(chs), n_perm=PERMUTATIONS, p_thresh=CLUSTER_P_THRESHOLD,
+                                                    seed=PERM_SEED, workers=PERM_WORKERS, adaptive=ADAPTIVE_PERMUTATIONS)
+        perm_results = {ch: [] for ch in range(len(chs))}
+        for (ch_idx, s, e, m, p) in st_clusters:
+            for ch in ch_idx: perm_results[ch].append((s, e, m, p))
+    else:
+        print("Running cluster permutation test per channel (this may take time)...")
+        perm_results = cluster_permutation_time(ctrl, alc, sr, n_perm=PERMUTATIONS, p_thresh=CLUSTER_P_THRESHOLD,
+                                                seed=PERM_SEED, workers=PERM_WORKERS, adaptive=ADAPTIVE_PERMUTATIONS)
 
     # ---------- PLOTTING ----------
     plt.figure(figsize=(12,6))
@@ -337,8 +482,8 @@ def main():
 
     # PSD median plots
     plt.figure(figsize=(10,5))
-    plt.semilogy(freqs, np.median(psd_ctrl, axis=0), label='Ctrl median PSD')
-    plt.semilogy(freqs, np.median(psd_alc, axis=0), label='Alc median PSD')
+    plt.semilogy(freqs, psd_med_ctrl, label='Ctrl median PSD')
+    plt.semilogy(freqs, psd_med_alc, label='Alc median PSD')
     plt.xlim(0,40); plt.xlabel("Hz"); plt.ylabel("PSD"); plt.legend(); plt.title("Group median PSD (median across channels then across subjects)")
 
     # Boxplots for alpha power and peak alpha freq
@@ -359,13 +504,20 @@ def main():
     m1,s1 = meansem(peak_alpha_ctrl); m2,s2 = meansem(peak_alpha_alc)
     print(f"Peak alpha freq (Hz): Control {m1:.2f} ± {s1:.2f}, Alcoholic {m2:.2f} ± {s2:.2f}")
  
-    print("\nSignificant clusters (per channel) [start_idx, end_idx, cluster_mass, pval]:")
     n_sig = 0
-    for ch, clusters in perm_results.items():
-        for (s,e,m,p) in clusters:
+    if CLUSTER_MODE == "spatiotemporal":
+        print("\nSignificant spatio-temporal clusters [start_idx, end_idx, cluster_mass, pval, channels]:")
+        for (ch_idx, s, e, m, p) in st_clusters:
             if p < 0.05:
                 n_sig += 1
-                print(f"Ch {ch} ({chs[ch]}): {s}, {e}, mass={m:.2f}, p={p:.3f}")
+                print(f"{s}, {e}, mass={m:.2f}, p={p:.3f}: {', '.join(chs[c] for c in ch_idx)}")
+    else:
+        print("\nSignificant clusters (per channel) [start_idx, end_idx, cluster_mass, pval]:")
+        for ch, clusters in perm_results.items():
+            for (s,e,m,p) in clusters:
+                if p < 0.05:
+                    n_sig += 1
+                    print(f"Ch {ch} ({chs[ch]}): {s}, {e}, mass={m:.2f}, p={p:.3f}")
     if n_sig==0:
         print("None (no time clusters survived permutation test at p<0.05).")
 
@@ -1,20 +1,85 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify
 from flask_cors import CORS # pyright: ignore[reportMissingModuleSource]
 import os
+import math
 import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 from rd_parser import (
     parse_rd_file, 
     extract_primary_signal, 
     get_all_channels_averaged,
+    recording_to_result,
+    merge_recordings,
 )
+from rd_parser import parse_rd_bytes
+from rd_cache import default_cache, CachingStreamWriter
+from eeg_dsp import EEG_BANDS, fill_gaps, windowed_features
+from recording_store import StoredRecording, default_store
+from decimation import DecimationPyramid, lttb, minmax_decimate
+from signal_codec import wants_f32, encode_array, encode_times
 from gemini_analysis import analyze_eeg_with_gemini, get_simple_anomalies # pyright: ignore[reportMissingImports]
 
+class RDUploadRequest(Request):
+    """
+    Request whose .rd file parts are parsed while they stream in
+
+    werkzeug normally spools every uploaded file to memory or a temporary file; for
+    accepted .rd uploads to /api/upload-rd each part goes to a CachingStreamWriter
+    instead. Each part is parsed by its own task on the upload pool while the request
+    body is still being read, so the files of one request are parsed side by side.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/api/upload-rd' and filename and allowed_file(filename):
+            return default_cache().stream_writer(executor=_upload_pool())
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
 app = Flask(__name__)
+app.request_class = RDUploadRequest
 CORS(app, origins=['http://localhost:5173', 'http://127.0.0.1:5173'])
 
 
 
+def _lookup_recording(recording_id):
+    """
+    Stored group recording for an upload's recording_id, or a single uploaded file by its
+    file id (content hash); None if neither is known
+    """
+    if not recording_id:
+        return None
+    entry = default_store().get(str(recording_id))
+    if entry is None:
+        recording = default_cache().get(str(recording_id))
+        if recording is not None:
+            entry = StoredRecording(str(recording_id), recording)
+    return entry
+
+
+def _stored_signal(entry, channel=None):
+    """
+    (signal, times, metadata) of one channel's trial average from a stored recording
+    (default: first channel by name, as in the upload response)
+    """
+    recording = entry.recording
+    channel = channel or min(recording.channels)
+    averages = entry.cached('channel_averages', recording.channel_averages)
+    signal = averages[recording.channel_index[channel]]
+    times = np.arange(signal.size) / recording.sampling_rate
+    metadata = dict(recording.metadata)
+    metadata.update({
+        'channel': channel,
+        'sampling_rate': recording.sampling_rate,
+        'duration': signal.size / recording.sampling_rate,
+        'samples': int(signal.size),
+        'trials_averaged': recording.n_trials,
+        'has_data': True,
+    })
+    return signal, times, metadata
+
+
 # Add explicit CORS preflight handler for /chat
 from flask import make_response
 
@@ -41,13 +106,18 @@ def chat():
     analysis = data.get('analysis', '')
     bandpower = data.get('bandpower', {})
 
+    # a recording_id from /api/upload-rd replaces sending the signal back
+    entry = _lookup_recording(data.get('recording_id'))
+    if entry is not None:
+        signal, times, stored_metadata = _stored_signal(entry, data.get('channel'))
+        metadata = {**stored_metadata, **metadata}
+
     print(f"📥 Chat endpoint received: signal_len={len(signal)}, metadata={metadata.get('has_data', False)}, samples={metadata.get('samples', 0)}")
 
     # If we have signal data, include statistics
     signal_stats = ""
-    if signal and len(signal) > 0:
-        import numpy as np
-        signal_array = np.array(signal)
+    if signal is not None and len(signal) > 0:
+        signal_array = np.asarray(signal, dtype=float)
         signal_stats = f"""
 **Signal Statistics:**
 - Total samples: {len(signal)}
@@ -55,7 +125,7 @@ def chat():
 - Std Dev: {np.std(signal_array):.2f}
 - Min: {np.min(signal_array):.2f}
 - Max: {np.max(signal_array):.2f}
-- First 20 values: {signal[:20]}
+- First 20 values: {signal_array[:20].tolist()}
 """
 
     # Compose context for Gemini
@@ -103,7 +173,8 @@ ALLOWED_EXTENSIONS = {'rd', 'edf'}  # Support both for now
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+# uploads are parsed as they stream in, so the limit no longer bounds worker memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', '50')) * 1024 * 1024
 
 
 ALLOWED_EXTENSIONS = {'rd', 'edf', '000', '001', '002'}  # Add numbered extensions
@@ -114,14 +185,10 @@ def allowed_file(filename):
         return True
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def downsample_for_visualization(data, target_points=5000):
-    """Downsample data for faster plotting"""
-    if len(data) <= target_points:
-        return data
-    import numpy as np
-    data_array = np.array(data)
-    indices = np.linspace(0, len(data) - 1, target_points, dtype=int)
-    return data_array[indices].tolist()
+def downsample_for_visualization(signal, sampling_rate, target_points=5000):
+    """Downsample a trace for faster plotting (LTTB keeps its shape and spikes), returns (signal, times) arrays"""
+    indices, values = lttb(np.asarray(signal, dtype=float), target_points)
+    return values, indices / sampling_rate
 
 
 @app.route('/api/health', methods=['GET'])
@@ -129,84 +196,125 @@ def health_check():
     return jsonify({'status': 'healthy', 'message': 'Backend is running'})
 
 
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '4'))
+_upload_executor = None
+
+
+def _upload_pool():
+    """
+    Bounded thread pool shared by all upload requests
+
+    It runs the per-file parse tasks of streamed uploads and then their finishing stage
+    (cache writes). Threads rather than processes: recordings stay in this process for the
+    response, and a parse task spends much of its time waiting for the next chunk of the
+    request body.
+    """
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(max_workers=max(1, UPLOAD_WORKERS),
+                                              thread_name_prefix='rd-upload')
+    return _upload_executor
+
+
+def _process_upload(file):
+    """
+    Finish parsing one uploaded file, returns (file_id, result, error)
+
+    Streamed parts only wait for their parse task and store the result; anything else
+    (e.g. a plain file object) is parsed here.
+    """
+    try:
+        # parsed recordings are cached by content hash, re-uploads are memory-mapped;
+        # the hash doubles as the file id for later requests
+        if isinstance(file.stream, CachingStreamWriter):
+            recording_id, recording = file.stream.finish()
+        else:
+            buf = file.read()
+            cache = default_cache()
+            recording_id = cache.key_for_bytes(buf)
+            recording = cache.get(recording_id) or cache.put(recording_id, parse_rd_bytes(buf))
+        return recording_id, recording_to_result(recording), None
+    except Exception as e:
+        return None, None, str(e)
+
+
 @app.route('/api/upload-rd', methods=['POST'])
 def upload_rd():
     """
     Handle multiple RD file uploads and parsing, merge data for group analysis
+
+    Signals are JSON float lists unless the client opts into float32 arrays
+    (signal_codec: ?encoding=f32 or Accept: application/vnd.eeg-f32+json).
     """
     files = request.files.getlist('files')
+    f32 = wants_f32(request)
     if not files or len(files) == 0:
         return jsonify({'success': False, 'error': 'No files provided'}), 400
 
     parsed_results = []
     filenames = []
+    file_ids = []
     errors = []
+    accepted = []
     for file in files:
         if file.filename == '':
             continue
         if not allowed_file(file.filename):
             errors.append(f"File {file.filename} not allowed")
             continue
-        try:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            result = parse_rd_file(filepath)
-            os.remove(filepath)
-            if result['success']:
-                parsed_results.append(result)
-                filenames.append(filename)
-            else:
-                errors.append(f"File {file.filename} failed: {result.get('error','parse error')}")
-        except Exception as e:
-            errors.append(f"File {file.filename} exception: {str(e)}")
+        accepted.append(file)
+
+    # per-file stage on the shared pool; map() keeps upload order
+    for file, (recording_id, result, error) in zip(accepted, _upload_pool().map(_process_upload, accepted)):
+        if error is not None:
+            errors.append(f"File {file.filename} exception: {error}")
+        elif result['success']:
+            parsed_results.append(result)
+            filenames.append(secure_filename(file.filename))
+            file_ids.append(recording_id)
+        else:
+            errors.append(f"File {file.filename} failed: {result.get('error','parse error')}")
 
     if not parsed_results:
         return jsonify({'success': False, 'error': 'No valid files parsed', 'errors': errors}), 400
 
-    # Merge data: concatenate trials for each channel across all files
-    from collections import defaultdict
-    merged_data = defaultdict(lambda: defaultdict(list))  # {channel: {trial: [values]}}
-    merged_metadata = {}
-    trial_offset = 0
-    for result in parsed_results:
-        data = result['data']
-        for channel, channel_info in data.items():
-            for trial_num, values in channel_info['trials'].items():
-                merged_data[channel][trial_num + trial_offset] = values
-        # Optionally, merge metadata (e.g., sum trials, keep channel list, etc.)
-        if 'channels' in result['metadata']:
-            merged_metadata.setdefault('channels', set()).update(result['metadata']['channels'])
-        trial_offset += max([int(t) for c in data.values() for t in c['trials'].keys()] or [0]) + 1
-
-    # Convert channel sets to sorted lists
-    if 'channels' in merged_metadata:
-        merged_metadata['channels'] = sorted(list(merged_metadata['channels']))
-    else:
-        merged_metadata['channels'] = sorted(list(merged_data.keys()))
+    # Merge data: concatenate every file's (trials, channels, samples) array along the trial axis
+    merged = merge_recordings([result['recording'] for result in parsed_results])
 
-    # Use first file's sampling rate and other metadata as default
-    merged_metadata.update(parsed_results[0]['metadata'])
+    # Use first file's sampling rate and other metadata as default, channels are the union
+    merged_metadata = dict(parsed_results[0]['metadata'])
+    merged_metadata['channels'] = sorted(merged.channels)
     merged_metadata['n_files'] = len(parsed_results)
     merged_metadata['filenames'] = filenames
 
-    # Prepare for visualization: use trial-averaged signal for primary channel
-    from rd_parser import get_channel_average
+    # keep the merged group server-side; follow-up requests send recording_id instead of signals
+    merged.metadata = merged_metadata
+    recording_id = default_store().add(merged)
+
+    # Trial-averaged signal of every channel, cut to the shortest file like before
+    min_samples = min(result['recording'].n_samples for result in parsed_results)
+    averages = merged.channel_averages()[:, :min_samples]
+    channel_averages = {name: encode_array(averages[merged.channel_index[name]], f32)
+                        for name in merged_metadata['channels']}
+
+    # Prepare for visualization: primary channel's trial-averaged signal
     primary_channel = merged_metadata['channels'][0] if merged_metadata['channels'] else None
+    sampling_rate = merged_metadata.get('sampling_rate', 256.0)
     if primary_channel:
-        channel_trials = merged_data[primary_channel]
-        signal = get_channel_average(channel_trials).tolist()
-        sampling_rate = merged_metadata.get('sampling_rate', 256.0)
-        times = [i / sampling_rate for i in range(len(signal))]
+        primary = averages[merged.channel_index[primary_channel]]
+        signal = channel_averages[primary_channel]
+        times = encode_times(primary.size, sampling_rate, f32)
+        viz_signal, viz_times = downsample_for_visualization(primary, sampling_rate)
+        viz_signal, viz_times = encode_array(viz_signal, f32), encode_array(viz_times, f32)
     else:
         signal, times = [], []
-
-    viz_signal = downsample_for_visualization(signal)
-    viz_times = downsample_for_visualization(times)
+        viz_signal, viz_times = [], []
 
     response = {
         'success': True,
         'filenames': filenames,
+        'recording_id': recording_id,
+        'file_ids': file_ids,
         'metadata': merged_metadata,
         'available_channels': merged_metadata['channels'],
         'visualization_data': {
@@ -218,6 +326,7 @@ def upload_rd():
             'times': times,
             'sampling_rate': merged_metadata.get('sampling_rate', 256.0)
         },
+        'channel_averages': channel_averages,
         'errors': errors
     }
     return jsonify(response)
@@ -233,6 +342,18 @@ def analyze_eeg():
     times = data.get('times')
     metadata = data.get('metadata', {})
     use_ai = data.get('use_ai', True)
+
+    # a recording_id from /api/upload-rd replaces sending the signal back
+    if data.get('recording_id'):
+        entry = _lookup_recording(data['recording_id'])
+        if entry is None:
+            return jsonify({'success': False, 'error': 'Unknown or expired recording_id'}), 404
+        channel = data.get('channel')
+        if channel and channel not in entry.recording.channel_index:
+            return jsonify({'success': False, 'error': f'Unknown channel: {channel}'}), 400
+        signal, stored_times, stored_metadata = _stored_signal(entry, channel)
+        signal_data, times = signal.tolist(), stored_times.tolist()
+        metadata = {**stored_metadata, **metadata}
     
     if not signal_data or not times:
         return jsonify({'success': False, 'error': 'Missing signal data'}), 400
@@ -256,14 +377,163 @@ def analyze_eeg():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/windowed-features', methods=['POST'])
+def windowed_features_endpoint():
+    """
+    Per-window variance and band power, computed server-side for the UI to plot
+
+    Expects JSON with either
+        recording_id: recording_id or a file_id from /api/upload-rd (channels averaged over trials)
+        signal: [values] (a single channel named 'signal') and sampling_rate
+    plus optional window_size (default 256), hop (default window_size) and channels.
+    The response is columnar: one list per channel for variance and for each band
+    ((channels, windows) float32 arrays with NaN rows when f32 encoding is requested).
+    """
+    data = request.json or {}
+    f32 = wants_f32(request)
+    window_size = int(data.get('window_size', 256))
+    hop = int(data.get('hop') or window_size)
+    if window_size < 2 or hop < 1:
+        return jsonify({'success': False, 'error': 'window_size must be >= 2 and hop >= 1'}), 400
+
+    if data.get('recording_id'):
+        entry = _lookup_recording(data['recording_id'])
+        if entry is None:
+            return jsonify({'success': False, 'error': 'Unknown or expired recording_id'}), 404
+        recording = entry.recording
+        channels = data.get('channels') or recording.channels
+        missing = [c for c in channels if c not in recording.channel_index]
+        if missing:
+            return jsonify({'success': False, 'error': f'Unknown channels: {missing}'}), 400
+        idx = [recording.channel_index[c] for c in channels]
+        signals = entry.cached('channel_averages', recording.channel_averages)[idx]
+        sampling_rate = recording.sampling_rate
+    elif data.get('signal'):
+        channels = ['signal']
+        signals = np.asarray(data['signal'], dtype=float)[None, :]
+        sampling_rate = float(data.get('sampling_rate', 256.0))
+    else:
+        return jsonify({'success': False, 'error': 'Provide recording_id or signal'}), 400
+
+    signals, filled = fill_gaps(signals)
+    feats = windowed_features(signals, sampling_rate, window_size, hop)
+    dead = filled.all(axis=-1)
+
+    def columns(values):
+        # one list per channel, null for channels without any samples
+        if f32:
+            return encode_array(np.where(dead[:, None], np.nan, values), f32)
+        return [None if d else v.tolist() for v, d in zip(values, dead)]
+
+    return jsonify({
+        'success': True,
+        'channels': list(channels),
+        'sampling_rate': sampling_rate,
+        'window_size': window_size,
+        'hop': hop,
+        'window_start': feats['start'].tolist(),
+        'variance': columns(feats['variance']),
+        'bands': {name: list(edges) for name, edges in EEG_BANDS.items()},
+        'bandpower': {name: columns(feats['bandpower'][..., i]) for i, name in enumerate(EEG_BANDS)},
+    })
+
 @app.route('/api/get-channel', methods=['POST'])
 def get_channel():
     """
-    Get specific channel data (for channel switching)
+    Get specific channel data (for channel switching) from a stored recording
+
+    Expects JSON:
+        recording_id: from /api/upload-rd (or a file_id)
+        channels: name or [names] (default: first channel by name)
+        trial: 'average' (default, cached trial average) or a trial number
+        start, end: time range in seconds (default: whole recording)
+        target_points: decimate each channel to about this many points (default 2000)
+        method: 'minmax' (default; keeps every bucket's min and max so spikes stay visible)
+                or 'lttb' (keeps the visual shape of the trace)
     """
-    # This will be used when user wants to switch channels
-    # Implementation coming next
-    return jsonify({'success': True, 'message': 'Channel switching ready'})
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+    f32 = wants_f32(request)
+    entry = _lookup_recording(data.get('recording_id'))
+    if entry is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired recording_id'}), 404
+    recording = entry.recording
+
+    channels = data.get('channels') or data.get('channel') or [min(recording.channels)]
+    if isinstance(channels, str):
+        channels = [channels]
+    missing = [c for c in channels if c not in recording.channel_index]
+    if missing:
+        return jsonify({'success': False, 'error': f'Unknown channels: {missing}'}), 400
+    idx = [recording.channel_index[c] for c in channels]
+
+    method = data.get('method', 'minmax')
+    if method not in ('minmax', 'lttb'):
+        return jsonify({'success': False, 'error': "method must be 'minmax' or 'lttb'"}), 400
+
+    trial = data.get('trial', 'average')
+    if trial == 'average':
+        block = entry.cached('channel_averages', recording.channel_averages)
+    else:
+        try:
+            trial = int(trial)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': "trial must be 'average' or a trial number"}), 400
+        if trial not in recording.trial_ids:
+            return jsonify({'success': False, 'error': f'Unknown trial: {trial}'}), 400
+        block = recording.trial(trial)
+
+    try:
+        start_s = float(data.get('start') or 0)
+        end_s = None if data.get('end') is None else float(data['end'])
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'start and end must be numbers of seconds'}), 400
+    if not math.isfinite(start_s) or start_s < 0 or (end_s is not None and not math.isfinite(end_s)):
+        return jsonify({'success': False, 'error': 'start must be >= 0 and end a finite number of seconds'}), 400
+    if end_s is not None and end_s <= start_s:
+        return jsonify({'success': False, 'error': 'end must be greater than start'}), 400
+    target_points = data.get('target_points', 2000)
+    if isinstance(target_points, bool) or not isinstance(target_points, (int, str)):
+        return jsonify({'success': False, 'error': 'target_points must be an integer >= 2'}), 400
+    try:
+        target_points = int(target_points)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'target_points must be an integer >= 2'}), 400
+    if target_points < 2:
+        return jsonify({'success': False, 'error': 'target_points must be an integer >= 2'}), 400
+
+    sr = recording.sampling_rate
+    n = recording.n_samples
+    start = int(np.floor(start_s * sr))
+    end = n if end_s is None else min(n, int(np.ceil(end_s * sr)))
+    if end <= start:
+        return jsonify({'success': False, 'error': 'Empty time range'}), 400
+
+    if method == 'lttb':
+        indices, values = lttb(block[idx, start:end], target_points)
+        indices = indices + start
+    elif trial == 'average':
+        # zooms on the trial average are served from its min/max pyramid, built once per recording
+        pyramid = entry.cached('average_pyramid', lambda: DecimationPyramid(block))
+        indices, values = pyramid.query(start, end, target_points)
+        indices, values = indices[idx], values[idx]
+    else:
+        indices, values = minmax_decimate(block[idx, start:end], target_points)
+        indices = indices + start
+    times = indices / sr
+    return jsonify({
+        'success': True,
+        'recording_id': entry.recording_id,
+        'sampling_rate': sr,
+        'trial': trial,
+        'start': start / sr,
+        'end': end / sr,
+        'n_samples': end - start,
+        'decimated': indices.shape[-1] < end - start,
+        'channels': {name: {'times': encode_array(times[i], f32), 'values': encode_array(values[i], f32)}
+                     for i, name in enumerate(channels)},
+    })
 
 
 if __name__ == '__main__':
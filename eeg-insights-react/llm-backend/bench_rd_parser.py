@@ -0,0 +1,151 @@
+"""
+Benchmark the array-based parse_rd_file against the old line-by-line parser
+
+Usage: python bench_rd_parser.py [dataset_dir ...]
+Defaults to ControlDataset/ and AlcoholicDataset/ next to this script.
+"""
+import glob
+import os
+import sys
+import time
+import numpy as np
+from typing import Dict, Any
+from collections import defaultdict
+from rd_parser import parse_rd_file
+
+REPEATS = 3
+
+
+# Frozen copy of the previous parser, kept only as the benchmark baseline
+def legacy_parse_rd_file(file_path: str) -> Dict[str, Any]:
+    """
+    Parse custom .rd EEG format
+    
+    Format: trial_num channel_name sample_index value
+    Example: 0 FP1 0 3.082
+    
+    Returns organized data structure with channels, trials, and metadata
+    """
+    try:
+        metadata = {}
+        channels_data = defaultdict(lambda: defaultdict(list))  # {channel: {trial: [values]}}
+        
+        with open(file_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                
+                # Parse header lines
+                if line.startswith('#'):
+                    metadata_line = line[1:].strip()
+                    
+                    # Extract key metadata
+                    if 'trials' in metadata_line.lower():
+                        parts = metadata_line.split(',')
+                        try:
+                            metadata['n_trials'] = int(parts[0].split()[0])
+                            metadata['n_channels'] = int(parts[1].split()[0])
+                            metadata['n_samples'] = int(parts[2].split()[0])
+                        except:
+                            pass
+                    
+                    elif 'msecs' in metadata_line:
+                        parts = metadata_line.split()
+                        try:
+                            metadata['sampling_interval_ms'] = float(parts[0])
+                            metadata['unit'] = parts[1] if len(parts) > 1 else 'µV'
+                        except:
+                            pass
+                    
+                    continue
+                
+                # Parse data lines
+                if line and not line.startswith('#'):
+                    parts = line.split()
+                    if len(parts) >= 4:
+                        try:
+                            trial_num = int(parts[0])
+                            channel_name = parts[1]
+                            sample_idx = int(parts[2])
+                            value = float(parts[3])
+                            
+                            channels_data[channel_name][trial_num].append(value)
+                        except ValueError:
+                            continue
+        
+        # Calculate sampling rate
+        if 'sampling_interval_ms' in metadata:
+            metadata['sampling_rate'] = 1000.0 / metadata['sampling_interval_ms']
+        else:
+            metadata['sampling_rate'] = 256.0  # Default assumption
+        
+        # Get channel list
+        metadata['channels'] = sorted(channels_data.keys())
+        
+        # Convert to organized structure
+        organized_data = {}
+        for channel, trials_dict in channels_data.items():
+            organized_data[channel] = {
+                'trials': dict(trials_dict),
+                'n_trials': len(trials_dict)
+            }
+        
+        return {
+            'success': True,
+            'data': organized_data,
+            'metadata': metadata
+        }
+        
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+def best_time(fn, path):
+    best = float('inf')
+    result = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn(path)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def same_output(old, new):
+    """Check the compatibility view gives the same channels, trials and values"""
+    if old['metadata']['channels'] != new['metadata']['channels']:
+        return False
+    for channel, info in old['data'].items():
+        new_trials = new['data'][channel]['trials']
+        if sorted(info['trials']) != sorted(new_trials):
+            return False
+        for trial_num, values in info['trials'].items():
+            if not np.allclose(values, new_trials[trial_num], atol=1e-4):
+                return False
+    return True
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    dirs = sys.argv[1:] or [os.path.join(here, 'ControlDataset'), os.path.join(here, 'AlcoholicDataset')]
+    files = sorted(p for d in dirs for p in glob.glob(os.path.join(d, '*.rd*')))
+    if not files:
+        print(f"No .rd files found in {dirs}")
+        return
+
+    total_old = total_new = 0.0
+    print(f"{'file':<28}{'legacy ms':>12}{'array ms':>12}{'speedup':>10}  match")
+    for path in files:
+        t_old, old = best_time(legacy_parse_rd_file, path)
+        t_new, new = best_time(parse_rd_file, path)
+        total_old += t_old
+        total_new += t_new
+        match = old['success'] and new['success'] and same_output(old, new)
+        print(f"{os.path.basename(path):<28}{t_old * 1e3:>12.1f}{t_new * 1e3:>12.1f}{t_old / t_new:>9.1f}x  {'✅' if match else '❌'}")
+
+    print(f"\n{len(files)} files: legacy {total_old:.2f}s, array {total_new:.2f}s ({total_old / total_new:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
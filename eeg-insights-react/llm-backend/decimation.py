@@ -0,0 +1,152 @@
+import warnings
+import numpy as np
+from typing import Tuple
+
+
+def minmax_decimate(data: np.ndarray, target_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Peak-preserving decimation of every row of data (..., n) to at most target_points
+
+    The last axis is cut into target_points // 2 equal buckets and each bucket keeps its
+    minimum and maximum sample in time order, so spikes survive any zoom level.
+    Returns (indices, values), both (..., m) with m <= target_points; rows that are
+    already short enough come back whole. NaN samples are skipped (an all-NaN bucket
+    yields NaN values).
+    """
+    x = np.asarray(data)
+    n = x.shape[-1]
+    if n <= target_points or target_points < 2:
+        indices = np.broadcast_to(np.arange(n), x.shape).copy()
+        return indices, x.copy()
+
+    bucket = -(-n // (target_points // 2))            # ceil
+    n_buckets = -(-n // bucket)
+    pad = n_buckets * bucket - n
+    buckets = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(0, pad)], constant_values=np.nan)
+    buckets = buckets.reshape(x.shape[:-1] + (n_buckets, bucket))
+    nan = np.isnan(buckets)
+    i_min = np.argmin(np.where(nan, np.inf, buckets), axis=-1)
+    i_max = np.argmax(np.where(nan, -np.inf, buckets), axis=-1)
+
+    first = np.minimum(i_min, i_max)
+    second = np.maximum(i_min, i_max)
+    base = np.arange(n_buckets) * bucket
+    indices = np.stack([base + first, base + second], axis=-1).reshape(x.shape[:-1] + (2 * n_buckets,))
+    return indices, np.take_along_axis(x, indices, axis=-1)
+
+
+def lttb(data: np.ndarray, target_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Largest-Triangle-Three-Buckets downsampling of every row of data (..., n)
+
+    Keeps the first and last sample and, from each of target_points - 2 buckets in between,
+    the sample forming the largest triangle with the previously kept sample and the next
+    bucket's mean, which follows the visual shape of the trace. Buckets are processed in
+    order but all rows at once. Returns (indices, values), both (..., target_points);
+    rows that are already short enough come back whole. NaN samples are never picked
+    unless a bucket has nothing else.
+    """
+    x = np.asarray(data, dtype=float)
+    n = x.shape[-1]
+    if n <= target_points or target_points < 3:
+        indices = np.broadcast_to(np.arange(n), x.shape).copy()
+        return indices, x.copy()
+
+    rows = x.reshape(-1, n)
+    edges = np.linspace(1, n - 1, target_points - 1).astype(np.int64)   # inner bucket i: [edges[i], edges[i+1])
+    # the point each bucket aims at: the next bucket's mean, or the last sample after the final bucket
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN buckets
+        next_v = np.stack([np.nanmean(rows[:, a:b], axis=1) for a, b in zip(edges[1:-1], edges[2:])]
+                          + [rows[:, -1]], axis=1)
+    next_t = np.append((edges[1:-1] + edges[2:] - 1) / 2.0, n - 1.0)
+
+    picked = np.empty((rows.shape[0], target_points), dtype=np.int64)
+    picked[:, 0] = 0
+    picked[:, -1] = n - 1
+    r = np.arange(rows.shape[0])
+    prev_t = np.zeros((rows.shape[0], 1))
+    prev_v = rows[:, :1]
+    for i, (a, b) in enumerate(zip(edges[:-1], edges[1:])):
+        seg = rows[:, a:b]
+        # twice the triangle area (prev, candidate, next), up to sign
+        area = np.abs((prev_t - next_t[i]) * (seg - prev_v)
+                      - (prev_t - np.arange(a, b)) * (next_v[:, i:i + 1] - prev_v))
+        best = np.argmax(np.where(np.isnan(area), -1.0, area), axis=1)
+        picked[:, i + 1] = a + best
+        prev_t = (a + best)[:, None].astype(float)
+        prev_v = seg[r, best][:, None]
+    indices = picked.reshape(x.shape[:-1] + (target_points,))
+    return indices, np.take_along_axis(x, indices, axis=-1)
+
+
+def _pair_buckets(lo_i, lo_v, hi_i, hi_v):
+    """Merge neighbouring buckets pairwise; a NaN side only wins when both are NaN"""
+    a, b = slice(0, None, 2), slice(1, None, 2)
+    take_b = (lo_v[..., b] < lo_v[..., a]) | np.isnan(lo_v[..., a])
+    lo_i, lo_v = np.where(take_b, lo_i[..., b], lo_i[..., a]), np.where(take_b, lo_v[..., b], lo_v[..., a])
+    take_b = (hi_v[..., b] > hi_v[..., a]) | np.isnan(hi_v[..., a])
+    hi_i, hi_v = np.where(take_b, hi_i[..., b], hi_i[..., a]), np.where(take_b, hi_v[..., b], hi_v[..., a])
+    return lo_i, lo_v, hi_i, hi_v
+
+
+def _interleave(lo_i, lo_v, hi_i, hi_v):
+    """Each bucket's min and max as two points in time order"""
+    swap = hi_i < lo_i
+    first_i, second_i = np.where(swap, hi_i, lo_i), np.where(swap, lo_i, hi_i)
+    first_v, second_v = np.where(swap, hi_v, lo_v), np.where(swap, lo_v, hi_v)
+    shape = lo_i.shape[:-1] + (2 * lo_i.shape[-1],)
+    return (np.stack([first_i, second_i], axis=-1).reshape(shape),
+            np.stack([first_v, second_v], axis=-1).reshape(shape))
+
+
+class DecimationPyramid:
+    """
+    Min/max levels of a (..., n) array for fast peak-preserving zooms
+
+    Level k holds the minimum and maximum (value and sample index) of every bucket of
+    2 ** (k + 1) samples, each level built from the one below, up to a single bucket (the
+    levels add up to about the size of the data). query() answers a range from the coarsest level that still gives
+    target_points, reading the raw array only for ranges that fit in target_points and
+    for the partial buckets at the two ends.
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.data = np.asarray(data)
+        n = self.data.shape[-1]
+        depth = max(1, int(np.ceil(np.log2(max(n, 2)))))
+        size = -(-n // 2 ** depth) * 2 ** depth
+        # pad to whole top-level buckets; padding is NaN so it is never picked over real samples
+        values = np.pad(self.data, [(0, 0)] * (self.data.ndim - 1) + [(0, size - n)], constant_values=np.nan)
+        indices = np.broadcast_to(np.arange(size, dtype=np.int64), values.shape)
+        level = (indices, values, indices, values)
+        self.levels = []
+        for _ in range(depth):
+            level = _pair_buckets(*level)
+            self.levels.append(level)
+
+    def query(self, start: int, end: int, target_points: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (indices, values) of samples [start, end) decimated to about target_points per row
+        (at most target_points + 4: two extra points per partial bucket at either end)
+        """
+        n = self.data.shape[-1]
+        start, end = max(0, start), min(end, n)
+        if end - start <= target_points:
+            indices = np.broadcast_to(np.arange(start, end), self.data.shape[:-1] + (end - start,)).copy()
+            return indices, self.data[..., start:end].copy()
+
+        need = 2 * (end - start) / max(target_points, 2)            # samples per bucket
+        k = min(len(self.levels) - 1, max(0, int(np.ceil(np.log2(need))) - 1))
+        size = 2 ** (k + 1)
+        b0, b1 = -(-start // size), end // size
+        if b1 <= b0:
+            indices, values = minmax_decimate(self.data[..., start:end], target_points)
+            return indices + start, values
+
+        inner = _interleave(*(arr[..., b0:b1] for arr in self.levels[k]))
+        left_i, left_v = minmax_decimate(self.data[..., start:b0 * size], 2)
+        right_i, right_v = minmax_decimate(self.data[..., b1 * size:end], 2)
+        indices = np.concatenate([left_i + start, inner[0], right_i + b1 * size], axis=-1)
+        values = np.concatenate([left_v, inner[1], right_v], axis=-1)
+        return indices, values
@@ -0,0 +1,223 @@
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import detrend, welch
+from typing import Dict, Optional, Tuple
+
+
+def fill_gaps(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Linearly interpolate NaN gaps along the last axis of data (..., n_ch, n_t)
+
+    Matches np.interp per channel: leading/trailing gaps hold the nearest valid value and
+    channels with no valid samples become zeros. Returns (filled float64 copy, mask of the
+    samples that were filled) so later stages can skip or down-weight them without
+    interpolating again; mask.all(axis=-1) marks the all-NaN channels.
+    """
+    x = np.array(data, dtype=float)
+    filled = np.isnan(x)
+    if not filled.any():
+        return x, filled
+
+    n_t = x.shape[-1]
+    t = np.arange(n_t)
+    prev = np.maximum.accumulate(np.where(filled, -1, t), axis=-1)
+    nxt = np.flip(np.minimum.accumulate(np.flip(np.where(filled, n_t, t), axis=-1), axis=-1), axis=-1)
+    # past either end of the valid samples, both sides collapse onto the nearest one
+    lo = np.clip(np.where(prev >= 0, prev, nxt), 0, n_t - 1)
+    hi = np.clip(np.where(nxt < n_t, nxt, prev), 0, n_t - 1)
+    x_lo = np.take_along_axis(x, lo, axis=-1)
+    x_hi = np.take_along_axis(x, hi, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(hi > lo, (t - lo) / (hi - lo), 0.0)
+    out = np.where(filled, x_lo + w * (x_hi - x_lo), x)
+    out[filled.all(axis=-1)] = 0.0
+    return out, filled
+
+
+def gap_weighted_mean(x: np.ndarray, filled: np.ndarray, axis: int = -2,
+                      filled_weight: float = 0.1) -> np.ndarray:
+    """
+    Mean of x along axis, counting filled samples at filled_weight and ignoring NaN
+
+    filled broadcasts against x (x is usually derived from fill_gaps output, e.g. a stack
+    of envelopes); positions where every contributing sample is NaN come back NaN.
+    """
+    w = np.where(np.broadcast_to(filled, x.shape), filled_weight, 1.0)
+    w[np.isnan(x)] = 0.0
+    total = w.sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, np.nansum(x * w, axis=axis) / total, np.nan)
+
+
+# Same bands as the UI's analyzeWindows (src/utils/eegAnalysis.js)
+EEG_BANDS = {
+    'delta': (0.5, 4),
+    'theta': (4, 8),
+    'alpha': (8, 13),
+    'beta': (13, 30),
+    'gamma': (30, 50),
+}
+
+
+def band_matrix(freqs: np.ndarray, bands: Dict[str, Tuple[float, float]]) -> np.ndarray:
+    """
+    (n_freqs, n_bands) 0/1 matrix: power spectra @ band_matrix gives per-band sums
+    """
+    return np.stack([(freqs >= lo) & (freqs <= hi) for lo, hi in bands.values()], axis=1).astype(float)
+
+
+def windowed_features(data: np.ndarray, sampling_rate: float, window_size: int,
+                      hop: Optional[int] = None,
+                      bands: Dict[str, Tuple[float, float]] = EEG_BANDS) -> Dict[str, np.ndarray]:
+    """
+    Variance and band power of every window along the last axis of data (..., n_t)
+
+    Windows are strided views (no copies) starting every hop samples (default: back to
+    back, like splitIntoWindows with no overlap). Band power follows the UI's
+    computeBandpower: mean-centred window, |DFT|^2 / N^2 summed over bins k < N/2 whose
+    frequency lies in [low, high], here from one batched rfft over all windows.
+    Returns {'start': (n_win,), 'variance': (..., n_win), 'bandpower': (..., n_win, n_bands)}.
+    """
+    hop = hop or window_size
+    x = np.asarray(data, dtype=float)
+    if x.shape[-1] < window_size:
+        n_win = 0
+        windows = np.zeros(x.shape[:-1] + (0, window_size))
+    else:
+        windows = sliding_window_view(x, window_size, axis=-1)[..., ::hop, :]
+        n_win = windows.shape[-2]
+
+    centred = windows - windows.mean(axis=-1, keepdims=True)
+    variance = np.mean(centred ** 2, axis=-1)
+    spec = np.fft.rfft(centred, axis=-1)
+    freqs = np.fft.rfftfreq(window_size, 1.0 / sampling_rate)
+    below_nyquist = np.arange(freqs.size) < window_size / 2
+    power = (spec.real ** 2 + spec.imag ** 2) / float(window_size) ** 2
+    bandpower = power @ (band_matrix(freqs, bands) * below_nyquist[:, None])
+    return {
+        'start': np.arange(n_win) * hop,
+        'variance': variance,
+        'bandpower': bandpower,
+    }
+
+
+def trapz_band_weights(freqs: np.ndarray, bands: Dict[str, Tuple[float, float]]) -> np.ndarray:
+    """
+    (n_freqs, n_bands) weights with psd @ W == np.trapz(psd[..., in_band], freqs[in_band])
+    for every band, in_band being freqs within [low, high]
+    """
+    W = np.zeros((freqs.size, len(bands)))
+    for j, (lo, hi) in enumerate(bands.values()):
+        idx = np.flatnonzero((freqs >= lo) & (freqs <= hi))
+        if idx.size < 2:
+            continue
+        df = np.diff(freqs[idx]) / 2.0
+        W[idx[:-1], j] += df
+        W[idx[1:], j] += df
+    return W
+
+
+class PSDEngine:
+    """
+    Welch PSDs of whole (..., n_channels, n_samples) stacks with precomputed band integrals
+
+    One welch call covers every subject and channel; band powers for all configured bands
+    then come from a single matrix multiply with trapezoid weights (trapz_band_weights),
+    computed once per frequency grid.
+    """
+
+    def __init__(self, fs: float, nperseg: int = 256, bands: Dict[str, Tuple[float, float]] = EEG_BANDS):
+        self.fs = fs
+        self.nperseg = nperseg
+        self.bands = dict(bands)
+        self._weights = {}
+
+    def band_weights(self, freqs: np.ndarray) -> np.ndarray:
+        key = (freqs.size, float(freqs[-1]) if freqs.size else 0.0)
+        W = self._weights.get(key)
+        if W is None:
+            W = self._weights[key] = trapz_band_weights(freqs, self.bands)
+        return W
+
+    def band_mask(self, freqs: np.ndarray, band: str) -> np.ndarray:
+        lo, hi = self.bands[band]
+        return (freqs >= lo) & (freqs <= hi)
+
+    def psd(self, data: np.ndarray, filled: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (freqs, psds (..., n_freqs)) of linearly detrended rows; NaN gaps are filled first
+        (pass filled from fill_gaps if data already went through it). All-NaN rows give zeros.
+        """
+        if filled is None:
+            data, filled = fill_gaps(data)
+        nperseg = min(self.nperseg, data.shape[-1])
+        return welch(detrend(data, axis=-1), fs=self.fs, nperseg=nperseg, axis=-1)
+
+    def band_powers(self, freqs: np.ndarray, psds: np.ndarray) -> np.ndarray:
+        """(..., n_bands) power of every configured band, in bands order"""
+        return psds @ self.band_weights(freqs)
+
+
+def robust_zscores(data: np.ndarray) -> np.ndarray:
+    """
+    MAD-based z-scores along the last axis, ignoring NaN
+
+    z = (x - median) / (1.4826 * MAD). Rows whose MAD is zero (e.g. mostly flat) fall
+    back to the standard deviation, and rows with no spread at all get z = 0.
+    """
+    x = np.asarray(data, dtype=float)
+    # np.median partitions in place of nanmedian's per-row path when there is nothing to skip
+    median_fn, std_fn = (np.nanmedian, np.nanstd) if np.isnan(x).any() else (np.median, np.std)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN rows
+        median = median_fn(x, axis=-1, keepdims=True)
+        scale = 1.4826 * median_fn(np.abs(x - median), axis=-1, keepdims=True)
+        scale = np.where(scale > 0, scale, std_fn(x, axis=-1, keepdims=True))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (x - median) / scale
+    return np.where(scale > 0, z, 0.0)
+
+
+def anomaly_runs(data: np.ndarray, threshold_sigma: float = 2.5) -> Dict[str, np.ndarray]:
+    """
+    Contiguous runs of samples whose robust |z| (see robust_zscores) exceeds threshold_sigma
+
+    data is (..., n_samples); every row is scored on its own, all rows in one pass.
+    Returns arrays with one entry per run, rows in C order then time:
+    'row' (flat row index), 'start', 'end' (exclusive), 'peak' (sample index of the
+    largest |z|), 'peak_z' (signed z there) and 'peak_value'.
+    """
+    x = np.asarray(data, dtype=float)
+    n = x.shape[-1]
+    z = robust_zscores(x).reshape(-1, n)
+    above = np.abs(z) > threshold_sigma
+
+    # run edges from a False-padded mask, per row
+    edges = np.diff(np.pad(above, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    row, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    if row.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return {'row': empty, 'start': empty, 'end': empty, 'peak': empty,
+                'peak_z': np.zeros(0), 'peak_value': np.zeros(0)}
+
+    # largest |z| in each run: walk all run samples at once, runs are contiguous in the flat order
+    lengths = end - start
+    offsets = np.repeat(row * n + start - np.cumsum(np.r_[0, lengths[:-1]]), lengths)
+    flat = np.arange(lengths.sum()) + offsets
+    absz = np.abs(z.ravel()[flat])
+    firsts = np.r_[0, np.cumsum(lengths[:-1])]
+    peak_abs = np.maximum.reduceat(absz, firsts)
+    is_peak = absz == np.repeat(peak_abs, lengths)
+    # first sample reaching the run's peak
+    first_peak = np.minimum.reduceat(np.where(is_peak, np.arange(absz.size), absz.size), firsts)
+    peak_flat = flat[first_peak]
+    return {
+        'row': row,
+        'start': start,
+        'end': end,
+        'peak': peak_flat - row * n,
+        'peak_z': z.ravel()[peak_flat],
+        'peak_value': x.reshape(-1, n).ravel()[peak_flat],
+    }
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from rd_cache import atomic_write, key_lock
+
+# Bump when a cached feature's computation changes, so old entries stop matching
+FEATURE_FORMAT_VERSION = 1
+
+DEFAULT_FEATURE_DIR = os.environ.get(
+    'FEATURE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.feature_cache'))
+DEFAULT_MAX_BYTES = int(os.environ.get('FEATURE_CACHE_MAX_MB', '512')) * 1024 * 1024
+DEFAULT_MEMORY_ITEMS = int(os.environ.get('FEATURE_CACHE_ITEMS', '64'))
+
+Features = Dict[str, np.ndarray]
+Input = Union[str, np.ndarray]
+
+
+def _json_default(value):
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"unhashable feature parameter {value!r}")
+
+
+class FeatureCache:
+    """
+    Cache of derived arrays (PSDs, band powers, envelopes, averages) with dependency-aware keys
+
+    A feature's key hashes its name, its parameters and its inputs: content hashes of the
+    arrays it is computed from (key_for_array) or keys of the features it is computed from.
+    Changing a parameter therefore changes that feature's key and, through them, the keys
+    of everything computed from it, while features that do not depend on it keep hitting. Each entry is a dict of arrays,
+    stored as an uncompressed <key>.npz in cache_dir (evicted least-recently-used first
+    past max_bytes) behind an in-memory LRU of max_items entries. Returned arrays are
+    read-only since they are shared between callers.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_FEATURE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_items: int = DEFAULT_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # ---------- keys ----------
+    @staticmethod
+    def key_for_array(data: np.ndarray) -> str:
+        """Content hash of an array (values, dtype and shape)"""
+        data = np.ascontiguousarray(data)
+        digest = hashlib.blake2b(data.view(np.uint8).reshape(-1), digest_size=16)
+        digest.update(f"{data.dtype.str}|{data.shape}".encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def key_for(cls, name: str, params: Optional[dict] = None, inputs: Iterable[Input] = ()) -> str:
+        """Key of feature name computed with params from inputs: arrays, or keys of cached entries"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{name}|v{FEATURE_FORMAT_VERSION}|".encode())
+        digest.update(json.dumps(params or {}, sort_keys=True, default=_json_default).encode())
+        for key in inputs:
+            digest.update(f"|{key if isinstance(key, str) else cls.key_for_array(key)}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    # ---------- entries ----------
+    def _remember(self, key: str, features: Features):
+        with self._lock:
+            self._memory[key] = features
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Features]:
+        """Cached arrays for key, or None on a miss"""
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                return features
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                features = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.discard(key)
+            return None
+        try:
+            os.utime(path)  # refresh recency for LRU eviction
+        except OSError:
+            pass
+        for arr in features.values():
+            arr.flags.writeable = False
+        self._remember(key, features)
+        return features
+
+    def put(self, key: str, features: Features) -> Features:
+        """Store a dict of arrays under key and return the read-only copy that is kept"""
+        features = {name: np.array(arr) for name, arr in features.items()}
+        for arr in features.values():
+            arr.flags.writeable = False
+        if self.cache_dir is not None:
+            with key_lock(key):
+                atomic_write(self._path(key), lambda f: np.savez(f, **features))
+            self.evict()
+        self._remember(key, features)
+        return features
+
+    def compute(self, name: str, params: Optional[dict], inputs: Iterable[Input], fn: Callable,
+                batch: bool = False) -> Tuple[Union[str, List[str]], Features]:
+        """
+        (key, arrays) of a feature, calling fn() only on a miss
+
+        inputs are the arrays fn works on, or the keys of cached entries they came from;
+        pass the returned key on as an input of anything computed from these arrays.
+
+        With batch=True, inputs are arrays stacked along a first subject axis and every
+        subject is its own entry, keyed on its rows of inputs, so a group that gains a
+        subject computes only that subject: fn(idx) returns the arrays of the missing
+        subjects idx (subject axis first) in one go. Returns (one key per subject,
+        arrays stacked over all subjects).
+        """
+        if not batch:
+            key = self.key_for(name, params, inputs)
+            features = self.get(key)
+            if features is None:
+                features = self.put(key, fn())
+            return key, features
+
+        inputs = list(inputs)
+        keys = [self.key_for(name, params, [x[i] for x in inputs]) for i in range(len(inputs[0]))]
+        entries = [self.get(key) for key in keys]
+        missing = [i for i, e in enumerate(entries) if e is None]
+        if missing:
+            fresh = fn(missing)
+            for j, i in enumerate(missing):
+                entries[i] = self.put(keys[i], {n: a[j] for n, a in fresh.items()})
+        return keys, {n: np.stack([e[n] for e in entries]) for n in entries[0]}
+
+    def discard(self, key: str):
+        with self._lock:
+            self._memory.pop(key, None)
+        if self.cache_dir is not None:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Drop least-recently-used files until the directory fits in max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name[:-4]))
+            total += st.st_size
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.discard(key)
+            total -= size
+
+
+_default_feature_cache = None
+
+
+def default_feature_cache() -> FeatureCache:
+    """
+    Process-wide cache in DEFAULT_FEATURE_DIR (FEATURE_CACHE_DIR / FEATURE_CACHE_MAX_MB /
+    FEATURE_CACHE_ITEMS override it)
+    """
+    global _default_feature_cache
+    if _default_feature_cache is None:
+        _default_feature_cache = FeatureCache()
+    return _default_feature_cache
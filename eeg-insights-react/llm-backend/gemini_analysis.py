@@ -3,6 +3,7 @@ import os
 from dotenv import load_dotenv
 import json
 import numpy as np
+from eeg_dsp import anomaly_runs
 
 # Load environment variables
 load_dotenv()
@@ -37,17 +38,7 @@ def analyze_eeg_with_gemini(signal_data, times, metadata):
         
         # Identify potential anomalies using statistical methods first
         # (Give Gemini something to work with)
-        threshold = stats['mean'] + 2.5 * stats['std']
-        negative_threshold = stats['mean'] - 2.5 * stats['std']
-        
-        statistical_anomalies = []
-        for i, (time, value) in enumerate(zip(times, signal_data)):
-            if value > threshold or value < negative_threshold:
-                statistical_anomalies.append({
-                    'index': i,
-                    'time': time,
-                    'value': value
-                })
+        statistical_anomalies = get_simple_anomalies(signal_array, times)
         
         # Prepare prompt for Gemini
         prompt = f"""You are an expert neuroscientist analyzing EEG data. Analyze this EEG signal and identify anomalies or interesting patterns.
@@ -64,8 +55,9 @@ def analyze_eeg_with_gemini(signal_data, times, metadata):
 - Standard Deviation: {stats['std']:.3f} µV
 - Range: {stats['min']:.3f} to {stats['max']:.3f} µV
 
-**Statistical Anomalies Detected (±2.5σ):**
+**Statistical Anomalies Detected (robust |z| > 2.5, contiguous runs):**
 {len(statistical_anomalies)} potential anomalies found.
+{json.dumps(statistical_anomalies[:10])}
 
 **Sample of Signal Data (first 50 points):**
 {signal_data[:50]}
@@ -143,21 +135,31 @@ Provide ONLY valid JSON, no markdown formatting.
 def get_simple_anomalies(signal_data, times, threshold_sigma=2.5):
     """
     Fallback: Simple statistical anomaly detection without AI
+
+    Flags contiguous runs whose robust (median/MAD) z-score exceeds threshold_sigma,
+    one entry per run located at its peak (see eeg_dsp.anomaly_runs). A signal and time
+    axis of different lengths are both cut to the shorter one.
     """
-    signal_array = np.array(signal_data)
-    mean = np.mean(signal_array)
-    std = np.std(signal_array)
-    
+    signal_array = np.asarray(signal_data, dtype=float)
+    times = np.asarray(times, dtype=float)
+    n = min(len(signal_array), len(times))
+    signal_array, times = signal_array[:n], times[:n]
+    if n == 0:
+        return []
+    runs = anomaly_runs(signal_array, threshold_sigma)
+
     anomalies = []
-    for i, (time, value) in enumerate(zip(times, signal_data)):
-        z_score = abs((value - mean) / std)
-        if z_score > threshold_sigma:
-            anomalies.append({
-                'time': float(time),
-                'index': int(i),
-                'severity': 'high' if z_score > 3.5 else 'medium',
-                'description': f'Amplitude spike: {value:.2f} µV ({z_score:.1f}σ from mean)',
-                'z_score': float(z_score)
-            })
+    for start, end, peak, z_score, value in zip(runs['start'], runs['end'], runs['peak'],
+                                                runs['peak_z'], runs['peak_value']):
+        anomalies.append({
+            'time': float(times[peak]),
+            'index': int(peak),
+            'start_time': float(times[start]),
+            'end_time': float(times[end - 1]),
+            'n_samples': int(end - start),
+            'severity': 'high' if abs(z_score) > 3.5 else 'medium',
+            'description': f'Amplitude spike: {value:.2f} µV ({abs(z_score):.1f}σ from median)',
+            'z_score': float(abs(z_score))
+        })
     
-    return anomalies
\ No newline at end of file
+    return anomalies
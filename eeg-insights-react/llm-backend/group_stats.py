@@ -0,0 +1,328 @@
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from feature_cache import FeatureCache
+from quantile_sketch import QuantileSketch
+
+Features = Dict[str, np.ndarray]
+Source = Union[Features, Callable[[], Features]]
+
+
+class RunningStats:
+    """
+    NaN-aware per-element count, mean and sum of squared deviations (Welford)
+
+    add() and remove() cost O(size) and are exact inverses up to rounding; merge() folds
+    in the stats of another batch (Chan et al.). Elements that only ever saw NaN have
+    count 0 and report NaN.
+    """
+
+    def __init__(self, shape: Sequence[int]):
+        self.shape = tuple(shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self._mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)
+
+    def _check(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=float)
+        if x.shape != self.shape:
+            raise ValueError(f"expected shape {self.shape}, got {x.shape}")
+        return x
+
+    def add(self, x: np.ndarray) -> 'RunningStats':
+        x = self._check(x)
+        valid = ~np.isnan(x)
+        self.count += valid
+        delta = np.where(valid, x - self._mean, 0.0)
+        self._mean += np.where(valid, delta / np.maximum(self.count, 1), 0.0)
+        self._m2 += np.where(valid, delta * (x - self._mean), 0.0)
+        return self
+
+    def remove(self, x: np.ndarray) -> 'RunningStats':
+        x = self._check(x)
+        valid = ~np.isnan(x) & (self.count > 0)
+        self.count -= valid
+        delta = np.where(valid, x - self._mean, 0.0)
+        mean = np.where(valid, self._mean - delta / np.maximum(self.count, 1), self._mean)
+        self._m2 -= np.where(valid, delta * (x - mean), 0.0)
+        empty = self.count == 0
+        self._mean = np.where(empty, 0.0, mean)
+        self._m2 = np.where(empty, 0.0, np.maximum(self._m2, 0.0))
+        return self
+
+    def merge(self, other: 'RunningStats') -> 'RunningStats':
+        if other.shape != self.shape:
+            raise ValueError(f"cannot merge stats of shape {other.shape} into {self.shape}")
+        n = self.count + other.count
+        delta = other._mean - self._mean
+        scale = np.where(n > 0, 1.0 / np.maximum(n, 1), 0.0)
+        self._mean = self._mean + delta * other.count * scale
+        self._m2 = self._m2 + other._m2 + delta ** 2 * self.count * other.count * scale
+        self.count = n
+        return self
+
+    @property
+    def mean(self) -> np.ndarray:
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def variance(self, ddof: int = 0) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > ddof, self._m2 / (self.count - ddof), np.nan)
+
+    def std(self, ddof: int = 0) -> np.ndarray:
+        return np.sqrt(self.variance(ddof))
+
+    def sem(self) -> np.ndarray:
+        """np.nanstd(x, axis=0) / sqrt(number of valid values), per element"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.std() / np.sqrt(self.count)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'count': self.count, 'mean': self._mean, 'm2': self._m2}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> 'RunningStats':
+        stats = cls(np.shape(state['mean']))
+        stats.count = np.array(state['count'], dtype=np.int64)
+        stats._mean = np.array(state['mean'], dtype=float)
+        stats._m2 = np.array(state['m2'], dtype=float)
+        return stats
+
+
+class GroupStatsStore:
+    """
+    Per-group aggregates of per-subject feature arrays, kept up to date one subject at a time
+
+    Each subject contributes a dict of arrays, e.g. {'erp': (n_ch, n_t), 'psd': (n_ch, n_freqs)}.
+    For every group and feature the store keeps RunningStats (count, mean, spread) and a
+    QuantileSketch (none if percentiles is empty), so adding a subject costs O(feature size)
+    whatever the cohort size.
+    Removing a subject reverses its RunningStats update exactly; quantile sketches cannot
+    forget, so the group's sketches are marked stale and rebuilt from the remaining
+    subjects the next time summary() needs them.
+
+    Subject features live in cache (a FeatureCache) under a key derived from the subject
+    id, which is what makes removal and rebuilds possible without the caller re-supplying
+    data. If the cache evicted a subject's entry, the features or loader last given to sync()
+    for that subject (or the loader given to add()) restore it. save()/load() keep the aggregates in the same
+    cache, so a script run on a cohort that grew by one subject only folds in that subject
+    (see sync()).
+    """
+
+    def __init__(self, cache: Optional[FeatureCache] = None, sketch_size: int = 128,
+                 percentiles: Sequence[float] = (10, 50, 90)):
+        self.cache = cache if cache is not None else FeatureCache(cache_dir=None, max_items=1 << 20)
+        self.sketch_size = sketch_size
+        self.percentiles = tuple(percentiles)
+        self._groups = {}
+        self._loaders = {}
+
+    def _group(self, group: str) -> dict:
+        return self._groups.setdefault(group, {'subjects': OrderedDict(), 'stats': {}, 'sketches': {}, 'stale': False})
+
+    def _subject_key(self, subject_id: str) -> str:
+        return self.cache.key_for('group_subject', {}, [subject_id])
+
+    def _features(self, subject_id: str) -> Features:
+        """
+        Cached features of a subject, restored from its sync() source if the cache evicted them;
+        KeyError if they are gone and there is no loader
+        """
+        key = self._subject_key(subject_id)
+        features = self.cache.get(key)
+        if features is None:
+            load = self._loaders.get(subject_id)
+            if load is None:
+                raise KeyError(f"features of subject {subject_id} are no longer cached")
+            features = self.cache.put(key, load() if callable(load) else load)
+        return features
+
+    def subjects(self, group: str) -> List[str]:
+        return list(self._group(group)['subjects'])
+
+    def groups(self) -> List[str]:
+        return list(self._groups)
+
+    # ---------- updates ----------
+    def _fold(self, group: str, subject_id: str, features: Features):
+        g = self._group(group)
+        features = {name: np.asarray(x, dtype=float) for name, x in features.items()}
+        for name, x in features.items():
+            if name in g['stats'] and g['stats'][name].shape != x.shape:
+                raise ValueError(f"{name}: expected shape {g['stats'][name].shape}, got {x.shape}")
+        for name, x in features.items():
+            if name not in g['stats']:
+                g['stats'][name] = RunningStats(x.shape)
+                if self.percentiles:
+                    g['sketches'][name] = QuantileSketch(x.shape, self.sketch_size)
+            g['stats'][name].add(x)
+            if self.percentiles and not g['stale']:
+                g['sketches'][name].update(x)
+        g['subjects'][subject_id] = None
+
+    def add(self, group: str, subject_id: str, features: Features,
+            loader: Optional[Callable[[], Features]] = None):
+        """
+        Fold one subject's features into group (a subject already in the group is left as is);
+        ValueError if a feature's shape differs from the group's. loader, if given, recomputes
+        the features should the cache evict them before a removal or rebuild needs them.
+        """
+        if loader is not None:
+            self._loaders[subject_id] = loader
+        if subject_id in self._group(group)['subjects']:
+            return
+        self._fold(group, subject_id, features)
+        self.cache.put(self._subject_key(subject_id), features)
+
+    def remove(self, group: str, subject_id: str):
+        """
+        Take a subject back out of group; raises KeyError if its features are no longer cached
+        and it has no loader
+        """
+        g = self._group(group)
+        if subject_id not in g['subjects']:
+            return
+        features = self._features(subject_id)
+        for name, x in features.items():
+            g['stats'][name].remove(x)
+        del g['subjects'][subject_id]
+        g['stale'] = True
+
+    def reset(self, group: str):
+        self._groups.pop(group, None)
+
+    def _replay(self, group: str, subject_ids: List[str]):
+        """Rebuild group from the features of subject_ids (cached or reloaded), one subject at a time"""
+        self.reset(group)
+        for sid in subject_ids:
+            try:
+                features = self._features(sid)
+            except KeyError:
+                self.reset(group)
+                raise
+            self._fold(group, sid, features)
+
+    def sync(self, group: str, subjects: Union[Dict[str, Source], Iterable[Tuple[str, Source]]]) -> Tuple[int, int]:
+        """
+        Make group hold exactly the given subjects: a {subject_id: features} dict or an iterable
+        of (subject_id, features) pairs, read once, so subjects can be streamed from a generator.
+        features is a dict of arrays, or a loader returning one when it is costly to build:
+        loaders run only for subjects not in the group yet, one at a time, or later to reload
+        a subject whose cached features were evicted. Subjects that are no longer listed are
+        removed at the end.
+
+        Subject ids should change whenever a subject's features change (e.g. content hashes).
+        If the first subject listed is new and its shapes do not match the group's (say the
+        alignment settings changed), the group starts over; a mismatch further down the
+        list raises ValueError.
+        If a removed subject's features were evicted and it has no loader (say it was only
+        listed in an earlier run), the group is rebuilt from the remaining subjects.
+        Returns (n_added, n_removed).
+        """
+        items = subjects.items() if isinstance(subjects, dict) else subjects
+        g = self._group(group)
+        seen, kept, added = set(), [], 0
+        for sid, load in items:
+            if sid in seen:
+                continue
+            seen.add(sid)
+            self._loaders[sid] = load
+            if sid in g['subjects']:
+                kept.append(sid)
+                continue
+            features = load() if callable(load) else load
+            try:
+                self.add(group, sid, features)
+            except ValueError:
+                if kept or added:
+                    raise
+                self.reset(group)
+                g = self._group(group)
+                self.add(group, sid, features)
+            added += 1
+
+        gone = [sid for sid in g['subjects'] if sid not in seen]
+        try:
+            for sid in gone:
+                self.remove(group, sid)
+        except KeyError:
+            self._replay(group, [sid for sid in g['subjects'] if sid in seen])
+        for sid in gone:
+            if not any(sid in other['subjects'] for other in self._groups.values()):
+                self._loaders.pop(sid, None)
+        return added, len(gone)
+
+    # ---------- results ----------
+    def _rebuild_sketches(self, group: str):
+        g = self._group(group)
+        if not self.percentiles:
+            g['stale'] = False
+            return
+        sketches = {name: QuantileSketch(stats.shape, self.sketch_size) for name, stats in g['stats'].items()}
+        for sid in g['subjects']:
+            for name, x in self._features(sid).items():
+                sketches[name].update(x)
+        g['sketches'] = sketches
+        g['stale'] = False
+
+    def summary(self, group: str, feature: str) -> Dict[str, np.ndarray]:
+        """
+        Aggregates of one feature over the group's subjects:
+        'count', 'mean', 'std' (ddof=0), 'se' and 'p<q>' for every configured percentile
+        """
+        g = self._group(group)
+        if feature not in g['stats']:
+            raise KeyError(f"no feature {feature!r} in group {group!r}")
+        if g['stale']:
+            self._rebuild_sketches(group)
+        stats = g['stats'][feature]
+        out = {'count': stats.count, 'mean': stats.mean, 'std': stats.std(), 'se': stats.sem()}
+        if self.percentiles:
+            for q, values in zip(self.percentiles, g['sketches'][feature].percentiles(self.percentiles)):
+                out[f'p{q:g}'] = values
+        return out
+
+    # ---------- persistence ----------
+    def _snapshot_key(self, name: str) -> str:
+        return self.cache.key_for('group_stats', {'name': name, 'sketch_size': self.sketch_size})
+
+    def save(self, name: str):
+        """Store every group's aggregates in the cache under name"""
+        arrays = {}
+        for group, g in self._groups.items():
+            if g['stale']:
+                self._rebuild_sketches(group)
+            arrays[f'{group}/subjects'] = np.array(list(g['subjects']), dtype=str)
+            for feature, stats in g['stats'].items():
+                for k, v in stats.state().items():
+                    arrays[f'{group}/{feature}/stats/{k}'] = v
+                if feature in g['sketches']:
+                    for k, v in g['sketches'][feature].state().items():
+                        arrays[f'{group}/{feature}/sketch/{k}'] = v
+        self.cache.put(self._snapshot_key(name), arrays)
+
+    def load(self, name: str) -> bool:
+        """Replace the store's groups with the snapshot saved under name; False if there is none"""
+        arrays = self.cache.get(self._snapshot_key(name))
+        if arrays is None:
+            return False
+        parts = {}
+        for key, value in arrays.items():
+            group, rest = key.split('/', 1)
+            parts.setdefault(group, {})[rest] = value
+        self._groups = {}
+        for group, items in parts.items():
+            g = self._group(group)
+            g['subjects'] = OrderedDict((str(sid), None) for sid in items['subjects'])
+            features = {k.split('/', 1)[0] for k in items if k != 'subjects'}
+            for feature in features:
+                prefix = feature + '/'
+                sub = {k[len(prefix):]: v for k, v in items.items() if k.startswith(prefix)}
+                g['stats'][feature] = RunningStats.from_state(
+                    {k[len('stats/'):]: v for k, v in sub.items() if k.startswith('stats/')})
+                sketch = {k[len('sketch/'):]: v for k, v in sub.items() if k.startswith('sketch/')}
+                if sketch and self.percentiles:
+                    g['sketches'][feature] = QuantileSketch.from_state(sketch)
+                elif self.percentiles:
+                    g['stale'] = True  # saved without sketches: rebuild them on demand
+        return True
@@ -0,0 +1,134 @@
+import numpy as np
+from typing import Dict, Optional, Sequence, Tuple
+
+
+class QuantileSketch:
+    """
+    KLL-style mergeable quantile sketch of every column of a stream of (n, *shape) rows
+
+    Items are kept in levels, level h holding items that each stand for 2 ** h rows.
+    When a level outgrows its capacity (sketch_size at the top, shrinking by 2/3 per level
+    down, at least 2) it is sorted and every other item (random offset per column) moves
+    up a level with twice the weight. All columns see the same number of rows, so every
+    level is one dense (m_h, *shape) array and compaction is a single sort along axis 0.
+    Memory stays about 3 * sketch_size rows whatever the stream length; rank error is
+    O(log(n / sketch_size) / sketch_size). Until the first compaction (fewer than
+    sketch_size rows) percentiles() is exact and matches np.nanpercentile.
+
+    NaN is ignored the way np.nanpercentile ignores it: NaN items sort last and carry no
+    weight in percentiles(). Sketches of the same shape merge (merge()), so chunks or
+    workers can be summarised separately.
+    """
+
+    def __init__(self, shape: Sequence[int], sketch_size: int = 128, seed: Optional[int] = 0):
+        self.shape = tuple(shape)
+        self.sketch_size = sketch_size
+        self.n = 0
+        self.levels = []   # level h: (m_h, *shape) items of weight 2 ** h
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, h: int) -> int:
+        return max(2, int(np.ceil(self.sketch_size * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def _push(self, h: int, items: np.ndarray):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty((0,) + self.shape))
+        self.levels[h] = np.concatenate([self.levels[h], items]) if self.levels[h].size else items
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.shape[0] > self._capacity(h):
+                level = np.sort(level, axis=0)  # NaN last
+                m = level.shape[0] - level.shape[0] % 2
+                offset = self._rng.integers(0, 2, size=self.shape)
+                idx = offset + 2 * np.arange(m // 2).reshape((-1,) + (1,) * len(self.shape))
+                self.levels[h] = level[m:]          # an odd item out stays behind
+                self._push(h + 1, np.take_along_axis(level[:m], idx, axis=0))
+            h += 1
+
+    def update(self, rows: np.ndarray) -> 'QuantileSketch':
+        """Add rows (n, *shape), or a single row shaped like the columns"""
+        rows = np.array(rows, dtype=float).reshape((-1,) + self.shape)
+        if rows.shape[0]:
+            self.n += rows.shape[0]
+            self._push(0, rows)
+            self._compress()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """Fold another sketch of the same shape into this one"""
+        if other.shape != self.shape:
+            raise ValueError(f"cannot merge sketches of shape {other.shape} into {self.shape}")
+        for h, level in enumerate(other.levels):
+            if level.shape[0]:
+                self._push(h, level)
+        self.n += other.n
+        self._compress()
+        return self
+
+    def percentiles(self, q) -> np.ndarray:
+        """
+        (len(q), *shape) approximate np.nanpercentile(rows, q, axis=0) (linear interpolation
+        between item ranks); columns with no valid rows give NaN
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        out = np.full((q.size,) + self.shape, np.nan)
+        if not self.levels:
+            return out
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.shape[0], 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, axis=0, kind='stable')
+        values = np.take_along_axis(items, order, axis=0)
+        w = np.where(np.isnan(values), 0.0, weights[order])
+        cum = np.cumsum(w, axis=0)
+        total = cum[-1]
+        # rank of each item's middle row; with unit weights item i has rank i
+        centre = cum - (w + 1) / 2
+        n_valid = np.count_nonzero(w, axis=0)
+        last = np.maximum(n_valid - 1, 0)
+
+        for i, qi in enumerate(q):
+            target = qi / 100.0 * (total - 1)
+            above = np.count_nonzero(centre <= target, axis=0)   # NaN items rank past every target
+            hi = np.minimum(above, last)[None]
+            lo = np.maximum(np.minimum(above - 1, last), 0)[None]
+            c_lo, c_hi = np.take_along_axis(centre, lo, axis=0)[0], np.take_along_axis(centre, hi, axis=0)[0]
+            v_lo, v_hi = np.take_along_axis(values, lo, axis=0)[0], np.take_along_axis(values, hi, axis=0)[0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                frac = np.clip(np.where(c_hi > c_lo, (target - c_lo) / (c_hi - c_lo), 0.0), 0.0, 1.0)
+            out[i] = np.where(n_valid > 0, v_lo + frac * (v_hi - v_lo), np.nan)
+        return out
+
+    # ---------- persistence ----------
+    def state(self) -> Dict[str, np.ndarray]:
+        """Arrays that from_state() rebuilds the sketch from"""
+        header = np.array([self.n, self.sketch_size] + list(self.shape), dtype=np.int64)
+        return {'header': header, **{f'level{h}': level for h, level in enumerate(self.levels)}}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray], seed: Optional[int] = 0) -> 'QuantileSketch':
+        header = np.asarray(state['header'])
+        sketch = cls(tuple(int(s) for s in header[2:]), sketch_size=int(header[1]), seed=seed)
+        sketch.n = int(header[0])
+        h = 0
+        while f'level{h}' in state:
+            sketch.levels.append(np.array(state[f'level{h}'], dtype=float))
+            h += 1
+        return sketch
+
+
+
+def sketch_percentiles(data: np.ndarray, q, axis: int = 0, sketch_size: int = 128,
+                       chunk_rows: int = 1024) -> Tuple[np.ndarray, QuantileSketch]:
+    """
+    Approximate np.nanpercentile(data, q, axis) with bounded memory: slices of chunk_rows
+    along axis go through one QuantileSketch. Returns (percentiles (len(q), ...), sketch);
+    merge the sketch with those of other chunks of the same columns for a combined answer.
+    """
+    x = np.moveaxis(np.asarray(data), axis, 0)
+    sketch = QuantileSketch(x.shape[1:], sketch_size=sketch_size)
+    for start in range(0, x.shape[0], chunk_rows):
+        sketch.update(x[start:start + chunk_rows])
+    return sketch.percentiles(q), sketch
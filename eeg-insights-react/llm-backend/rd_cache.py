@@ -0,0 +1,323 @@
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import numpy as np
+from concurrent.futures import Executor
+from typing import Optional, Iterable, Tuple, Union
+from rd_parser import EEGRecording, RDStreamParser, parse_rd_bytes
+
+# Bump when parse_rd_bytes changes what it produces, so old sidecars stop matching
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'RD_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.rd_cache'))
+DEFAULT_MAX_BYTES = int(os.environ.get('RD_CACHE_MAX_MB', '1024')) * 1024 * 1024
+
+# writers of the same key serialise on one of these (picked by key), across cache instances
+_KEY_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def key_lock(key: str) -> threading.Lock:
+    return _KEY_LOCKS[hash(key) % len(_KEY_LOCKS)]
+
+
+def atomic_write(path: str, write, mode: str = 'wb'):
+    """
+    Write path through write(file) into a unique temporary file next to it, then move it
+    into place, so concurrent writers and readers never see a partial file
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class RecordingCache:
+    """
+    Content-addressed on-disk cache of parsed recordings
+
+    Each entry is a pair of sidecars named after the key:
+        <key>.npy   float32 (n_trials, n_channels, n_samples) array, memory-mapped on load
+        <key>.json  channels, sampling rate, trial ids, units and header metadata
+
+    Keys come from a hash of the file bytes ('hash' validation) or of path, size and
+    mtime ('mtime' validation, which skips reading the file on a hit). Entries are
+    evicted least-recently-used first once the directory grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 validate: str = 'hash'):
+        if validate not in ('hash', 'mtime'):
+            raise ValueError(f"validate must be 'hash' or 'mtime', got {validate!r}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.validate = validate
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # ---------- keys ----------
+    @staticmethod
+    def key_for_bytes(buf: bytes) -> str:
+        digest = hashlib.blake2b(buf, digest_size=16)
+        digest.update(f"v{CACHE_FORMAT_VERSION}".encode())
+        return digest.hexdigest()
+
+    def key_for_path(self, path: str) -> str:
+        if self.validate == 'mtime':
+            st = os.stat(path)
+            stamp = f"{os.path.realpath(path)}|{st.st_size}|{st.st_mtime_ns}|v{CACHE_FORMAT_VERSION}"
+            return hashlib.blake2b(stamp.encode(), digest_size=16).hexdigest()
+        with open(path, 'rb') as f:
+            return self.key_for_bytes(f.read())
+
+    def _paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.npy', base + '.json'
+
+    # ---------- entries ----------
+    def get(self, key: str) -> Optional[EEGRecording]:
+        """
+        Memory-map a cached recording, or None on a miss (or an unreadable entry)
+        """
+        npy_path, json_path = self._paths(key)
+        try:
+            with open(json_path, 'r') as f:
+                header = json.load(f)
+            data = np.load(npy_path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.discard(key)
+            return None
+
+        # refresh recency for LRU eviction
+        for p in (npy_path, json_path):
+            try:
+                os.utime(p)
+            except OSError:
+                pass
+        return EEGRecording(data, header['channels'], header['sampling_rate'], header['trial_ids'],
+                            units=header['units'], metadata=header['metadata'])
+
+    def put(self, key: str, recording: EEGRecording) -> EEGRecording:
+        """
+        Write a recording's sidecars and return the memory-mapped copy
+        """
+        npy_path, json_path = self._paths(key)
+        header = {
+            'channels': recording.channels,
+            'sampling_rate': recording.sampling_rate,
+            'trial_ids': recording.trial_ids.tolist(),
+            'units': recording.units,
+            'metadata': recording.metadata,
+        }
+        with key_lock(key):
+            # another writer of the same bytes may have finished while this one parsed
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            # the .json is written last: its presence marks a complete entry
+            atomic_write(npy_path, lambda f: np.save(f, recording.data))
+            atomic_write(json_path, lambda f: json.dump(header, f), mode='w')
+
+        self.evict()
+        cached = self.get(key)
+        return cached if cached is not None else recording
+
+    def age(self, key: str) -> Optional[float]:
+        """
+        Seconds since the entry was last written or read, None if it is not cached
+        """
+        try:
+            return time.time() - os.stat(self._paths(key)[1]).st_mtime
+        except OSError:
+            return None
+
+    def discard(self, key: str):
+        for p in self._paths(key):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Drop least-recently-used entries until the cache fits in max_bytes
+        """
+        entries = {}
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext not in ('.npy', '.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            size, last_used = entries.get(key, (0, 0.0))
+            entries[key] = (size + st.st_size, max(last_used, st.st_mtime))
+            total += st.st_size
+
+        for key, (size, _) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+            if total <= self.max_bytes:
+                break
+            self.discard(key)
+            total -= size
+
+    # ---------- loading ----------
+    def load_bytes(self, buf: bytes) -> EEGRecording:
+        """
+        Parse a .rd buffer, or memory-map it if the same bytes were parsed before
+        """
+        key = self.key_for_bytes(buf)
+        recording = self.get(key)
+        if recording is None:
+            recording = self.put(key, parse_rd_bytes(buf))
+        return recording
+
+    def stream_writer(self, executor: Optional[Executor] = None) -> 'CachingStreamWriter':
+        """
+        File-like sink that parses a .rd upload chunk by chunk into this cache
+        (on a task of executor, if given, see CachingStreamWriter)
+        """
+        return CachingStreamWriter(self, executor)
+
+    def load_path(self, path: str, trials: Union[int, Iterable[int], None] = None) -> EEGRecording:
+        """
+        Load a .rd file through the cache (all trials are cached, selection happens after)
+        """
+        key = self.key_for_path(path)
+        recording = self.get(key)
+        if recording is None:
+            with open(path, 'rb') as f:
+                recording = self.put(key, parse_rd_bytes(f.read()))
+        return recording if trials is None else recording.select_trials(trials)
+
+
+class CachingStreamWriter:
+    """
+    Write-only file object that parses and hashes an upload while it is being received
+
+    Hand it to anything that streams bytes into a file (e.g. werkzeug's multipart parser
+    via Request._get_file_stream); finish() then returns (key, recording) from the cache.
+    Nothing is written to a temporary file and the raw text is never held in full.
+    A parse error is kept and raised from finish() instead of breaking the writer.
+
+    With an executor, chunks go through a bounded queue to a parse task on it, so the
+    writer only hashes and the thread reading the request moves on to the next file while
+    this one is still being parsed. The stream ends at the first seek() (the multipart
+    parser rewinds a part once it is complete), close() or finish(); a parse task that
+    gets no chunk for idle_timeout seconds gives up with an error.
+    """
+
+    def __init__(self, cache: 'RecordingCache', executor: Optional[Executor] = None,
+                 queue_size: int = 16, idle_timeout: float = 60.0):
+        self.cache = cache
+        self._hash = hashlib.blake2b(digest_size=16)  # same key as key_for_bytes
+        self._parser = RDStreamParser()
+        self._size = 0
+        self._error = None
+        self.idle_timeout = idle_timeout
+        self._chunks = None
+        self._parsed = None
+        self._recording = None
+        self._ended = False
+        if executor is not None:
+            self._chunks = queue.Queue(maxsize=queue_size)
+            self._parsed = executor.submit(self._drain)
+
+    def _feed(self, chunk: bytes):
+        if self._error is None:
+            try:
+                self._parser.feed(chunk)
+            except Exception as e:
+                self._error = e
+
+    def _drain(self):
+        """Parse task: feed queued chunks until the end of the stream, then parse the rest"""
+        while True:
+            try:
+                chunk = self._chunks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._error = self._error or TimeoutError("upload stream stalled")
+                self._ended = True
+                return
+            if chunk is None:
+                break
+            self._feed(chunk)
+        if self._error is None:
+            try:
+                self._recording = self._parser.finish()
+            except Exception as e:
+                self._error = e
+
+    def _end(self):
+        if self._chunks is not None and not self._ended:
+            self._ended = True
+            self._chunks.put(None)
+
+    def write(self, chunk: bytes) -> int:
+        self._hash.update(chunk)
+        self._size += len(chunk)
+        if self._chunks is None:
+            self._feed(chunk)
+        elif not self._ended:
+            try:
+                self._chunks.put(bytes(chunk), timeout=self.idle_timeout)
+            except queue.Full:
+                self._error = self._error or TimeoutError("upload parser stalled")
+                self._ended = True
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # the multipart parser rewinds finished parts; there is nothing to rewind,
+        # but no more chunks will come
+        self._end()
+        return self._size
+
+    def tell(self) -> int:
+        return self._size
+
+    def close(self):
+        self._end()
+        if self._parsed is None:
+            self._parser = None
+
+    def finish(self) -> Tuple[str, EEGRecording]:
+        if self._parsed is not None:
+            self._end()
+            self._parsed.result()
+        if self._error is not None:
+            raise self._error
+        self._hash.update(f"v{CACHE_FORMAT_VERSION}".encode())
+        key = self._hash.hexdigest()
+        recording = self.cache.get(key)
+        if recording is None:
+            parsed = self._recording if self._recording is not None else self._parser.finish()
+            recording = self.cache.put(key, parsed)
+        self._parser = self._recording = None
+        return key, recording
+
+
+_default_cache = None
+
+
+def default_cache() -> RecordingCache:
+    """
+    Process-wide cache in DEFAULT_CACHE_DIR (RD_CACHE_DIR / RD_CACHE_MAX_MB override it)
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = RecordingCache()
+    return _default_cache
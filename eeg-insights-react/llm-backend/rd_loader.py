@@ -0,0 +1,65 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+from rd_parser import EEGRecording, parse_rd_bytes
+from rd_cache import RecordingCache, default_cache
+
+
+def _parse_into_cache(job: Tuple[str, str, int, str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Worker: make sure path is parsed into the cache, return (key, error)
+
+    Only the key travels back to the parent, which memory-maps the sidecar instead of
+    receiving a pickled array.
+    """
+    path, cache_dir, max_bytes, validate = job
+    try:
+        cache = RecordingCache(cache_dir, max_bytes=max_bytes, validate=validate)
+        key = cache.key_for_path(path)
+        if cache.get(key) is None:
+            with open(path, 'rb') as f:
+                recording = parse_rd_bytes(f.read())
+            if recording.n_channels == 0:
+                raise ValueError("no data rows")
+            cache.put(key, recording)
+        return key, None
+    except FileNotFoundError:
+        return None, "missing"
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def iter_recordings(paths: List[str], workers: Optional[int] = None,
+                    cache: Optional[RecordingCache] = None
+                    ) -> Iterator[Tuple[str, Optional[EEGRecording], Optional[str]]]:
+    """
+    Load many .rd files, yielding (path, recording, error) in input order as they finish
+
+    Every file is parsed into the cache (default_cache() if none is given) and handed back
+    as a memory-mapped array. With workers > 1 the parses run in a process pool, so large
+    arrays are never pickled between processes. A missing or unreadable file yields
+    (path, None, error) instead of stopping the load.
+    """
+    if cache is None:
+        cache = default_cache()
+
+    jobs = [(p, cache.cache_dir, cache.max_bytes, cache.validate) for p in paths]
+    if workers and workers > 1 and len(jobs) > 1:
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(jobs)))
+        results = pool.map(_parse_into_cache, jobs)
+    else:
+        pool = None
+        results = map(_parse_into_cache, jobs)
+
+    try:
+        for path, (key, error) in zip(paths, results):
+            if error is not None:
+                yield path, None, error
+                continue
+            recording = cache.get(key)
+            if recording is None:
+                # evicted between the worker's write and this read
+                recording = cache.load_path(path)
+            yield path, recording, None
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
@@ -1,84 +1,438 @@
+import io
+import re
+import warnings
 import numpy as np
-from typing import Dict, List, Any, Tuple
-from collections import defaultdict
+from typing import Dict, List, Any, Tuple, Iterable, Union
+from collections.abc import Mapping
 
-def parse_rd_file(file_path: str) -> Dict[str, Any]:
+# Header lines start with '#'; everything else is a "trial channel sample value" row
+_HEADER_TEXT = re.compile(rb'#([^\n]*)')
+_ROW_DTYPE = np.dtype([('trial', np.int64), ('channel', 'S32'), ('sample', np.int64), ('value', np.float32)])
+
+
+def _parse_header(header_lines: List[str]) -> Tuple[Dict[str, Any], Dict[int, str]]:
+    """
+    Extract metadata and the "<name> chan <idx>" channel order from header lines
+    """
+    metadata = {}
+    chan_order = {}
+    for metadata_line in header_lines:
+        # Extract key metadata
+        if 'trials' in metadata_line.lower():
+            parts = metadata_line.split(',')
+            try:
+                metadata['n_trials'] = int(parts[0].split()[0])
+                metadata['n_channels'] = int(parts[1].split()[0])
+                metadata['n_samples'] = int(parts[2].split()[0])
+            except:
+                pass
+
+        elif 'msecs' in metadata_line:
+            parts = metadata_line.split()
+            try:
+                metadata['sampling_interval_ms'] = float(parts[0])
+                metadata['unit'] = parts[parts.index('msecs') + 1] if len(parts) > 2 else 'µV'
+            except:
+                pass
+
+        elif ' chan ' in metadata_line:
+            toks = metadata_line.split()
+            try:
+                idx = toks.index('chan')
+                chan_order[int(toks[idx + 1])] = ' '.join(toks[:idx])
+            except (ValueError, IndexError):
+                pass
+    return metadata, chan_order
+
+
+def _parse_rows_slow(data: bytes) -> np.ndarray:
+    """
+    Line-by-line fallback for buffers with malformed rows (skips them, like the old parser)
+    """
+    rows = []
+    for line in data.splitlines():
+        parts = line.split()
+        if len(parts) < 4 or parts[0].startswith(b'#'):
+            continue
+        try:
+            rows.append((int(parts[0]), parts[1], int(parts[2]), float(parts[3])))
+        except ValueError:
+            continue
+    return np.array(rows, dtype=_ROW_DTYPE)
+
+
+def _parse_rows(data: bytes) -> np.ndarray:
+    """
+    Convert all data rows at once into a structured (trial, channel, sample, value) array
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # loadtxt warns on buffers without rows
+            return np.loadtxt(io.BytesIO(data), dtype=_ROW_DTYPE, comments='#',
+                              usecols=(0, 1, 2, 3), ndmin=1)
+    except ValueError:
+        return _parse_rows_slow(data)
+
+
+class EEGRecording:
+    """
+    One parsed recording: a contiguous float32 (n_trials, n_channels, n_samples) array
+    (NaN where the file had no sample) and the metadata needed to interpret it.
+    This is the shared type behind parse_rd_file, parse_rd000 and the analysis scripts.
+    """
+    __slots__ = ('data', 'channels', 'channel_index', 'sampling_rate', 'trial_ids', 'units', 'metadata')
+
+    def __init__(self, data: np.ndarray, channels: List[str], sampling_rate: float,
+                 trial_ids: np.ndarray, units: str = 'µV', metadata: Dict[str, Any] = None):
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.channels = list(channels)
+        self.channel_index = {name: i for i, name in enumerate(self.channels)}
+        self.sampling_rate = float(sampling_rate)
+        self.trial_ids = np.asarray(trial_ids, dtype=np.int64)
+        self.units = units
+        self.metadata = metadata if metadata is not None else {}
+
+    @property
+    def n_trials(self) -> int:
+        return self.data.shape[0]
+
+    @property
+    def n_channels(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def n_samples(self) -> int:
+        return self.data.shape[2]
+
+    def trial(self, trial_num: int = 0) -> np.ndarray:
+        """
+        (n_channels, n_samples) view of one trial, all NaN if the file has no such trial
+        """
+        hits = np.flatnonzero(self.trial_ids == trial_num)
+        if hits.size == 0:
+            return np.full(self.data.shape[1:], np.nan, dtype=np.float32)
+        return self.data[hits[0]]
+
+    def select_trials(self, trials: Union[int, Iterable[int]]) -> 'EEGRecording':
+        """
+        Recording restricted to the given trial numbers (those present, in trial order)
+        """
+        wanted = [trials] if isinstance(trials, int) else list(trials)
+        keep = np.isin(self.trial_ids, wanted)
+        if keep.all():
+            return self
+        return EEGRecording(self.data[keep], self.channels, self.sampling_rate, self.trial_ids[keep],
+                            units=self.units, metadata=self.metadata)
+
+    def channel_average(self, channel: str) -> np.ndarray:
+        """
+        Average across trials for one channel, ignoring missing samples
+        """
+        block = self.data[:, self.channel_index[channel], :]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN columns
+            return np.nanmean(block, axis=0)
+
+    def channel_averages(self) -> np.ndarray:
+        """
+        (n_channels, n_samples) average across trials for every channel in one reduction
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN columns
+            return np.nanmean(self.data, axis=0)
+
+    def __repr__(self) -> str:
+        return (f"EEGRecording({self.n_trials} trials, {self.n_channels} channels, "
+                f"{self.n_samples} samples @ {self.sampling_rate:.2f} Hz)")
+
+
+def _select_trial_rows(buf: bytes, trials: Iterable[int]) -> bytes:
+    """
+    Keep only the data rows whose first token is one of the requested trial numbers.
+
+    Rows are matched with byte comparisons at every line start, so rows of other trials are
+    dropped before any field is converted. Header lines are dropped too.
+    """
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(raw == ord('\n')) + 1
+    if ends.size == 0 or ends[-1] != raw.size:
+        ends = np.append(ends, raw.size)
+    starts = np.concatenate(([0], ends[:-1]))
+
+    tokens = [str(int(t)).encode() for t in trials]
+    padded = np.concatenate((raw, np.zeros(max(map(len, tokens), default=0) + 1, dtype=np.uint8)))
+    keep = np.zeros(starts.size, dtype=bool)
+    for token in tokens:
+        match = np.ones(starts.size, dtype=bool)
+        for k, char in enumerate(token):
+            match &= padded[starts + k] == char
+        follow = padded[starts + len(token)]
+        keep |= match & ((follow == ord(' ')) | (follow == ord('\t')))
+    return raw[np.repeat(keep, ends - starts)].tobytes()
+
+
+def parse_rd_bytes(buf: bytes, trials: Union[int, Iterable[int], None] = None) -> EEGRecording:
+    """
+    Parse a whole .rd buffer into an EEGRecording.
+
+    Channels keep header ("<name> chan <idx>") order, then any unlisted channel by first
+    appearance. Trials are every trial number present in the rows, or only the requested
+    ones when trials is given (rows of other trials are skipped before conversion).
+    """
+    header_lines = [m.decode('utf-8', 'ignore').strip() for m in _HEADER_TEXT.findall(buf)]
+    metadata, chan_order = _parse_header(header_lines)
+
+    if trials is not None:
+        buf = _select_trial_rows(buf, [trials] if isinstance(trials, int) else trials)
+    rows = _parse_rows(buf)
+    rows = rows[rows['sample'] >= 0]
+    trial, names, sample, value = rows['trial'], rows['channel'], rows['sample'], rows['value']
+
+    # Channel index: header order first, then any unlisted channel by first appearance
+    uniq, first_seen, ch_inv = np.unique(names, return_index=True, return_inverse=True)
+    uniq = [u.decode('utf-8', 'ignore') for u in uniq]
+    header_rank = {name: idx for idx, name in chan_order.items()}
+    order = sorted(range(len(uniq)), key=lambda i: (header_rank.get(uniq[i], len(header_rank)), first_seen[i]))
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    channels = [uniq[i] for i in order]
+
+    trial_ids, trial_inv = np.unique(trial, return_inverse=True)
+    n_samples = int(sample.max()) + 1 if sample.size else 0
+
+    signals = np.full((len(trial_ids), len(channels), n_samples), np.nan, dtype=np.float32)
+    signals[trial_inv, position[ch_inv], sample] = value
+
+    if 'sampling_interval_ms' in metadata:
+        sampling_rate = 1000.0 / metadata['sampling_interval_ms']
+    else:
+        sampling_rate = 256.0  # Default assumption
+
+    return EEGRecording(signals, channels, sampling_rate, trial_ids,
+                        units=metadata.get('unit', 'µV'), metadata=metadata)
+
+
+class RDStreamParser:
+    """
+    Incremental .rd parser: feed() chunks as they arrive, finish() for the EEGRecording
+
+    Complete lines are buffered up to block_size bytes and then converted in one go
+    straight into a preallocated float32 (trials, channels, samples) array sized from the
+    header and grown by doubling if the rows go beyond it. Memory therefore stays at about
+    the size of the decoded array plus one block, however large the text is. The result is
+    the same as parse_rd_bytes on the concatenated chunks.
+    """
+
+    def __init__(self, block_size: int = 4 * 1024 * 1024):
+        self.block_size = block_size
+        self._pending = []
+        self._pending_bytes = 0
+        self._header_lines = []
+        self._chan_order = {}
+        self._metadata = {}
+        self._channel_slot = {}   # channel name (bytes) -> slot, slots in first-appearance order
+        self._trial_slot = {}     # trial number -> slot
+        self._n_samples = 0
+        self._store = None
+
+    def _reserve(self, n_trials: int, n_channels: int, n_samples: int):
+        """Make sure the store holds at least this many trials, channels and samples"""
+        if self._store is None:
+            self._store = np.full((max(n_trials, 1), max(n_channels, 1), max(n_samples, 1)),
+                                  np.nan, dtype=np.float32)
+            return
+        have = self._store.shape
+        need = (n_trials, n_channels, n_samples)
+        if all(n <= h for n, h in zip(need, have)):
+            return
+        grown = tuple(h if n <= h else max(n, 2 * h) for n, h in zip(need, have))
+        store = np.full(grown, np.nan, dtype=np.float32)
+        store[:have[0], :have[1], :have[2]] = self._store
+        self._store = store
+
+    def _slots(self, keys: np.ndarray, table: Dict) -> np.ndarray:
+        """Slot of every key, giving unseen keys new slots in order of first appearance"""
+        uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+        for i in np.argsort(first, kind='stable'):
+            table.setdefault(uniq[i].item(), len(table))
+        return np.array([table[u.item()] for u in uniq], dtype=np.int64)[inv]
+
+    def _consume(self, block: bytes):
+        lines = [m.decode('utf-8', 'ignore').strip() for m in _HEADER_TEXT.findall(block)]
+        if lines:
+            self._header_lines.extend(lines)
+            self._metadata, self._chan_order = _parse_header(self._header_lines)
+
+        rows = _parse_rows(block)
+        rows = rows[rows['sample'] >= 0]
+        if rows.size == 0:
+            return
+        ch = self._slots(rows['channel'], self._channel_slot)
+        tr = self._slots(rows['trial'], self._trial_slot)
+        self._n_samples = max(self._n_samples, int(rows['sample'].max()) + 1)
+        # size from the header on first use, so a well-formed file never regrows
+        self._reserve(len(self._trial_slot), max(len(self._channel_slot), self._metadata.get('n_channels', 0)),
+                      max(self._n_samples, self._metadata.get('n_samples', 0)))
+        self._store[tr, ch, rows['sample']] = rows['value']
+
+    def _flush(self, final: bool = False):
+        data = b''.join(self._pending)
+        cut = len(data) if final else data.rfind(b'\n') + 1
+        self._pending = [data[cut:]] if cut < len(data) else []
+        self._pending_bytes = len(data) - cut
+        if cut:
+            self._consume(data[:cut])
+
+    def feed(self, chunk: bytes):
+        """Add the next chunk of the file (chunks may split lines anywhere)"""
+        if not chunk:
+            return
+        self._pending.append(bytes(chunk))
+        self._pending_bytes += len(chunk)
+        if self._pending_bytes >= self.block_size:
+            self._flush()
+
+    def finish(self) -> EEGRecording:
+        """Parse whatever is left and return the recording"""
+        self._flush(final=True)
+        metadata = self._metadata
+
+        # same ordering rules as parse_rd_bytes: header channels first, trials ascending
+        names = [name.decode('utf-8', 'ignore') for name in self._channel_slot]
+        header_rank = {name: idx for idx, name in self._chan_order.items()}
+        ch_order = sorted(range(len(names)), key=lambda i: (header_rank.get(names[i], len(header_rank)), i))
+        trial_ids = np.array(sorted(self._trial_slot), dtype=np.int64)
+        tr_order = [self._trial_slot[t] for t in trial_ids.tolist()]
+
+        if self._store is None:
+            signals = np.full((0, 0, 0), np.nan, dtype=np.float32)
+        else:
+            signals = self._store[np.ix_(tr_order, ch_order)][..., :self._n_samples]
+        self._store = None
+
+        if 'sampling_interval_ms' in metadata:
+            sampling_rate = 1000.0 / metadata['sampling_interval_ms']
+        else:
+            sampling_rate = 256.0  # Default assumption
+
+        return EEGRecording(signals, [names[i] for i in ch_order], sampling_rate, trial_ids,
+                            units=metadata.get('unit', 'µV'), metadata=metadata)
+
+
+def load_recording(file_path: str, trials: Union[int, Iterable[int], None] = None,
+                   cache=None) -> EEGRecording:
+    """
+    Read and parse one .rd file (optionally only some trials, see parse_rd_bytes).
+    With a cache (rd_cache.RecordingCache) the parse is reused across runs.
+    """
+    if cache is not None:
+        return cache.load_path(file_path, trials=trials)
+    with open(file_path, 'rb') as f:
+        return parse_rd_bytes(f.read(), trials=trials)
+
+
+def align_channels(data: np.ndarray, channel_names: List[str], target_names: List[str]) -> np.ndarray:
+    """
+    Reorder the channel axis (second to last) of data to target_names.
+    Channels missing from channel_names are NaN; extra channels are dropped.
+    """
+    index = {name: i for i, name in enumerate(channel_names)}
+    src = np.array([index.get(name, -1) for name in target_names], dtype=np.int64)
+    present = src >= 0
+    out = np.full(data.shape[:-2] + (len(target_names), data.shape[-1]), np.nan, dtype=float)
+    out[..., present, :] = data[..., src[present], :]
+    return out
+
+
+def merge_recordings(recordings: List[EEGRecording]) -> EEGRecording:
+    """
+    Concatenate recordings along the trial axis over the union of their channels
+
+    Channels are ordered by first appearance (first recording's order, then new ones),
+    channels or samples a recording lacks are NaN, and each recording's trial numbers are
+    shifted past the previous recording's largest one. Sampling rate, units and metadata
+    come from the first recording.
+    """
+    channel_index = {}
+    for rec in recordings:
+        for name in rec.channels:
+            channel_index.setdefault(name, len(channel_index))
+    n_trials = sum(rec.n_trials for rec in recordings)
+    n_samples = max((rec.n_samples for rec in recordings), default=0)
+
+    data = np.full((n_trials, len(channel_index), n_samples), np.nan, dtype=np.float32)
+    trial_ids = np.empty(n_trials, dtype=np.int64)
+    row = 0
+    offset = 0
+    for rec in recordings:
+        cols = [channel_index[name] for name in rec.channels]
+        data[row:row + rec.n_trials, cols, :rec.n_samples] = rec.data
+        trial_ids[row:row + rec.n_trials] = rec.trial_ids + offset
+        row += rec.n_trials
+        offset += int(rec.trial_ids.max()) + 1 if rec.trial_ids.size else 1
+
+    first = recordings[0] if recordings else EEGRecording(data, [], 256.0, trial_ids)
+    return EEGRecording(data, list(channel_index), first.sampling_rate, trial_ids,
+                        units=first.units, metadata=dict(first.metadata))
+
+
+class ChannelTrialsView(Mapping):
+    """
+    Read-only {channel: {'trials': {trial: [values]}, 'n_trials': int}} view of a dense array,
+    matching what parse_rd_file used to build with nested dicts
+    """
+
+    def __init__(self, signals: np.ndarray, channels: List[str], trial_ids: np.ndarray):
+        self._signals = signals
+        self._channels = channels
+        self._index = {name: i for i, name in enumerate(channels)}
+        self._trial_ids = [int(t) for t in trial_ids]
+
+    def __getitem__(self, channel: str) -> Dict[str, Any]:
+        block = self._signals[:, self._index[channel], :]
+        present = ~np.isnan(block)
+        trials = {
+            trial_num: block[k][present[k]].tolist()
+            for k, trial_num in enumerate(self._trial_ids)
+            if present[k].any()
+        }
+        return {'trials': trials, 'n_trials': len(trials)}
+
+    def __iter__(self):
+        return iter(self._channels)
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+
+def recording_to_result(recording: EEGRecording) -> Dict[str, Any]:
+    """
+    Wrap a recording in the parse_rd_file success/data/metadata contract
+    """
+    metadata = dict(recording.metadata)
+    metadata['sampling_rate'] = recording.sampling_rate
+    metadata['channels'] = sorted(recording.channels)
+    
+    return {
+        'success': True,
+        'data': ChannelTrialsView(recording.data, recording.channels, recording.trial_ids),
+        'metadata': metadata,
+        'recording': recording
+    }
+
+
+def parse_rd_file(file_path: str, cache=None) -> Dict[str, Any]:
     """
     Parse custom .rd EEG format
     
     Format: trial_num channel_name sample_index value
     Example: 0 FP1 0 3.082
     
-    Returns organized data structure with channels, trials, and metadata
+    Returns organized data structure with channels, trials, and metadata.
+    'data' is a compatibility view over the EEGRecording in 'recording'.
     """
     try:
-        metadata = {}
-        channels_data = defaultdict(lambda: defaultdict(list))  # {channel: {trial: [values]}}
-        
-        with open(file_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                
-                # Parse header lines
-                if line.startswith('#'):
-                    metadata_line = line[1:].strip()
-                    
-                    # Extract key metadata
-                    if 'trials' in metadata_line.lower():
-                        parts = metadata_line.split(',')
-                        try:
-                            metadata['n_trials'] = int(parts[0].split()[0])
-                            metadata['n_channels'] = int(parts[1].split()[0])
-                            metadata['n_samples'] = int(parts[2].split()[0])
-                        except:
-                            pass
-                    
-                    elif 'msecs' in metadata_line:
-                        parts = metadata_line.split()
-                        try:
-                            metadata['sampling_interval_ms'] = float(parts[0])
-                            metadata['unit'] = parts[1] if len(parts) > 1 else 'µV'
-                        except:
-                            pass
-                    
-                    continue
-                
-                # Parse data lines
-                if line and not line.startswith('#'):
-                    parts = line.split()
-                    if len(parts) >= 4:
-                        try:
-                            trial_num = int(parts[0])
-                            channel_name = parts[1]
-                            sample_idx = int(parts[2])
-                            value = float(parts[3])
-                            
-                            channels_data[channel_name][trial_num].append(value)
-                        except ValueError:
-                            continue
-        
-        # Calculate sampling rate
-        if 'sampling_interval_ms' in metadata:
-            metadata['sampling_rate'] = 1000.0 / metadata['sampling_interval_ms']
-        else:
-            metadata['sampling_rate'] = 256.0  # Default assumption
-        
-        # Get channel list
-        metadata['channels'] = sorted(channels_data.keys())
-        
-        # Convert to organized structure
-        organized_data = {}
-        for channel, trials_dict in channels_data.items():
-            organized_data[channel] = {
-                'trials': dict(trials_dict),
-                'n_trials': len(trials_dict)
-            }
-        
-        return {
-            'success': True,
-            'data': organized_data,
-            'metadata': metadata
-        }
+        return recording_to_result(load_recording(file_path, cache=cache))
         
     except Exception as e:
         return {
@@ -87,6 +441,48 @@ def parse_rd_file(file_path: str) -> Dict[str, Any]:
         }
 
 
+def to_rd000(recording: EEGRecording, default_ch: int = 64, default_samples: int = 416,
+             default_ms: float = 3.906,
+             trials: Union[int, Iterable[int]] = 0) -> Tuple[np.ndarray, List[str], int, int]:
+    """
+    Selected trial(s) of a recording in the layout the analysis scripts use
+
+    Returns:
+        data: float array (n_ch, n_samples) for a single trial number, or
+              (len(trials), n_ch, n_samples) for a list of them; NaN where missing
+        channel_names: header channel order, padded with "Ch<n>" up to the header channel count
+        sampling_rate: int Hz
+        n_samples: header sample count
+    """
+    metadata = recording.metadata
+    n_ch = metadata.get('n_channels', default_ch)
+    n_samp = metadata.get('n_samples', default_samples)
+    samp_ms = metadata.get('sampling_interval_ms', default_ms)
+
+    channel_names = recording.channels[:n_ch]
+    channel_names += [f"Ch{i+1}" for i in range(len(channel_names), n_ch)]
+
+    selected = [trials] if isinstance(trials, int) else list(trials)
+    width = min(n_samp, recording.n_samples)
+    data = np.full((len(selected), n_ch, n_samp), np.nan, dtype=float)
+    for k, trial_num in enumerate(selected):
+        data[k, :, :width] = align_channels(recording.trial(trial_num)[:, :width],
+                                            recording.channels, channel_names)
+    if isinstance(trials, int):
+        data = data[0]
+    return data, channel_names, int(round(1000.0 / samp_ms)), n_samp
+
+
+def parse_rd000(path: str, default_ch: int = 64, default_samples: int = 416,
+                default_ms: float = 3.906, trials: Union[int, Iterable[int]] = 0,
+                cache=None) -> Tuple[np.ndarray, List[str], int, int]:
+    """
+    Load a .rd file and return to_rd000 of its selected trial(s)
+    """
+    recording = load_recording(path, trials=trials, cache=cache)
+    return to_rd000(recording, default_ch, default_samples, default_ms, trials=trials)
+
+
 def get_channel_average(channel_data: Dict[int, List[float]]) -> np.ndarray:
     """
     Average across all trials for a channel (common in ERP analysis)
@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+from rd_parser import EEGRecording
+from rd_cache import RecordingCache, default_cache
+
+DEFAULT_MAX_ITEMS = int(os.environ.get('RECORDING_STORE_ITEMS', '32'))
+DEFAULT_TTL_SECONDS = float(os.environ.get('RECORDING_TTL_S', '3600'))
+# '1' keeps stored recordings in the on-disk recording cache too, so they outlive the process
+DISK_BACKED = os.environ.get('RECORDING_STORE_DISK', '0') == '1'
+
+
+class StoredRecording:
+    """
+    A recording held for follow-up requests, plus arrays derived from it
+
+    derived is a scratch dict for results that are costly to recompute per request
+    (channel averages, decimation levels, ...); it lives and dies with the entry.
+    """
+    __slots__ = ('recording_id', 'recording', 'derived', 'last_used')
+
+    def __init__(self, recording_id: str, recording: EEGRecording):
+        self.recording_id = recording_id
+        self.recording = recording
+        self.derived = {}
+        self.last_used = time.monotonic()
+
+    def cached(self, name: str, compute):
+        """Value of derived[name], computing it with compute() on first use"""
+        value = self.derived.get(name)
+        if value is None:
+            value = self.derived[name] = compute()
+        return value
+
+
+class RecordingStore:
+    """
+    Server-side recordings referenced by id, so clients stop sending signals back
+
+    Entries are kept in memory, least-recently-used first out once there are more than
+    max_items, and expire ttl_seconds after their last use. With a disk cache each entry
+    is also written there under its id, and a request for an id that fell out of memory
+    (or came from another process) is served from the memory-mapped copy if that copy was
+    written or read within the TTL.
+    """
+
+    def __init__(self, max_items: int = DEFAULT_MAX_ITEMS, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 disk_cache: Optional[RecordingCache] = None):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.disk_cache = disk_cache
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if now - oldest.last_used <= self.ttl_seconds and len(self._entries) <= self.max_items:
+                break
+            self._entries.popitem(last=False)
+
+    def add(self, recording: EEGRecording) -> str:
+        """Store a recording and return its new id"""
+        recording_id = uuid.uuid4().hex
+        if self.disk_cache is not None:
+            recording = self.disk_cache.put(recording_id, recording)
+        with self._lock:
+            self._entries[recording_id] = StoredRecording(recording_id, recording)
+            self._expire(time.monotonic())
+        return recording_id
+
+    def get(self, recording_id: str) -> Optional[StoredRecording]:
+        """Entry for recording_id (refreshing its TTL), or None if unknown or expired"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(recording_id)
+            if entry is not None:
+                entry.last_used = now
+                self._entries.move_to_end(recording_id)
+                return entry
+
+        if self.disk_cache is None:
+            return None
+        age = self.disk_cache.age(recording_id)
+        if age is None or age > self.ttl_seconds:
+            return None
+        recording = self.disk_cache.get(recording_id)
+        if recording is None:
+            return None
+        with self._lock:
+            entry = self._entries.setdefault(recording_id, StoredRecording(recording_id, recording))
+            self._expire(now)
+        return entry
+
+    def discard(self, recording_id: str):
+        with self._lock:
+            self._entries.pop(recording_id, None)
+        if self.disk_cache is not None:
+            self.disk_cache.discard(recording_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_store = None
+
+
+def default_store() -> RecordingStore:
+    """
+    Process-wide store (RECORDING_STORE_ITEMS / RECORDING_TTL_S / RECORDING_STORE_DISK configure it)
+    """
+    global _default_store
+    if _default_store is None:
+        _default_store = RecordingStore(disk_cache=default_cache() if DISK_BACKED else None)
+    return _default_store
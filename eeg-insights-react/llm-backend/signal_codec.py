@@ -0,0 +1,41 @@
+import base64
+import numpy as np
+from typing import Any, Dict, Union
+
+# Accept header media type and query flag (?encoding=f32) that opt into binary arrays
+F32_MEDIA_TYPE = 'application/vnd.eeg-f32+json'
+F32_QUERY_VALUES = ('f32', 'float32', 'binary')
+
+
+def wants_f32(request) -> bool:
+    """
+    True if the client asked for float32 arrays (Accept header or ?encoding=f32)
+    """
+    if request.args.get('encoding', '').lower() in F32_QUERY_VALUES:
+        return True
+    return F32_MEDIA_TYPE in request.headers.get('Accept', '')
+
+
+def encode_array(values: np.ndarray, f32: bool) -> Union[list, Dict[str, Any]]:
+    """
+    JSON form of a numeric array
+
+    Default: nested float lists with NaN as null. With f32: the little-endian float32
+    bytes, base64 encoded, as {'dtype': '<f4', 'shape': [...], 'data': '...'} (NaN stays NaN).
+    """
+    values = np.asarray(values)
+    if f32:
+        raw = np.ascontiguousarray(values, dtype='<f4')
+        return {'dtype': '<f4', 'shape': list(raw.shape), 'data': base64.b64encode(raw.tobytes()).decode('ascii')}
+    values = values.astype(float)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def encode_times(n_samples: int, sampling_rate: float, f32: bool, start: float = 0.0) -> Union[list, Dict[str, Any]]:
+    """
+    Time axis of n_samples evenly spaced samples: a float list by default, or with f32
+    just {'start', 'step', 'length'} for the client to expand
+    """
+    if f32:
+        return {'start': start, 'step': 1.0 / sampling_rate, 'length': int(n_samples)}
+    return (start + np.arange(n_samples) / sampling_rate).tolist()
@@ -0,0 +1,143 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+from eeg_dsp import EEG_BANDS, band_matrix
+
+
+class WindowedFeatureEngine:
+    """
+    Incremental per-window variance and band power for live multichannel streams
+
+    Produces the same numbers as eeg_dsp.windowed_features over the samples seen so far,
+    but keeps running state instead of recomputing whole windows: variance comes from
+    running sums of x and x^2, band power from a sliding DFT of only the bins that fall in
+    a band. Each new sample costs O(tracked bins) per channel, against O(window log window)
+    for a fresh FFT. The running state is recomputed exactly from the window buffer every
+    refresh_windows windows so rounding drift cannot build up.
+
+    Input must be NaN-free (run gaps through eeg_dsp.fill_gaps first).
+    """
+
+    def __init__(self, n_channels: int, sampling_rate: float, window_size: int,
+                 hop: Optional[int] = None, bands: Dict[str, Tuple[float, float]] = EEG_BANDS,
+                 refresh_windows: int = 8):
+        self.n_channels = n_channels
+        self.sampling_rate = float(sampling_rate)
+        self.window_size = window_size
+        self.hop = hop or window_size
+        self.bands = dict(bands)
+        self.refresh_samples = refresh_windows * window_size
+
+        # only the bins windowed_features would count: below N/2 and inside some band
+        freqs = np.fft.rfftfreq(window_size, 1.0 / self.sampling_rate)
+        weights = band_matrix(freqs, self.bands)
+        weights[np.arange(freqs.size) >= window_size / 2] = 0
+        weights[0] = 0  # the DC bin of a mean-centred window is zero
+        self._bins = np.flatnonzero(weights.any(axis=1))
+        self._band_weights = weights[self._bins]                              # (n_bins, n_bands)
+        self._step = np.exp(2j * np.pi * self._bins / window_size)            # one-sample rotation
+        self._dft = np.exp(-2j * np.pi * np.outer(np.arange(window_size), self._bins) / window_size)
+        self._slide_weights = {}
+        self.reset()
+
+    def reset(self):
+        """Forget all samples"""
+        n, N = self.n_channels, self.window_size
+        self._buf = np.zeros((n, N))     # ring buffer of the current window
+        self._head = 0                   # index of the oldest sample in _buf
+        self._n_seen = 0
+        self._since_refresh = 0
+        self._spec = np.zeros((n, self._bins.size), dtype=complex)
+        self._shift = np.zeros(n)        # per-channel offset keeping the running sums well conditioned
+        self._sum = np.zeros(n)
+        self._sumsq = np.zeros(n)
+
+    # ---------- state updates ----------
+    def _refresh(self):
+        window = np.roll(self._buf, -self._head, axis=1)
+        self._head = 0
+        self._buf = window
+        self._spec = window @ self._dft
+        self._shift = window.mean(axis=1)
+        centred = window - self._shift[:, None]
+        self._sum = centred.sum(axis=1)
+        self._sumsq = (centred ** 2).sum(axis=1)
+        self._since_refresh = 0
+
+    def _weights_for(self, h: int) -> np.ndarray:
+        # W[i, k] = step_k ** (h - i): sample i of an h-sample block still rotates h - i times
+        W = self._slide_weights.get(h)
+        if W is None:
+            W = self._step[None, :] ** (h - np.arange(h))[:, None]
+            self._slide_weights[h] = W
+        return W
+
+    def _slide(self, new: np.ndarray):
+        """Advance the window by new.shape[1] (<= window_size) samples"""
+        h = new.shape[1]
+        cols = (self._head + np.arange(h)) % self.window_size
+        old = self._buf[:, cols]
+        self._spec = self._spec * self._step ** h + (new - old) @ self._weights_for(h)
+        shift = self._shift[:, None]
+        self._sum += (new - shift).sum(axis=1) - (old - shift).sum(axis=1)
+        self._sumsq += ((new - shift) ** 2).sum(axis=1) - ((old - shift) ** 2).sum(axis=1)
+        self._buf[:, cols] = new
+        self._head = (self._head + h) % self.window_size
+        self._n_seen += h
+        self._since_refresh += h
+        if self._since_refresh >= self.refresh_samples:
+            self._refresh()
+
+    def _features(self) -> Tuple[np.ndarray, np.ndarray]:
+        N = self.window_size
+        mean = self._sum / N
+        variance = np.maximum(self._sumsq / N - mean ** 2, 0.0)
+        power = (self._spec.real ** 2 + self._spec.imag ** 2) / float(N) ** 2
+        return variance, power @ self._band_weights
+
+    # ---------- public API ----------
+    def push(self, samples: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Feed new samples, (n_channels, n_new) or (n_new,) for a single channel
+
+        Returns the windows completed by these samples, shaped like windowed_features:
+        {'start': (n_win,), 'variance': (n_channels, n_win), 'bandpower': (n_channels, n_win, n_bands)}
+        """
+        x = np.asarray(samples, dtype=float)
+        if x.ndim == 1:
+            x = x[None, :]
+        if x.shape[0] != self.n_channels:
+            raise ValueError(f"expected {self.n_channels} channels, got {x.shape[0]}")
+
+        N, hop = self.window_size, self.hop
+        starts, variances, bandpowers = [], [], []
+        pos, n_new = 0, x.shape[1]
+        while pos < n_new:
+            if self._n_seen < N:
+                take = min(N - self._n_seen, n_new - pos)
+                self._buf[:, self._n_seen:self._n_seen + take] = x[:, pos:pos + take]
+                self._n_seen += take
+                pos += take
+                if self._n_seen < N:
+                    continue
+                self._refresh()
+            else:
+                # slide straight to the next window start on the hop grid (at most N at a time)
+                start = self._n_seen - N
+                h = min((start // hop + 1) * hop - start, n_new - pos, N)
+                self._slide(x[:, pos:pos + h])
+                pos += h
+
+            start = self._n_seen - N
+            if start % hop == 0:
+                variance, bandpower = self._features()
+                starts.append(start)
+                variances.append(variance)
+                bandpowers.append(bandpower)
+
+        n_bands = len(self.bands)
+        return {
+            'start': np.array(starts, dtype=np.int64),
+            'variance': np.stack(variances, axis=1) if variances else np.zeros((self.n_channels, 0)),
+            'bandpower': (np.stack(bandpowers, axis=1) if bandpowers
+                          else np.zeros((self.n_channels, 0, n_bands))),
+        }
@@ -0,0 +1,162 @@
+import os
+import sys
+import numpy as np
+from scipy.stats import t, ttest_ind
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TemporalAnalysis import (_init_perm_worker, _null_chunk, _spacetime_components, _sufficient_stats,
+                              channel_adjacency, cluster_permutation_spacetime, cluster_permutation_time,
+                              schedule_permutations)
+
+
+def _groups(n_sub=8, n_ch=4, n_t=40, effect_ch=(), effect_t=slice(10, 20), effect=3.0, seed=0):
+    rng = np.random.default_rng(seed)
+    g1 = rng.normal(size=(n_sub, n_ch, n_t))
+    g2 = rng.normal(size=(n_sub, n_ch, n_t))
+    for ch in effect_ch:
+        g2[:, ch, effect_t] += effect
+    return g1, g2
+
+
+def test_components_join_adjacent_channels_and_time():
+    mask = np.zeros((1, 3, 6), dtype=bool)
+    mask[0, 0, 1:3] = True     # channel 0, t 1-2
+    mask[0, 1, 2:4] = True     # channel 1, t 2-3: touches channel 0 at t=2
+    mask[0, 2, 1:3] = True     # channel 2: same times as channel 0 but not adjacent to it
+    weights = np.ones(mask.shape)
+    pairs = np.array([[0, 1]])
+    nodes, comp, mass, lab = _spacetime_components(mask, weights, pairs)
+    assert nodes.size == 6
+    assert sorted(mass.tolist()) == [2.0, 4.0]
+    assert np.all(lab == 0)
+    # the channel 0/1 points form one component, channel 2 its own
+    ch = (nodes // mask.shape[2]) % mask.shape[1]
+    assert len(set(comp[ch < 2])) == 1
+    assert set(comp[ch == 2]).isdisjoint(comp[ch < 2])
+
+
+def test_components_keep_labelings_apart():
+    mask = np.zeros((2, 2, 4), dtype=bool)
+    mask[:, 0, :2] = True
+    weights = np.arange(mask.size, dtype=float).reshape(mask.shape)
+    _, _, mass, lab = _spacetime_components(mask, weights, np.array([[0, 1]]))
+    assert lab.tolist() == [0, 1]
+    assert mass.tolist() == [weights[0, 0, :2].sum(), weights[1, 0, :2].sum()]
+
+
+def test_components_of_empty_mask():
+    nodes, comp, mass, lab = _spacetime_components(np.zeros((2, 3, 5), dtype=bool), np.ones((2, 3, 5)),
+                                                   np.array([[0, 1]]))
+    assert nodes.size == comp.size == mass.size == lab.size == 0
+
+
+def test_channel_adjacency_is_symmetric_and_skips_unknown_labels():
+    adj = channel_adjacency(["FZ", "CZ", "PZ", "FC1", "X"])
+    assert np.array_equal(adj, adj.T)
+    assert not adj.diagonal().any()
+    assert not adj[4].any()
+    assert adj[0, 3] and adj[1, 3]      # FC1 sits between FZ and CZ
+    assert not adj[0, 2]                # FZ and PZ are two rows apart
+
+
+def test_spacetime_cluster_spans_adjacent_channels():
+    g1, g2 = _groups(effect_ch=(0, 1))
+    adjacency = np.zeros((4, 4), dtype=bool)
+    adjacency[0, 1] = adjacency[1, 0] = True
+    clusters = cluster_permutation_spacetime(g1, g2, 256, adjacency, n_perm=200, rng=np.random.RandomState(1))
+    chans, start, end, mass, pval = clusters[0]
+    assert chans.tolist() == [0, 1]
+    assert start <= 10 and end >= 20
+    assert pval < 0.05
+    assert [c[3] for c in clusters] == sorted((c[3] for c in clusters), reverse=True)
+
+
+def test_spacetime_clusters_split_without_adjacency():
+    g1, g2 = _groups(effect_ch=(0, 1))
+    clusters = cluster_permutation_spacetime(g1, g2, 256, np.zeros((4, 4), dtype=bool), n_perm=50, rng=np.random.RandomState(1))
+    big = [c for c in clusters if c[2] - c[1] >= 5]
+    assert sorted(c[0].tolist() for c in big) == [[0], [1]]
+
+
+def test_time_clusters_match_per_channel_effect():
+    g1, g2 = _groups(effect_ch=(2,))
+    results = cluster_permutation_time(g1, g2, 256, n_perm=200, rng=np.random.RandomState(1))
+    start, end, mass, pval = max(results[2], key=lambda c: c[2])
+    assert start <= 10 and end >= 20 and pval < 0.05
+
+
+def _spacetime_state(g1, g2, p_thresh=0.05):
+    X0, V, Q, labels = _sufficient_stats(g1, g2)
+    return {"kind": "spacetime", "X0": X0, "V": V, "Q": Q, "labels": labels,
+            "tcrit": t.ppf(1 - p_thresh / 2, labels.size - 2), "pairs": np.zeros((0, 2), dtype=int)}
+
+
+def test_adaptive_permutations_stop_once_pvalues_are_resolved():
+    state = _spacetime_state(*_groups(effect_ch=(0,)))
+    masses = np.array([1e6, 0.0])    # one cluster no permutation reaches, one every permutation beats
+    pvals, used = schedule_permutations(state, np.zeros(2, dtype=int), masses, 1000, seed=3, adaptive=True)
+    assert used < 1000 and used % 100 == 0
+    assert pvals[0] < 0.05 and pvals[1] == 1.0
+    _, used_full = schedule_permutations(state, np.zeros(2, dtype=int), masses, 1000, seed=3, adaptive=False)
+    assert used_full == 1000
+
+
+def test_adaptive_permutations_run_on_for_borderline_pvalues():
+    state = _spacetime_state(*_groups())
+    _init_perm_worker(state)
+    null = np.concatenate([_null_chunk((seq, 100))[0] for seq in np.random.SeedSequence(3).spawn(4)])
+    # a mass at the null's 95th percentile keeps p at alpha, so the whole budget is used
+    pvals, used = schedule_permutations(state, [0], [np.quantile(null, 0.95)], 400, seed=3, adaptive=True)
+    assert used == 400
+    assert abs(pvals[0] - 0.05) < 0.01
+
+
+def test_seeded_permutations_do_not_depend_on_workers():
+    g1, g2 = _groups(effect_ch=(1,))
+    serial = cluster_permutation_time(g1, g2, 256, n_perm=300, seed=7, workers=1)
+    pooled = cluster_permutation_time(g1, g2, 256, n_perm=300, seed=7, workers=2)
+    assert serial == pooled
+    again = cluster_permutation_time(g1, g2, 256, n_perm=300, seed=8, workers=1)
+    assert [c[:3] for c in again[1]] == [c[:3] for c in serial[1]]
+
+
+def _scipy_cluster_permutation_time(group1, group2, n_perm, rng, p_thresh=0.05):
+    """Per-channel, per-timepoint ttest_ind loop with the same permutation draw order"""
+    allsub = np.concatenate([group1, group2])
+    labels = np.array([0] * group1.shape[0] + [1] * group2.shape[0])
+    tcrit = t.ppf(1 - p_thresh / 2, labels.size - 2)
+
+    def tvals(a, b):
+        out = np.zeros(a.shape[-1])
+        for tt in range(a.shape[-1]):
+            x = a[:, tt][~np.isnan(a[:, tt])]; y = b[:, tt][~np.isnan(b[:, tt])]
+            if x.size >= 2 and y.size >= 2:
+                out[tt] = np.nan_to_num(ttest_ind(x, y, equal_var=False).statistic)
+        return np.abs(out)
+
+    def runs(tv):
+        edges = np.diff(np.r_[0, (tv > tcrit).astype(int), 0])
+        return [(s, e, tv[s:e].sum()) for s, e in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))]
+
+    results = {}
+    for ch in range(allsub.shape[1]):
+        clusters = runs(tvals(group1[:, ch], group2[:, ch]))
+        if not clusters:
+            continue
+        null = []
+        for _ in range(n_perm):
+            perm = rng.permutation(labels)
+            null.append(max((c[2] for c in runs(tvals(allsub[perm == 0, ch], allsub[perm == 1, ch]))), default=0))
+        results[ch] = [(s, e, (np.sum(np.array(null) >= m) + 1) / (n_perm + 1)) for s, e, m in clusters]
+    return results
+
+
+def test_time_pvalues_match_scipy_loop_on_nan_data():
+    rng = np.random.default_rng(56)
+    g1 = rng.normal(size=(5, 3, 30)); g2 = rng.normal(size=(5, 3, 30)) + 0.8
+    g1[rng.random(g1.shape) < 0.1] = np.nan; g2[rng.random(g2.shape) < 0.1] = np.nan
+    g1[:, 1, 7] = g2[:, 1, 7] = np.nan
+    # 5 + 5 subjects: permutations often repeat the observed split, whose mass must tie exactly
+    expected = _scipy_cluster_permutation_time(g1, g2, 50, np.random.RandomState(1))
+    results = cluster_permutation_time(g1, g2, 256, n_perm=50, rng=np.random.RandomState(1))
+    assert {ch: [(s, e, p) for s, e, _, p in c] for ch, c in results.items() if c} == expected
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from decimation import DecimationPyramid, lttb, minmax_decimate
+
+
+def _signal(n=10000, seed=0):
+    x = np.cumsum(np.random.default_rng(seed).normal(size=(2, n)), axis=-1)
+    x[0, n // 8] += 500.0     # spikes a decimator must not drop
+    x[1, n - n // 8] -= 500.0
+    return x
+
+
+def test_minmax_decimate_keeps_extremes_within_target():
+    x = _signal()
+    indices, values = minmax_decimate(x, 500)
+    assert values.shape[-1] <= 500
+    np.testing.assert_array_equal(values, np.take_along_axis(x, indices, axis=-1))
+    assert np.all(np.diff(indices, axis=-1) >= 0)
+    np.testing.assert_array_equal(values.max(axis=-1), x.max(axis=-1))
+    np.testing.assert_array_equal(values.min(axis=-1), x.min(axis=-1))
+
+
+def test_lttb_keeps_ends_and_size():
+    x = _signal()
+    indices, values = lttb(x, 300)
+    assert indices.shape == (2, 300)
+    assert np.all(indices[:, 0] == 0) and np.all(indices[:, -1] == x.shape[-1] - 1)
+    assert np.all(np.diff(indices, axis=-1) > 0)
+    np.testing.assert_array_equal(values, np.take_along_axis(x, indices, axis=-1))
+    assert 1250 in indices[0] and 8750 in indices[1]
+
+
+@pytest.mark.parametrize("start,end,target", [
+    (0, 10000, 400),
+    (17, 9999, 256),
+    (1000, 1300, 64),
+    (1230, 1240, 4),
+    (5000, 5100, 1000),     # fits in target: raw samples
+])
+def test_pyramid_query_keeps_extremes_within_bounds(start, end, target):
+    x = _signal()
+    pyramid = DecimationPyramid(x)
+    indices, values = pyramid.query(start, end, target)
+    assert values.shape[-1] <= target + 4
+    assert np.all((indices >= start) & (indices < end))
+    assert np.all(np.diff(indices, axis=-1) >= 0)
+    np.testing.assert_array_equal(values, np.take_along_axis(x, indices, axis=-1))
+    window = x[:, start:end]
+    np.testing.assert_array_equal(values.max(axis=-1), window.max(axis=-1))
+    np.testing.assert_array_equal(values.min(axis=-1), window.min(axis=-1))
+
+
+def test_pyramid_ignores_nan_and_clamps_range():
+    x = _signal(n=1000)
+    x[0, 100:300] = np.nan
+    indices, values = DecimationPyramid(x).query(-50, 5000, 100)
+    assert values.shape[-1] <= 104
+    assert np.all((indices >= 0) & (indices < 1000))
+    np.testing.assert_array_equal(values, np.take_along_axis(x, indices, axis=-1))  # NaN only for all-NaN buckets
+    np.testing.assert_array_equal(np.nanmax(values, axis=-1), np.nanmax(x, axis=-1))
+    np.testing.assert_array_equal(np.nanmin(values, axis=-1), np.nanmin(x, axis=-1))
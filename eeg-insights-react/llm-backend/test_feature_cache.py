@@ -0,0 +1,28 @@
+import numpy as np
+from feature_cache import FeatureCache
+
+
+def test_keys_hash_array_inputs_by_content():
+    x = np.arange(6.0).reshape(2, 3)
+    assert FeatureCache.key_for("f", {}, [x]) == FeatureCache.key_for("f", {}, [FeatureCache.key_for_array(x)])
+    assert FeatureCache.key_for("f", {}, [x]) == FeatureCache.key_for("f", {}, [x.copy()])
+    assert FeatureCache.key_for("f", {}, [x]) != FeatureCache.key_for("f", {}, [x + 1])
+    assert FeatureCache.key_for("f", {}, [x]) != FeatureCache.key_for("f", {"p": 1}, [x])
+
+
+def test_batch_compute_only_computes_new_subjects():
+    cache = FeatureCache(cache_dir=None)
+    data = np.random.default_rng(0).normal(size=(4, 3, 5))
+    calls = []
+
+    def mean(idx):
+        calls.append(list(idx))
+        return {"mean": data[idx].mean(axis=-1)}
+
+    keys, out = cache.compute("mean", {}, [data[:3]], mean, batch=True)
+    assert len(set(keys)) == 3
+    np.testing.assert_allclose(out["mean"], data[:3].mean(axis=-1))
+    keys_all, out = cache.compute("mean", {}, [data], mean, batch=True)
+    assert keys_all[:3] == keys
+    assert calls == [[0, 1, 2], [3]]
+    np.testing.assert_allclose(out["mean"], data.mean(axis=-1))
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from feature_cache import FeatureCache
+from group_stats import GroupStatsStore, RunningStats
+
+
+def _subjects(n=6, shape=(3, 5), seed=0):
+    rng = np.random.default_rng(seed)
+    subjects = {f"s{i}": {"x": rng.normal(size=shape) * (i + 1)} for i in range(n)}
+    subjects["s1"]["x"][0, 0] = np.nan
+    return subjects
+
+
+def test_running_stats_match_nan_aware_numpy():
+    X = np.stack([f["x"] for f in _subjects().values()])
+    stats = RunningStats(X.shape[1:])
+    for x in X:
+        stats.add(x)
+    np.testing.assert_allclose(stats.mean, np.nanmean(X, axis=0))
+    np.testing.assert_allclose(stats.std(), np.nanstd(X, axis=0))
+    np.testing.assert_allclose(stats.variance(ddof=1), np.nanvar(X, axis=0, ddof=1))
+
+
+def test_running_stats_remove_undoes_add():
+    X = np.stack([f["x"] for f in _subjects().values()])
+    stats = RunningStats(X.shape[1:])
+    for x in X:
+        stats.add(x)
+    stats.remove(X[1]).remove(X[4])
+    rest = X[[0, 2, 3, 5]]
+    np.testing.assert_array_equal(stats.count, (~np.isnan(rest)).sum(axis=0))
+    np.testing.assert_allclose(stats.mean, rest.mean(axis=0))
+    np.testing.assert_allclose(stats.std(), rest.std(axis=0))
+    for x in rest:
+        stats.remove(x)
+    assert np.all(stats.count == 0) and np.isnan(stats.mean).all()
+
+
+def test_running_stats_merge_and_state():
+    X = np.stack([f["x"] for f in _subjects().values()])
+    a, b = RunningStats(X.shape[1:]), RunningStats(X.shape[1:])
+    for x in X[:2]:
+        a.add(x)
+    for x in X[2:]:
+        b.add(x)
+    merged = RunningStats.from_state(a.state()).merge(b)
+    np.testing.assert_allclose(merged.mean, np.nanmean(X, axis=0))
+    np.testing.assert_allclose(merged.std(), np.nanstd(X, axis=0))
+    with pytest.raises(ValueError):
+        a.merge(RunningStats((2,)))
+
+
+def test_sync_adds_and_removes_subjects():
+    subjects = _subjects()
+    store = GroupStatsStore()
+    assert store.sync("g", subjects) == (6, 0)
+    keep = ["s0", "s2", "s3"]
+    assert store.sync("g", {sid: (lambda sid=sid: subjects[sid]) for sid in keep}) == (0, 3)
+    X = np.stack([subjects[sid]["x"] for sid in keep])
+    summary = store.summary("g", "x")
+    assert store.subjects("g") == keep
+    np.testing.assert_allclose(summary["mean"], X.mean(axis=0))
+    np.testing.assert_allclose(summary["p50"], np.percentile(X, 50, axis=0))
+
+
+def test_evicted_subjects_are_reloaded_through_loaders():
+    subjects = _subjects()
+    loads = []
+    def loader(sid):
+        loads.append(sid)
+        return subjects[sid]
+    store = GroupStatsStore(FeatureCache(cache_dir=None, max_items=1))   # keeps one entry at most
+    store.sync("g", {sid: (lambda sid=sid: loader(sid)) for sid in subjects})
+    del loads[:]
+    store.sync("g", {sid: (lambda sid=sid: loader(sid)) for sid in ["s0", "s1", "s2"]})
+    summary = store.summary("g", "x")
+    X = np.stack([subjects[sid]["x"] for sid in ["s0", "s1", "s2"]])
+    np.testing.assert_allclose(summary["mean"], np.nanmean(X, axis=0))
+    np.testing.assert_allclose(summary["p50"], np.nanpercentile(X, 50, axis=0))
+    assert loads   # removals and the sketch rebuild went back to the loaders
+
+
+def test_evicted_subjects_are_restored_from_synced_features():
+    subjects = _subjects()
+    store = GroupStatsStore(FeatureCache(cache_dir=None, max_items=1))
+    store.sync("g", subjects)
+    store.sync("g", {sid: subjects[sid] for sid in ["s0", "s1", "s2"]})
+    X = np.stack([subjects[sid]["x"] for sid in ["s0", "s1", "s2"]])
+    np.testing.assert_allclose(store.summary("g", "x")["mean"], np.nanmean(X, axis=0))
+
+
+def test_remove_without_cache_entry_or_loader_raises():
+    subjects = _subjects()
+    store = GroupStatsStore(FeatureCache(cache_dir=None, max_items=1))
+    for sid in ["s0", "s1"]:
+        store.add("g", sid, subjects[sid])
+    with pytest.raises(KeyError):
+        store.remove("g", "s0")
+
+
+def test_save_and_load_roundtrip():
+    subjects = _subjects()
+    cache = FeatureCache(cache_dir=None, max_items=100)
+    store = GroupStatsStore(cache)
+    store.sync("g", subjects)
+    store.save("test")
+    loaded = GroupStatsStore(cache)
+    assert loaded.load("test") and not GroupStatsStore(cache).load("other")
+    assert loaded.subjects("g") == store.subjects("g")
+    for key, value in store.summary("g", "x").items():
+        np.testing.assert_allclose(loaded.summary("g", "x")[key], value)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from quantile_sketch import QuantileSketch, sketch_percentiles
+
+Q = (1, 10, 25, 50, 75, 90, 99)
+
+
+def _ranks(data, estimates):
+    """Fraction of each column's values at or below each estimate, (len(Q), n_cols)"""
+    return np.stack([(data <= est).mean(axis=0) for est in estimates])
+
+
+def test_exact_below_sketch_size():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(100, 6))
+    data[::7, 2] = np.nan
+    data[:, 5] = np.nan
+    estimates, _ = sketch_percentiles(data, Q, sketch_size=128, chunk_rows=13)
+    np.testing.assert_allclose(estimates, np.nanpercentile(data, Q, axis=0), equal_nan=True)
+
+
+@pytest.mark.parametrize("sketch_size", [64, 128, 256])
+def test_rank_error_stays_within_bound(sketch_size):
+    rng = np.random.default_rng(1)
+    data = np.concatenate([rng.normal(size=(20000, 3)), rng.exponential(size=(20000, 1))], axis=1)
+    estimates, sketch = sketch_percentiles(data, Q, sketch_size=sketch_size, chunk_rows=1000)
+    error = np.abs(_ranks(data, estimates) - np.array(Q)[:, None] / 100)
+    bound = np.log2(data.shape[0] / sketch_size) / sketch_size
+    assert error.max() <= bound
+    # memory stays about 3 * sketch_size rows however long the stream is
+    assert sum(level.shape[0] for level in sketch.levels) <= 3 * sketch_size
+
+
+def test_merged_sketches_match_single_stream_accuracy():
+    rng = np.random.default_rng(2)
+    data = rng.uniform(size=(12000, 2))
+    parts = [QuantileSketch((2,), sketch_size=128, seed=i).update(chunk) for i, chunk in enumerate(np.split(data, 4))]
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+    assert merged.n == data.shape[0]
+    error = np.abs(_ranks(data, merged.percentiles(Q)) - np.array(Q)[:, None] / 100)
+    assert error.max() <= np.log2(data.shape[0] / 128) / 128
+    with pytest.raises(ValueError):
+        merged.merge(QuantileSketch((3,)))
+
+
+def test_nan_rows_carry_no_weight():
+    rng = np.random.default_rng(3)
+    data = rng.normal(size=(5000, 2))
+    with_nan = data.copy()
+    with_nan[rng.random(5000) < 0.3, 0] = np.nan
+    estimates, _ = sketch_percentiles(with_nan, Q, sketch_size=128)
+    valid = with_nan[:, 0][~np.isnan(with_nan[:, 0])]
+    error = np.abs((valid[:, None] <= estimates[:, 0]).mean(axis=0) - np.array(Q) / 100)
+    assert error.max() <= np.log2(valid.size / 128) / 128
+    assert np.isnan(QuantileSketch((1,)).update(np.full((10, 1), np.nan)).percentiles(Q)).all()
+
+
+def test_state_roundtrip():
+    data = np.random.default_rng(4).normal(size=(3000, 3))
+    sketch = QuantileSketch((3,), sketch_size=64).update(data)
+    restored = QuantileSketch.from_state(sketch.state())
+    assert restored.n == sketch.n and restored.shape == sketch.shape
+    np.testing.assert_array_equal(restored.percentiles(Q), sketch.percentiles(Q))
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from rd_cache import CachingStreamWriter, RecordingCache
+from rd_parser import RDStreamParser, parse_rd_bytes
+
+CHANNELS = ["FP1", "FP2", "CZ", "X"]
+
+
+def _rd_text(trials=(0, 3, 7), n_samples=40, seed=0):
+    rng = np.random.default_rng(seed)
+    lines = ["# co2c0000001.rd",
+             f"# {len(trials)} trials, {len(CHANNELS)} chans, {n_samples} samples 30 post_stim samples",
+             "# 3.906000 msecs uV"]
+    for trial in trials:
+        lines.append(f"# S1 obj , trial {trial}")
+        for idx, name in enumerate(CHANNELS):
+            lines.append(f"# {name} chan {idx}")
+            # a channel missing from the last trial leaves NaN there
+            if trial == trials[-1] and name == "X":
+                continue
+            lines.extend(f"{trial} {name} {s} {v:.3f}" for s, v in enumerate(rng.normal(size=n_samples) * 10))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _assert_same(a, b):
+    assert a.channels == b.channels
+    np.testing.assert_array_equal(a.trial_ids, b.trial_ids)
+    assert a.sampling_rate == b.sampling_rate
+    np.testing.assert_array_equal(a.data, b.data)   # NaN compare equal here
+
+
+def _chunks(buf, sizes):
+    pos, i = 0, 0
+    while pos < len(buf):
+        n = sizes[i % len(sizes)]
+        yield buf[pos:pos + n]
+        pos += n; i += 1
+
+
+@pytest.mark.parametrize("sizes,block_size", [
+    ([1], 64),
+    ([7, 3, 11], 50),
+    ([4096], 1 << 20),
+    ([333, 1], 17),
+])
+def test_stream_parser_matches_parse_rd_bytes(sizes, block_size):
+    buf = _rd_text()
+    parser = RDStreamParser(block_size=block_size)
+    for chunk in _chunks(buf, sizes):
+        parser.feed(chunk)
+    _assert_same(parser.finish(), parse_rd_bytes(buf))
+
+
+def test_stream_parser_on_random_splits():
+    buf = _rd_text(trials=tuple(range(5)), n_samples=25, seed=1)
+    expected = parse_rd_bytes(buf)
+    rng = np.random.default_rng(2)
+    for _ in range(5):
+        cuts = np.sort(rng.choice(len(buf), size=20, replace=False))
+        parser = RDStreamParser(block_size=int(rng.integers(16, 512)))
+        for chunk in np.split(np.frombuffer(buf, dtype=np.uint8), cuts):
+            parser.feed(chunk.tobytes())
+        _assert_same(parser.finish(), expected)
+
+
+def test_stream_parser_without_trailing_newline_or_rows():
+    buf = _rd_text().rstrip(b"\n")
+    parser = RDStreamParser(block_size=100)
+    parser.feed(buf)
+    _assert_same(parser.finish(), parse_rd_bytes(buf))
+    empty = RDStreamParser().finish()
+    assert empty.data.size == 0 and empty.channels == []
+
+
+def test_caching_stream_writer_key_and_recording(tmp_path):
+    buf = _rd_text()
+    cache = RecordingCache(cache_dir=str(tmp_path))
+    writer = CachingStreamWriter(cache)
+    for chunk in _chunks(buf, [5, 600]):
+        writer.write(chunk)
+    key, recording = writer.finish()
+    assert key == RecordingCache.key_for_bytes(buf)
+    _assert_same(recording, parse_rd_bytes(buf))
+    _assert_same(cache.get(key), recording)
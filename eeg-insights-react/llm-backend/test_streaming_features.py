@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from eeg_dsp import windowed_features
+from streaming_features import WindowedFeatureEngine
+
+
+def _stream(engine, data, chunk_sizes):
+    starts, variances, bandpowers = [], [], []
+    pos, i = 0, 0
+    while pos < data.shape[-1]:
+        n = chunk_sizes[i % len(chunk_sizes)]
+        out = engine.push(data[:, pos:pos + n])
+        starts.append(out['start']); variances.append(out['variance']); bandpowers.append(out['bandpower'])
+        pos += n; i += 1
+    return (np.concatenate(starts), np.concatenate(variances, axis=1),
+            np.concatenate(bandpowers, axis=1))
+
+
+@pytest.mark.parametrize("window_size,hop,chunks", [
+    (256, None, [256]),
+    (256, None, [1, 7, 300, 64]),
+    (128, 32, [5, 1000, 13]),
+    (64, 96, [50]),             # hop larger than the window skips samples
+])
+def test_engine_matches_windowed_features(window_size, hop, chunks):
+    rng = np.random.default_rng(0)
+    t = np.arange(4000) / 256.0
+    data = rng.normal(size=(3, t.size)) + 20 * np.sin(2 * np.pi * 10 * t) + 100.0  # offset tests conditioning
+    expected = windowed_features(data, 256.0, window_size, hop=hop)
+    engine = WindowedFeatureEngine(3, 256.0, window_size, hop=hop, refresh_windows=4)
+    starts, variance, bandpower = _stream(engine, data, chunks)
+    np.testing.assert_array_equal(starts, expected['start'])
+    np.testing.assert_allclose(variance, expected['variance'], rtol=1e-7, atol=1e-9)
+    np.testing.assert_allclose(bandpower, expected['bandpower'], rtol=1e-7, atol=1e-9)
+
+
+def test_single_channel_input_and_reset():
+    data = np.random.default_rng(1).normal(size=1000)
+    engine = WindowedFeatureEngine(1, 256.0, 100)
+    first = engine.push(data)
+    engine.reset()
+    again = engine.push(data)
+    np.testing.assert_array_equal(first['start'], again['start'])
+    np.testing.assert_allclose(first['variance'], again['variance'])
+    assert engine.push(np.zeros(0))['start'].size == 0
+
+
+def test_wrong_channel_count_raises():
+    with pytest.raises(ValueError):
+        WindowedFeatureEngine(2, 256.0, 64).push(np.zeros((3, 10)))
@@ -0,0 +1,56 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+import pytest
+import app as app_module
+import rd_cache
+import rd_parser
+from rd_cache import RecordingCache
+
+PARSE_DELAY = 0.1   # stands in for converting one block of rows
+BLOCK_SIZE = 2048   # small blocks so most of a file is parsed while the body is still being read
+
+
+def _rd_file(seed, n_samples=64):
+    rng = np.random.default_rng(seed)
+    lines = ["# co2c0000001.rd", f"# 2 trials, 2 chans, {n_samples} samples 30 post_stim samples",
+             "# 3.906000 msecs uV"]
+    for trial in (0, 1):
+        for idx, name in enumerate(["FP1", "CZ"]):
+            lines.append(f"# {name} chan {idx}")
+            lines.extend(f"{trial} {name} {s} {v:.3f}" for s, v in enumerate(rng.normal(size=n_samples)))
+    return ("\n".join(lines) + "\n").encode()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(rd_cache, '_default_cache', RecordingCache(cache_dir=str(tmp_path)))
+    pool = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(app_module, '_upload_executor', pool)
+    monkeypatch.setattr(rd_cache, 'RDStreamParser', partial(rd_parser.RDStreamParser, block_size=BLOCK_SIZE))
+    parse_rows = rd_parser._parse_rows
+    def slow_parse_rows(data):
+        time.sleep(PARSE_DELAY)
+        return parse_rows(data)
+    monkeypatch.setattr(rd_parser, '_parse_rows', slow_parse_rows)
+    yield app_module.app.test_client()
+    pool.shutdown()
+
+
+def _upload(client, seeds):
+    files = [(io.BytesIO(_rd_file(seed)), f"s{seed}.rd") for seed in seeds]
+    start = time.perf_counter()
+    response = client.post('/api/upload-rd', data={'files': files}, content_type='multipart/form-data')
+    return time.perf_counter() - start, response.get_json()
+
+
+def test_multi_file_upload_takes_about_as_long_as_one_file(client):
+    single, result = _upload(client, [0])
+    assert result['success'] and len(result['file_ids']) == 1
+    multi, result = _upload(client, [1, 2, 3, 4])
+    assert result['success'] and result['errors'] == []
+    assert len(set(result['file_ids'])) == 4
+    # parsed one after another, four files would take four times as long as one
+    assert multi < 2 * single
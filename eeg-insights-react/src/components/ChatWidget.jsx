@@ -1,7 +1,7 @@
 import React, { useState } from "react";
 import "./ChatWidget.css";
 
-export default function ChatWidget() {
+export default function ChatWidget({ recordingId = null, channel = null }) {
   const [isOpen, setIsOpen] = useState(false);
   const [messages, setMessages] = useState([]);
   const [input, setInput] = useState("");
@@ -19,7 +19,12 @@ export default function ChatWidget() {
       const res = await fetch("http://localhost:5000/chat", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ message: input }),
+        // with an uploaded .rd recording the backend adds its signal to the chat context
+        body: JSON.stringify(
+          recordingId
+            ? { message: input, recording_id: recordingId, channel }
+            : { message: input }
+        ),
       });
       const data = await res.json();
       setMessages((prev) => [...prev, { role: "assistant", content: data.reply }]);
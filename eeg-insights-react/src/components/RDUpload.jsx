@@ -1,5 +1,6 @@
 import { useState } from 'react';
 import './CSVUpload.css'; // Reuse styles
+import { decodeArray, decodeTimes } from '../utils/signalCodec';
 
 function RDUpload({ onDataLoaded }) {
   const [uploading, setUploading] = useState(false);
@@ -14,10 +15,10 @@ function RDUpload({ onDataLoaded }) {
     setError(null);
 
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('files', file);
 
     try {
-      const response = await fetch('http://localhost:5000/api/upload-rd', {
+      const response = await fetch('http://localhost:5000/api/upload-rd?encoding=f32', {
         method: 'POST',
         body: formData,
       });
@@ -29,19 +30,20 @@ function RDUpload({ onDataLoaded }) {
       }
 
       setFileInfo({
-        name: result.filename,
+        name: result.filenames.join(', '),
         channels: result.available_channels.length,
         trials: result.metadata.n_trials,
         duration: result.metadata.duration,
         samplingRate: result.metadata.sampling_rate
       });
 
-      // Pass data to parent
+      // Pass data to parent; recordingId lets later analyze/chat calls skip re-sending the signal
       onDataLoaded({
-        visualizationData: result.visualization_data.signal,
-        times: result.visualization_data.times,
-        fullSignal: result.full_signal.signal,
-        fullTimes: result.full_signal.times,
+        recordingId: result.recording_id,
+        visualizationData: Array.from(decodeArray(result.visualization_data.signal)),
+        times: Array.from(decodeArray(result.visualization_data.times)),
+        fullSignal: Array.from(decodeArray(result.full_signal.signal)),
+        fullTimes: Array.from(decodeTimes(result.full_signal.times)),
         metadata: result.metadata,
         availableChannels: result.available_channels
       });
@@ -1,10 +1,11 @@
 import { useState } from "react";
 import ChatWidget from "../components/ChatWidget";
 import CSVUpload from "../components/CSVUpload";
+import RDUpload from "../components/RDUpload";
 import EEGPlot from "../components/EEGPlot";
 import BandpowerPlot from "../components/BandpowerPlot";
 import AnalysisResults from "../components/AnalysisResults";
-import { analyzeWindows } from "../utils/eegAnalysis";
+import { analyzeWindows, analyzeWindowsRemote } from "../utils/eegAnalysis";
 import {
   exportToMarkdown,
   downloadMarkdownReport,
@@ -20,17 +21,45 @@ function App() {
   const [metadata, setMetadata] = useState({});
   const [windowSize, setWindowSize] = useState(256);
   const [samplingRate, setSamplingRate] = useState(256);
+  // Set for .rd uploads: the backend keeps the recording, so AI/chat requests send its id instead of the signal
+  const [recordingId, setRecordingId] = useState(null);
+  const [channel, setChannel] = useState(null);
   // AI Insights state
   const [aiData, setAiData] = useState(null);
   const [aiLoading, setAiLoading] = useState(false);
   const [aiError, setAiError] = useState(null);
 
-  const handleDataLoaded = (data, fileMetadata) => {
+  // Windowed features come from the backend; fall back to the in-browser version if it is unreachable
+  const runWindowAnalysis = async (data) => {
+    try {
+      return await analyzeWindowsRemote(data, windowSize, samplingRate);
+    } catch (err) {
+      return analyzeWindows(data, windowSize, samplingRate);
+    }
+  };
+
+  const handleCSVLoaded = (data, fileMetadata) => {
+    setRecordingId(null);
+    setChannel(null);
+    return handleDataLoaded(data, fileMetadata);
+  };
+
+  const handleRDLoaded = (rd) => {
+    setRecordingId(rd.recordingId);
+    setChannel(rd.availableChannels[0] || null);
+    if (rd.metadata.sampling_rate) setSamplingRate(rd.metadata.sampling_rate);
+    return handleDataLoaded(rd.fullSignal, {
+      ...rd.metadata,
+      samples: rd.fullSignal.length,
+    });
+  };
+
+  const handleDataLoaded = async (data, fileMetadata) => {
     setEegData(data);
     setMetadata(fileMetadata);
 
     // Automatically run analysis
-    const results = analyzeWindows(data, windowSize, samplingRate);
+    const results = await runWindowAnalysis(data);
     setAnalysisResults(results);
 
     // Generate mock LLM explanation
@@ -38,10 +67,10 @@ function App() {
     setLlmExplanation(explanation);
   };
 
-  const handleReanalyze = () => {
+  const handleReanalyze = async () => {
     if (!eegData) return;
 
-    const results = analyzeWindows(eegData, windowSize, samplingRate);
+    const results = await runWindowAnalysis(eegData);
     setAnalysisResults(results);
 
     const explanation = generateMockExplanation(results);
@@ -80,12 +109,16 @@ function App() {
       const response = await fetch("http://localhost:5000/api/analyze-eeg", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          signal: eegData,
-          times: eegData.map((_, i) => i / samplingRate),
-          metadata,
-          use_ai: true,
-        }),
+        body: JSON.stringify(
+          recordingId
+            ? { recording_id: recordingId, channel, use_ai: true }
+            : {
+                signal: eegData,
+                times: eegData.map((_, i) => i / samplingRate),
+                metadata,
+                use_ai: true,
+              }
+        ),
       });
       const data = await response.json();
       setAiData(data);
@@ -104,7 +137,8 @@ function App() {
 
       <main className="app-main">
         <section className="upload-section">
-          <CSVUpload onDataLoaded={handleDataLoaded} />
+          <CSVUpload onDataLoaded={handleCSVLoaded} />
+          <RDUpload onDataLoaded={handleRDLoaded} />
         </section>
 
         {eegData && (
@@ -230,11 +264,11 @@ function App() {
       <footer className="app-footer">
         <p>EEG Insights - Built with Vite, React, and Plotly.js</p>
       </footer>
-      <ChatWidget />
+      <ChatWidget recordingId={recordingId} channel={channel} />
     </div>
   );
 }
 
 export default function Analyzer() {
-  // (everything inside original App function goes here unchanged)
+  return <App />;
 }
@@ -106,3 +106,44 @@ export function analyzeWindows(data, windowSize, samplingRate = 256) {
     };
   });
 }
+
+/**
+ * Analyze EEG data windows on the backend (/api/windowed-features)
+ * The server computes all windows with one batched FFT; this only reshapes
+ * its columnar response into the same per-window objects as analyzeWindows.
+ * @param {number[]} data - Array of signal values
+ * @param {number} windowSize - Size of each window
+ * @param {number} samplingRate - Sampling rate in Hz
+ * @param {string} apiUrl - Backend base URL
+ * @returns {Promise<Object[]>} Array of analysis results per window
+ */
+export async function analyzeWindowsRemote(
+  data,
+  windowSize,
+  samplingRate = 256,
+  apiUrl = "http://localhost:5000"
+) {
+  const response = await fetch(`${apiUrl}/api/windowed-features`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      signal: data,
+      sampling_rate: samplingRate,
+      window_size: windowSize,
+    }),
+  });
+  const result = await response.json();
+  if (!result.success) {
+    throw new Error(result.error || "Windowed analysis failed");
+  }
+
+  const variance = result.variance[0] || [];
+  const bandNames = Object.keys(result.bands);
+  return variance.map((value, index) => ({
+    windowIndex: index,
+    variance: value,
+    bandpower: Object.fromEntries(
+      bandNames.map((band) => [band, result.bandpower[band][0][index]])
+    ),
+  }));
+}
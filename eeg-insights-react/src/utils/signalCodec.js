@@ -0,0 +1,37 @@
+/**
+ * Decoders for the backend's opt-in float32 encoding
+ * (request with ?encoding=f32 or Accept: application/vnd.eeg-f32+json)
+ */
+
+/**
+ * Decode an array field: plain JSON lists pass through, encoded ones become Float32Arrays
+ * @param {Array|Object} value - JSON list or { dtype: '<f4', shape, data (base64) }
+ * @returns {Array|Float32Array|Float32Array[]} 1-D arrays as a Float32Array, 2-D as one per row
+ */
+export function decodeArray(value) {
+  if (!value || Array.isArray(value) || value.dtype !== "<f4") return value;
+
+  const bytes = Uint8Array.from(atob(value.data), (c) => c.charCodeAt(0));
+  const flat = new Float32Array(bytes.buffer);
+  if (value.shape.length < 2) return flat;
+
+  const rowLength = value.shape[value.shape.length - 1];
+  const rows = [];
+  for (let i = 0; i < flat.length; i += rowLength) {
+    rows.push(flat.subarray(i, i + rowLength));
+  }
+  return rows;
+}
+
+/**
+ * Expand an implicit time axis ({ start, step, length }); lists pass through
+ * @param {Array|Object} times - JSON list or implicit axis
+ * @returns {Array|Float64Array} Time of every sample in seconds
+ */
+export function decodeTimes(times) {
+  if (!times || Array.isArray(times) || times.step === undefined) return decodeArray(times);
+
+  const out = new Float64Array(times.length);
+  for (let i = 0; i < times.length; i++) out[i] = times.start + i * times.step;
+  return out;
+}